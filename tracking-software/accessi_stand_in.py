@@ -0,0 +1,475 @@
+"""
+Local stand-in for the Access-i server (MR host), for load testing the pipeline without a scanner or simulator.
+
+Implements the HTTPS endpoints accessi_local uses (Remote, Authorization, HostControl, TemplateExecution,
+TemplateModification, ParameterStandard, Table, Image) and the imageStream websocket.
+While a template is running, frames are streamed to every connected websocket at the given frame rate (with jitter).
+Frames are synthetic (phantom + moving artifacts), loaded from a folder of images or replayed from a session
+recorded by AccessiWebsocket (SessionRecorder, memory mapped, so long sessions do not need to fit in RAM).
+The slice position/orientation set over REST is reported in the image metadata of the following frames.
+
+Usage: python accessi_stand_in.py [--fps 3] [--jitter 0.02] [--frames folder | --session file] [--size 256] [--autostart]
+Then register in the main UI with IP 127.0.0.1 and version v2.
+
+TLS uses a self signed certificate, generated with openssl if --cert/--key are not given.
+--no-tls serves http/ws instead, the client then needs config.protocol = "http", config.websocket_protocol = "ws".
+"""
+
+import os
+import sys
+import ssl
+import json
+import time
+import uuid
+import base64
+import random
+import asyncio
+import argparse
+import threading
+import subprocess
+import tempfile
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import websockets
+
+sys.path.append("./modules")
+from modules.SessionRecorder import SessionReader
+
+
+def result(success=True, reason="ok"):
+    return {"result": {"success": success, "reason": reason, "time": datetime.now().strftime("%Y%m%dT%H%M%S.%f")[:-3]}}
+
+
+def vector(values, keys=("x", "y", "z")):
+    return {key: float(value) for key, value in zip(keys, values)}
+
+
+def synthetic_frames(size=256, count=64):
+    """
+    Disk phantom with noise and three dark artifacts moving along a line, like a guidewire being pushed.
+    """
+    y, x = np.mgrid[0:size, 0:size]
+    center = size / 2
+    phantom = np.where((x - center) ** 2 + (y - center) ** 2 < (0.4 * size) ** 2, 1500.0, 100.0)
+    rng = np.random.default_rng(0)
+    frames = []
+    for index in range(count):
+        frame = phantom + rng.normal(0, 40, phantom.shape)
+        progress = 0.3 + 0.4 * (index % count) / count
+        for artifact in range(3):
+            ax, ay = size * (progress - 0.06 * artifact), size * (0.35 + 0.1 * artifact)
+            frame[(x - ax) ** 2 + (y - ay) ** 2 < (size / 64) ** 2] = 20
+        frames.append(np.clip(frame, 0, 4095).astype(np.uint16))
+    return frames
+
+
+def load_frames(folder):
+    import cv2
+    frames = []
+    for name in sorted(os.listdir(folder)):
+        image = cv2.imread(os.path.join(folder, name), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            continue
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if image.dtype == np.uint8:
+            # 8 bit exports, spread to the 12 bit range the scanner sends.
+            image = image.astype(np.uint16) * 16
+        frames.append(image.astype(np.uint16))
+    if not frames:
+        raise SystemExit(f"No images found in {folder}")
+    return frames
+
+
+class StandInState:
+    """
+    Everything the REST handlers change and the frame streamer reads.
+    """
+
+    def __init__(self, autostart=False):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.control_session = None
+        self.image_format = "raw16bit"
+        self.image_service_sessions = set()
+        self.templates = [{"id": str(uuid.uuid4()), "label": "Stand-in Interactive Template", "isInteractive": True},
+                          {"id": str(uuid.uuid4()), "label": "Stand-in T2 Template", "isInteractive": False}]
+        self.open_template = None
+        self.running_template = self.templates[0]["id"] if autostart else None
+        self.autostart = autostart
+        self.paused = False
+        self.series_number = 0
+        self.slice_position = [0.0, 0.0, 0.0]
+        self.slice_orientation = {"normal": [0.0, 0.0, -1.0], "phase": [0.0, -1.0, 0.0], "read": [-1.0, 0.0, 0.0]}
+        self.slice_thickness = 10.0
+        self.field_of_view = 300.0
+        self.base_resolution = 256
+        self.table_position = 0
+        self.table_mode = "isoCenter"
+        self.fix_table_position = 0
+
+    def scanning(self):
+        return self.running_template is not None and not self.paused
+
+    def template(self, template_id):
+        return next((template for template in self.templates if template["id"] == template_id), None)
+
+    def template_state(self, template_id):
+        template = self.template(template_id)
+        if template is None:
+            return {"isApplicable": False}
+        return {"isApplicable": True, "isTemplate": True, "isInteractive": template["isInteractive"],
+                "id": template["id"], "label": template["label"]}
+
+
+class AccessiRequests:
+    """
+    REST endpoints, path (after /SRC/<version>/product/) -> method(state, data) returning the reply dict.
+    """
+
+    def __init__(self, state: StandInState):
+        self.state = state
+        self.routes = {
+            "authorization/register": self.register,
+            "authorization/getIsRegistered": self.get_is_registered,
+            "authorization/deregister": self.deregister,
+            "hostControl/getState": self.host_control_state,
+            "hostControl/requestControl": self.request_control,
+            "hostControl/releaseControl": self.release_control,
+            "systemInformation/getSystemInfo": lambda data: {
+                **result(), "value": {"systemModel": "Stand-in", "fieldStrength": "1.5"}},
+            "systemInformation/getSerialNumber": lambda data: {**result(), "value": "0"},
+            "templateExecution/getTemplates": lambda data: {**result(), "value": self.state.templates},
+            "templateExecution/getState": self.execution_state,
+            "templateExecution/getRemainingMeasurementTimeInSeconds": lambda data: {
+                **result(), "isApplicable": self.state.running_template is not None, "value": 0},
+            "templateExecution/start": self.start,
+            "templateExecution/stop": self.stop,
+            "templateExecution/pause": lambda data: self.set_paused(True),
+            "templateExecution/continue": lambda data: self.set_paused(False),
+            "templateModification/getState": self.modification_state,
+            "templateModification/open": self.open,
+            "templateModification/close": self.close,
+            "parameter/standard/getSlicePositionDcs": lambda data: {
+                **result(), "value": vector(self.state.slice_position)},
+            "parameter/standard/setSlicePositionDcs": self.set_slice_position,
+            "parameter/standard/getSliceOrientationDcs": self.get_slice_orientation,
+            "parameter/standard/getSliceOrientationPcs": self.get_slice_orientation,
+            "parameter/standard/setSliceOrientationDcs": self.set_slice_orientation,
+            "parameter/standard/getNumberOfSliceGroups": lambda data: {**result(), "value": 1},
+            "parameter/standard/getNumberOfSlices": lambda data: {**result(), "value": 1},
+            "parameter/standard/getSliceThickness": lambda data: {**result(), "value": self.state.slice_thickness},
+            "parameter/standard/setSliceThickness": lambda data: self.set_value("slice_thickness", data, float),
+            "parameter/standard/getFieldOfViewRead": lambda data: {**result(), "value": self.state.field_of_view},
+            "parameter/standard/setFieldOfViewRead": lambda data: self.set_value("field_of_view", data, float),
+            "parameter/standard/getBaseResolution": lambda data: {**result(), "value": self.state.base_resolution},
+            "parameter/standard/setBaseResolution": lambda data: self.set_value("base_resolution", data, int),
+            "table/getCurrentTablePosition": lambda data: {**result(), "value": self.state.table_position},
+            "table/getTablePositioningMode": lambda data: {**result(), "value": self.state.table_mode},
+            "table/setTablePositioningMode": lambda data: self.set_value("table_mode", data, str),
+            "table/getFixTablePosition": lambda data: {**result(), "value": self.state.fix_table_position},
+            "table/setFixTablePosition": lambda data: self.set_value("fix_table_position", data, int),
+            "image/setImageFormat": self.set_image_format,
+            "image/getLastSeriesNumber": lambda data: {**result(), "value": self.state.series_number},
+            "image/connectServiceToDefaultWebSocket": self.connect_image_service,
+        }
+        self.remote_routes = {
+            "getIsActive": lambda data: {**result(), "value": True, "isProductionSystem": False},
+            "getVersion": lambda data: {**result(), "value": "2.0"},
+        }
+        self.open_routes = {"authorization/register"}
+
+    def handle(self, path, data):
+        """
+        :return: http status, reply dict
+        """
+        parts = path.strip("/").split("/")
+        if parts[:3] == ["SRC", "product", "remote"] and "/".join(parts[3:]) in self.remote_routes:
+            return 200, self.remote_routes["/".join(parts[3:])](data)
+        if len(parts) < 4 or parts[0] != "SRC" or parts[2] != "product":
+            return 404, result(False, "unknownService")
+        route = "/".join(parts[3:])
+        if route not in self.routes:
+            return 404, result(False, "notImplemented")
+        with self.state.lock:
+            if route not in self.open_routes and (data or {}).get("sessionId") not in self.state.sessions:
+                return 200, result(False, "invalidSessionId")
+            return 200, self.routes[route](data or {})
+
+    def register(self, data):
+        session_id = str(uuid.uuid4())
+        self.state.sessions[session_id] = data.get("name", "")
+        return {**result(), "sessionId": session_id, "privilegeLevel": "advanced"}
+
+    def get_is_registered(self, data):
+        return {**result(), "value": True, "privilegeLevel": "advanced"}
+
+    def deregister(self, data):
+        self.state.sessions.pop(data["sessionId"], None)
+        self.state.image_service_sessions.discard(data["sessionId"])
+        if self.state.control_session == data["sessionId"]:
+            self.state.control_session = None
+        return result()
+
+    def host_control_state(self, data):
+        has_control = self.state.control_session == data["sessionId"]
+        return {**result(), "value": {"hasControl": has_control,
+                                      "canRequestControl": self.state.control_session is None,
+                                      "canReleaseControl": has_control,
+                                      "cannotRequestControlReason": "" if self.state.control_session is None
+                                      else "otherClientInControl"}}
+
+    def request_control(self, data):
+        if self.state.control_session not in (None, data["sessionId"]):
+            return result(False, "otherClientInControl")
+        self.state.control_session = data["sessionId"]
+        return result()
+
+    def release_control(self, data):
+        if self.state.control_session != data["sessionId"]:
+            return result(False, "clientNotInControl")
+        self.state.control_session = None
+        return result()
+
+    def execution_state(self, data):
+        running = self.state.running_template is not None
+        return {**result(), "value": {"runningTemplate": self.state.template_state(self.state.running_template),
+                                      "canStart": not running and self.state.open_template is not None,
+                                      "canStop": running, "canPause": running and not self.state.paused,
+                                      "canContinue": running and self.state.paused,
+                                      "executionState": "scanning" if self.state.scanning() else "idle"}}
+
+    def start(self, data):
+        if self.state.template(data.get("id")) is None:
+            return result(False, "unknownTemplate")
+        self.state.running_template = data["id"]
+        self.state.paused = False
+        self.state.series_number += 1
+        return result()
+
+    def stop(self, data):
+        if self.state.running_template is None:
+            return result(False, "notRunning")
+        self.state.running_template = None
+        return result()
+
+    def set_paused(self, paused):
+        self.state.paused = paused
+        return result()
+
+    def modification_state(self, data):
+        return {**result(), "value": {"openTemplate": self.state.template_state(self.state.open_template),
+                                      "canOpen": self.state.open_template is None,
+                                      "canClose": self.state.open_template is not None}}
+
+    def open(self, data):
+        if self.state.template(data.get("id")) is None:
+            return result(False, "unknownTemplate")
+        self.state.open_template = data["id"]
+        return result()
+
+    def close(self, data):
+        self.state.open_template = None
+        return result()
+
+    def set_slice_position(self, data):
+        value = data.get("value", {})
+        self.state.slice_position = [float(value[axis]) if value.get(axis) is not None else current
+                                     for axis, current in zip("xyz", self.state.slice_position)]
+        return {**result(), "valueSet": vector(self.state.slice_position)}
+
+    def get_slice_orientation(self, data):
+        return {**result(), **{name: vector(values) for name, values in self.state.slice_orientation.items()}}
+
+    def set_slice_orientation(self, data):
+        for name in ("normal", "phase", "read"):
+            self.state.slice_orientation[name] = [float(data[name][axis]) for axis in "xyz"]
+        return {**result(), **{f"{name}Set": vector(values) for name, values in self.state.slice_orientation.items()}}
+
+    def set_value(self, attribute, data, convert):
+        setattr(self.state, attribute, convert(data["value"]))
+        return {**result(), "valueSet": getattr(self.state, attribute)}
+
+    def set_image_format(self, data):
+        if data.get("value") not in ("dicom", "raw16bit"):
+            return result(False, "invalidValue")
+        self.state.image_format = data["value"]
+        return result()
+
+    def connect_image_service(self, data):
+        self.state.image_service_sessions.add(data["sessionId"])
+        return result()
+
+
+def make_http_handler(requests_handler: AccessiRequests):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def reply(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                data = json.loads(self.rfile.read(length)) if length else None
+            except json.JSONDecodeError:
+                data = None
+            status, answer = requests_handler.handle(urlparse(self.path).path, data)
+            body = json.dumps(answer).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = reply
+        do_POST = reply
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def encode_frame(frame):
+    return frame.shape, base64.b64encode(np.ascontiguousarray(frame, dtype="<u2").tobytes()).decode()
+
+
+class FrameStreamer:
+    """
+    Sends the frames round robin to the connected websockets at fps, each interval jittered by a gaussian.
+    The base64 of in memory frames is encoded once up front, so the stand-in itself stays cheap.
+    Recorded sessions are encoded frame by frame from the memory map instead.
+    """
+
+    def __init__(self, state: StandInState, frames, fps=3.0, jitter=0.02, voxel_size=None):
+        self.state = state
+        self.fps = fps
+        self.jitter = jitter
+        self.source = frames
+        self.encoded = [encode_frame(frame) for frame in frames] if isinstance(frames, list) else None
+        self.voxel_size = voxel_size
+        self.clients = {}
+        self.sent = 0
+
+    async def handle_client(self, websocket):
+        session_id = parse_qs(urlparse(websocket.path).query).get("sessionId", [None])[0]
+        with self.state.lock:
+            known = session_id in self.state.sessions
+        if not known:
+            await websocket.close(code=1008, reason="invalidSessionId")
+            return
+        self.clients[websocket] = session_id
+        try:
+            await websocket.wait_closed()
+        finally:
+            self.clients.pop(websocket, None)
+
+    def message(self, index):
+        if self.encoded is not None:
+            (rows, columns), data = self.encoded[index % len(self.encoded)]
+        else:
+            # SessionReader gives the frame as (columns, rows), the recorded dimensions are sent as they were.
+            frame, metadata = self.source[index % len(self.source)]
+            _, data = encode_frame(frame)
+            rows, columns = metadata.rows, metadata.columns
+        with self.state.lock:
+            position = vector(self.state.slice_position)
+            orientation = {name: vector(values) for name, values in self.state.slice_orientation.items()}
+            voxel = self.voxel_size or self.state.field_of_view / columns
+            thickness = self.state.slice_thickness
+        image = {"format": "raw16bit", "data": data,
+                 "dimensions": {"columns": columns, "rows": rows,
+                                "voxelSize": {"column": voxel, "row": voxel, "slice": thickness}},
+                 "acquisition": {"time": datetime.now().strftime("%H%M%S.%f"), "number": index + 1},
+                 "coordinates": {"mrSliceDcs": {"position": position, **orientation}}}
+        return json.dumps({"service": "image", "request": "imageStream",
+                           "response": {**result(), "value": {"image": image}}})
+
+    def receivers(self):
+        with self.state.lock:
+            if not self.state.scanning() or self.state.image_format != "raw16bit":
+                return []
+            connected = self.state.image_service_sessions
+            return [websocket for websocket, session_id in self.clients.items()
+                    if session_id in connected or self.state.autostart]
+
+    async def run(self):
+        next_frame = time.perf_counter()
+        index = 0
+        while True:
+            next_frame += max(0.0, 1 / self.fps + random.gauss(0, self.jitter))
+            await asyncio.sleep(max(0.0, next_frame - time.perf_counter()))
+            receivers = self.receivers()
+            if not receivers:
+                continue
+            message = self.message(index)
+            index += 1
+            for websocket in receivers:
+                try:
+                    await websocket.send(message)
+                except websockets.ConnectionClosed:
+                    self.clients.pop(websocket, None)
+            self.sent += 1
+
+
+def self_signed_certificate():
+    """
+    :return: paths of a temporary self signed certificate and key (openssl has to be installed).
+    """
+    folder = tempfile.mkdtemp(prefix="accessi_stand_in_")
+    cert, key = os.path.join(folder, "cert.pem"), os.path.join(folder, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "30",
+                    "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+async def serve(arguments):
+    state = StandInState(autostart=arguments.autostart)
+    if arguments.session:
+        frames = SessionReader(arguments.session)
+        if len(frames) == 0:
+            raise SystemExit(f"No frames recorded in {arguments.session}")
+    elif arguments.frames:
+        frames = load_frames(arguments.frames)
+    else:
+        frames = synthetic_frames(arguments.size)
+    streamer = FrameStreamer(state, frames, fps=arguments.fps, jitter=arguments.jitter)
+
+    ssl_context = None
+    if not arguments.no_tls:
+        cert, key = (arguments.cert, arguments.key) if arguments.cert else self_signed_certificate()
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(cert, key)
+
+    http_server = ThreadingHTTPServer((arguments.host, arguments.port), make_http_handler(AccessiRequests(state)))
+    if ssl_context is not None:
+        http_server.socket = ssl_context.wrap_socket(http_server.socket, server_side=True)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+
+    async with websockets.serve(streamer.handle_client, arguments.host, arguments.websocket_port, ssl=ssl_context,
+                                max_size=None, compression=None):
+        scheme = "http" if ssl_context is None else "https"
+        print(f"Access-i stand-in: {scheme}://{arguments.host}:{arguments.port}, websocket port "
+              f"{arguments.websocket_port}, {len(frames)} frames at {arguments.fps} fps (jitter {arguments.jitter}s)")
+        await streamer.run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Access-i stand-in server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7787)
+    parser.add_argument("--websocket-port", type=int, default=7788)
+    parser.add_argument("--fps", type=float, default=3.0, help="frames per second while a template runs")
+    parser.add_argument("--jitter", type=float, default=0.02, help="standard deviation of the frame interval (s)")
+    parser.add_argument("--frames", help="folder with images to replay, synthetic frames if not given")
+    parser.add_argument("--session", help="session recorded by AccessiWebsocket (.mrisession) to replay")
+    parser.add_argument("--size", type=int, default=256, help="size of the synthetic frames")
+    parser.add_argument("--autostart", action="store_true", help="stream without starting a template")
+    parser.add_argument("--cert")
+    parser.add_argument("--key")
+    parser.add_argument("--no-tls", action="store_true")
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
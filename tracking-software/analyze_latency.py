@@ -0,0 +1,272 @@
+"""
+Reads back the latency logs of a session and joins them by image id (acquisition time).
+
+Usage: python analyze_latency.py latency_tests _0_default_256 [--bin 10] [--plot]
+Looks for WebSocket_Latency<suffix>, CNN_Latency<suffix>, Tracking_Latency<suffix> and 3DSuite_Latency<suffix>,
+either the old text logs or the binary .latlog files of LatencyLogger.
+
+Every logged latency is cumulative (acquisition -> stage), the per stage latency is the difference to the
+previous stage for the same image. A frame that is in one stage's log but not in the next one was dropped there.
+
+Parsed logs are cached in the user cache folder (or --cache-dir), a log is only parsed again when it changed.
+"""
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+import numpy as np
+
+sys.path.append("./modules")
+from modules.LatencyLogger import read_latency_log, LOG_EXTENSION
+
+STAGE_LOGS = (("websocket", "WebSocket_Latency"), ("cnn", "CNN_Latency"),
+              ("tracking", "Tracking_Latency"), ("3d_suite", "3DSuite_Latency"))
+PERCENTILES = (50, 90, 95, 99)
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def default_cache_folder():
+    """
+    :return: %LOCALAPPDATA%/tracking-software/latency on Windows, ~/.cache/tracking-software/latency elsewhere.
+    """
+    base = os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "tracking-software", "latency")
+
+
+def hhmmss_to_seconds(values):
+    """
+    :param values: float array of HHMMSS.fff times.
+    :return: seconds since midnight.
+    """
+    hours, rest = np.divmod(values, 10000)
+    minutes, seconds = np.divmod(rest, 100)
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def parse_text_chunk(chunk):
+    """
+    Lines look like: 100420.645 | 100424.075113 | 2024-04-15 10:04:24.075113 | 3.430113
+    :return: image id (ms since midnight), logged (s since midnight), latency (s)
+    """
+    tokens = np.array(chunk.replace(b"|", b" ").split())
+    if tokens.size % 5 == 0 and chunk.count(b"|") == 3 * (tokens.size // 5):
+        tokens = tokens.reshape(-1, 5)
+        values = np.stack([tokens[:, 0], tokens[:, 1], tokens[:, 4]], axis=1).astype(np.float64)
+    else:
+        # Lines that are not log lines (e.g. logs pasted into a spreadsheet and back), slow path.
+        values = np.array([fields for fields in (parse_text_line(line) for line in chunk.split(b"\n"))
+                           if fields is not None], dtype=np.float64).reshape(-1, 3)
+    image_id = np.round(hhmmss_to_seconds(values[:, 0]) * 1000).astype(np.int64)
+    return image_id, hhmmss_to_seconds(values[:, 1]), values[:, 2]
+
+
+def parse_text_line(line):
+    """
+    :return: image id, logged (both HHMMSS.fff) and latency of one log line, None if it is not a log line.
+    """
+    fields = line.split(b"|")
+    if len(fields) != 4:
+        return None
+    try:
+        return float(fields[0]), float(fields[1]), float(fields[3])
+    except ValueError:
+        return None
+
+
+def parse_text_log(path):
+    """
+    Streams the file in chunks (cut at line ends), so multi GB logs are never fully in memory as text.
+    """
+    parts = []
+    with open(path, "rb") as file:
+        remainder = b""
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunk = remainder + chunk
+            cut = chunk.rfind(b"\n") + 1
+            remainder = chunk[cut:]
+            if cut:
+                parts.append(parse_text_chunk(chunk[:cut]))
+        if remainder.strip():
+            parts.append(parse_text_chunk(remainder))
+    if not parts:
+        return np.empty(0, np.int64), np.empty(0), np.empty(0)
+    return tuple(np.concatenate(column) for column in zip(*parts))
+
+
+def parse_binary_log(path):
+    records = read_latency_log(path)
+    image_id = np.empty(len(records), np.int64)
+    logged = np.empty(len(records))
+    latency = np.empty(len(records))
+    for start in range(0, len(records), CHUNK_SIZE // records.dtype.itemsize):
+        chunk = records[start:start + CHUNK_SIZE // records.dtype.itemsize]
+        end = start + len(chunk)
+        image_id[start:end] = np.round(chunk["acquisition"] * 1000)
+        # time.time() -> local seconds since midnight, same reference as the text logs.
+        logged[start:end] = (chunk["logged"] + time.localtime(chunk["logged"][0]).tm_gmtoff) % 86400
+        latency[start:end] = chunk["latency"]
+    return image_id, logged, latency
+
+
+def load_log(path, cache_folder=None):
+    """
+    :param cache_folder: None for default_cache_folder()
+    :return: image id, logged, latency of a log, from the cache if the log did not change since.
+    """
+    stat = os.stat(path)
+    cache_folder = cache_folder or default_cache_folder()
+    # Logs of different sessions share names, the folder they are in tells them apart.
+    folder_hash = hashlib.sha1(os.path.abspath(os.path.dirname(path)).encode()).hexdigest()[:12]
+    cache_path = os.path.join(cache_folder, f"{os.path.basename(path)}.{folder_hash}.npz")
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            if cache["size"] == stat.st_size and cache["mtime"] == stat.st_mtime_ns:
+                return cache["image_id"], cache["logged"], cache["latency"]
+    if path.endswith(LOG_EXTENSION):
+        image_id, logged, latency = parse_binary_log(path)
+    else:
+        image_id, logged, latency = parse_text_log(path)
+    os.makedirs(cache_folder, exist_ok=True)
+    np.savez(cache_path, image_id=image_id, logged=logged, latency=latency,
+             size=stat.st_size, mtime=stat.st_mtime_ns)
+    return image_id, logged, latency
+
+
+def find_session_logs(folder, suffix=""):
+    """
+    :return: [(stage, path)] in pipeline order, for the stages that have a log. Binary logs win over text logs.
+    """
+    logs = []
+    for stage, name in STAGE_LOGS:
+        for path in (os.path.join(folder, name + suffix + LOG_EXTENSION), os.path.join(folder, name + suffix)):
+            if os.path.exists(path):
+                logs.append((stage, path))
+                break
+    return logs
+
+
+class SessionLatency:
+    """
+    Latency logs of all stages joined on image id. Rows are the images of the first stage,
+    columns the stages, nan where a stage did not log the image.
+    """
+
+    def __init__(self, logs, cache_folder=None):
+        """
+        :param logs: [(stage, path)], first one is the reference (usually the websocket).
+        :param cache_folder: see load_log
+        """
+        self.stages = [stage for stage, _ in logs]
+        loaded = [self.first_per_image(*load_log(path, cache_folder)) for _, path in logs]
+        self.image_id = loaded[0][0]
+        self.cumulative = np.full((len(self.image_id), len(logs)), np.nan)
+        self.logged = np.full((len(self.image_id), len(logs)), np.nan)
+        for column, (image_id, logged, latency) in enumerate(loaded):
+            _, rows, found = np.intersect1d(self.image_id, image_id, assume_unique=True, return_indices=True)
+            self.cumulative[rows, column] = latency[found]
+            self.logged[rows, column] = logged[found]
+        # Difference to the previous stage that logged the image.
+        self.per_stage = np.full_like(self.cumulative, np.nan)
+        previous = np.zeros(len(self.image_id))
+        for column in range(len(logs)):
+            self.per_stage[:, column] = self.cumulative[:, column] - previous
+            previous = np.where(np.isnan(self.cumulative[:, column]), previous, self.cumulative[:, column])
+
+    @staticmethod
+    def first_per_image(image_id, logged, latency):
+        """
+        A stage can log the same image twice (e.g. the websocket resent it), only the first counts.
+        """
+        image_id, first = np.unique(image_id, return_index=True)
+        return image_id, logged[first], latency[first]
+
+    def distribution(self, values):
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return {"count": 0}
+        result = {"count": values.size, "mean": values.mean(), "max": values.max()}
+        result.update({f"p{percentile}": value for percentile, value in
+                       zip(PERCENTILES, np.percentile(values, PERCENTILES))})
+        return result
+
+    def per_stage_distributions(self):
+        return {stage: self.distribution(self.per_stage[:, column]) for column, stage in enumerate(self.stages)}
+
+    def cumulative_distributions(self):
+        return {stage: self.distribution(self.cumulative[:, column]) for column, stage in enumerate(self.stages)}
+
+    def dropped_frames(self):
+        """
+        :return: {stage: images the previous stage logged but this one did not}
+        """
+        present = ~np.isnan(self.cumulative)
+        return {stage: int(np.count_nonzero(present[:, column - 1] & ~present[:, column]))
+                for column, stage in enumerate(self.stages) if column > 0}
+
+    def throughput(self, bin_seconds=10):
+        """
+        :return: bin start times (s since midnight) and frames per second per stage, shape (bins, stages).
+        """
+        logged = self.logged[~np.isnan(self.logged)]
+        if logged.size == 0:
+            return np.empty(0), np.empty((0, len(self.stages)))
+        edges = np.arange(np.floor(logged.min()), logged.max() + bin_seconds, bin_seconds)
+        counts = np.stack([np.histogram(self.logged[:, column][~np.isnan(self.logged[:, column])], edges)[0]
+                           for column in range(len(self.stages))], axis=1)
+        return edges[:-1], counts / bin_seconds
+
+    def report(self, bin_seconds=10):
+        lines = [f"{len(self.image_id)} images, stages: {', '.join(self.stages)}"]
+        for title, distributions in (("Per stage latency (s)", self.per_stage_distributions()),
+                                     ("Cumulative latency (s)", self.cumulative_distributions())):
+            lines.append(title)
+            for stage, values in distributions.items():
+                lines.append(f"  {stage:<10} " + " ".join(f"{key} {value:.3f}" if key != "count" else
+                                                          f"n {value}" for key, value in values.items()))
+        lines.append("Dropped frames")
+        for stage, dropped in self.dropped_frames().items():
+            lines.append(f"  {stage:<10} {dropped}")
+        start, fps = self.throughput(bin_seconds)
+        if len(start):
+            lines.append(f"Throughput (fps, {bin_seconds}s bins): " + " ".join(
+                f"{stage} {fps[:, column].mean():.2f} avg / {fps[:, column].min():.2f} min"
+                for column, stage in enumerate(self.stages)))
+        return "\n".join(lines)
+
+    def plot(self, bin_seconds=10):
+        import matplotlib.pyplot as plt
+        figure, (latency_axis, throughput_axis) = plt.subplots(2, 1, figsize=(10, 8))
+        latency_axis.boxplot([self.per_stage[:, column][~np.isnan(self.per_stage[:, column])]
+                              for column in range(len(self.stages))], labels=self.stages)
+        latency_axis.set_ylabel('Latency (s)')
+        latency_axis.set_title('Per stage latency')
+        start, fps = self.throughput(bin_seconds)
+        for column, stage in enumerate(self.stages):
+            throughput_axis.plot(start, fps[:, column], label=stage)
+        throughput_axis.set_xlabel('Time (s since midnight)')
+        throughput_axis.set_ylabel('Frames per second')
+        throughput_axis.legend()
+        throughput_axis.grid(True)
+        plt.show()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency breakdown of a recorded session.")
+    parser.add_argument("folder", help="folder with the latency logs")
+    parser.add_argument("suffix", nargs="?", default="", help="session suffix, e.g. _0_default_256")
+    parser.add_argument("--bin", type=float, default=10, help="throughput bin size in seconds")
+    parser.add_argument("--plot", action="store_true")
+    parser.add_argument("--cache-dir", default=None, help="where parsed logs are cached, default: user cache folder")
+    arguments = parser.parse_args()
+    session_logs = find_session_logs(arguments.folder, arguments.suffix)
+    if not session_logs:
+        sys.exit(f"No latency logs found in {arguments.folder} for '{arguments.suffix}'")
+    session = SessionLatency(session_logs, arguments.cache_dir)
+    print(session.report(arguments.bin))
+    if arguments.plot:
+        session.plot(arguments.bin)
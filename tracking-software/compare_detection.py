@@ -0,0 +1,111 @@
+"""
+Compares coarse to fine detection (CNNModel detection="coarse_to_fine") with the full frame pass.
+
+Usage: python compare_detection.py MODEL_512_V3 [--datasets ../susceptibility-simulation/test-images
+       ../susceptibility-simulation/generated_dataset/images] [--coarse-scale 2] [--window 128]
+
+For every dataset: inference latency of both paths (median and 95th percentile) and the centroid detection F1
+(GuidewireTracking.find_artifact_centroids, matched within --distance pixels). The reference is the ground truth
+mask where there is one (generated_dataset/masks of SusceptibilitySimulation.ipynb, <name>.png for <name>_0000.png),
+otherwise the full frame pass, whose F1 is then 1 by definition.
+"""
+
+import os
+import sys
+import time
+import argparse
+import cv2
+import numpy as np
+
+sys.path.append("./modules")
+from modules.CNNModel import CNNModel
+from modules.CoarseToFine import CoarseToFineDetector
+from modules.GuidewireTracking import GuidewireTracking
+from export_model import load_images
+from quantize_model import match_centroids
+
+MASK_FOLDER = "masks"
+
+
+def mask_centroids(folder, name):
+    """
+    :return: centroids of the ground truth mask of an image, None if it has none.
+    """
+    path = os.path.join(folder, name.replace("_0000.", "."))
+    if not os.path.exists(path):
+        return None
+    mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    count, _, _, centroids = cv2.connectedComponentsWithStats((mask > 0).astype(np.uint8), connectivity=8)
+    return [(int(x), int(y)) for x, y in centroids[1:count]]
+
+
+def timed(predict, image):
+    start = time.perf_counter()
+    labels = predict(image)
+    return labels, time.perf_counter() - start
+
+
+def centroids_of(cnn, labels, shape):
+    return GuidewireTracking.find_artifact_centroids(cnn.plans.postprocess(labels * 255, shape))[0]
+
+
+def compare(cnn, detector, images, mask_folder, distance):
+    """
+    :return: {path: (latencies, matched, reference count, found count)} and the number of images with a mask.
+    """
+    results = {"full": ([], 0, 0, 0), "coarse_to_fine": ([], 0, 0, 0)}
+    masked = 0
+    for name, image in images.items():
+        full_labels, full_time = timed(lambda frame: cnn.engine.predict([frame])[0], image)
+        fine_labels, fine_time = timed(detector.predict, image)
+        full = centroids_of(cnn, full_labels, image.shape)
+        reference = mask_centroids(mask_folder, name) if mask_folder else None
+        if reference is None:
+            reference = full
+        else:
+            masked += 1
+        for path, labels, seconds in (("full", full_labels, full_time), ("coarse_to_fine", fine_labels, fine_time)):
+            found = full if path == "full" else centroids_of(cnn, labels, image.shape)
+            latencies, matched, reference_count, found_count = results[path]
+            latencies.append(seconds)
+            results[path] = (latencies, matched + match_centroids(reference, found, distance),
+                             reference_count + len(reference), found_count + len(found))
+    return results, masked
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accuracy and latency of coarse to fine against full frame detection.")
+    parser.add_argument("model", nargs="?", default="MODEL_512_V3", help="folder in ../MODELS")
+    parser.add_argument("--datasets", nargs="+", default=["../susceptibility-simulation/test-images",
+                                                          "../susceptibility-simulation/generated_dataset/images"])
+    parser.add_argument("--inference", default="direct", choices=["direct", "torchscript", "onnx"])
+    parser.add_argument("--coarse-scale", type=int, default=2)
+    parser.add_argument("--window", type=int, default=128, help="side of the full resolution windows")
+    parser.add_argument("--distance", type=float, default=5, help="pixels between matching centroids")
+    parser.add_argument("--limit", type=int, default=None, help="images per dataset")
+    parser.add_argument("--threads", type=int, default=None)
+    arguments = parser.parse_args()
+
+    cnn = CNNModel(control=None, cnn_model=arguments.model, inference=arguments.inference, threads=arguments.threads)
+    cnn.prepare_engine("cpu")
+    detector = CoarseToFineDetector(cnn.engine, arguments.coarse_scale, arguments.window)
+    for dataset in arguments.datasets:
+        if not os.path.isdir(dataset):
+            print(f"{dataset}: not found, skipped")
+            continue
+        images = dict(list(load_images(dataset).items())[:arguments.limit])
+        if not images:
+            continue
+        # One pass each first, the first inference includes allocation and graph optimization.
+        first = next(iter(images.values()))
+        cnn.engine.predict([first])
+        detector.predict(first)
+        masks = os.path.join(os.path.dirname(os.path.normpath(dataset)), MASK_FOLDER)
+        results, masked = compare(cnn, detector, images, masks if os.path.isdir(masks) else None,
+                                  arguments.distance)
+        reference = f"ground truth masks ({masked} images)" if masked else "full frame pass"
+        print(f"{dataset}: {len(images)} images, F1 against {reference}")
+        for path, (latencies, matched, reference_count, found_count) in results.items():
+            f1 = 2 * matched / (reference_count + found_count) if reference_count + found_count else 1.0
+            print(f"  {path:<15} F1 {f1:.4f}  latency median {np.median(latencies) * 1000:.1f} ms"
+                  f"  p95 {np.percentile(latencies, 95) * 1000:.1f} ms")
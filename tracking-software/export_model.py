@@ -0,0 +1,135 @@
+"""
+Exports the nnU-Net segmentation model to CPU optimized formats for CNNModel (inference="torchscript" / "onnx")
+and checks that they give the same segmentation as the PyTorch network.
+
+Usage: python export_model.py MODEL_512_V3 [--formats torchscript onnx] [--images ../susceptibility-simulation/test-images]
+
+Writes ../MODELS/<model>/exported/fold_<fold>.torchscript.pt and .onnx (InferenceEngine.exported_model_paths).
+TorchScript is traced, frozen and optimized for inference (conv + batchnorm folded, ops fused).
+ONNX is graph optimized by onnxruntime when it is loaded. Needs the onnx package to export and onnxruntime to check.
+"""
+
+import os
+import sys
+import copy
+import argparse
+import cv2
+import numpy as np
+
+sys.path.append("./modules")
+from modules.CNNModel import CNNModel
+from modules.InferenceEngine import TorchScriptInference, OnnxInference, exported_model_paths
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def load_images(folder):
+    return {name: cv2.imread(os.path.join(folder, name), cv2.IMREAD_GRAYSCALE)
+            for name in sorted(os.listdir(folder)) if name.lower().endswith(IMAGE_EXTENSIONS)}
+
+
+def wrap_network(torch, network, dtype=None):
+    """
+    Deep supervision returns a list, exported graphs only give the full resolution logits.
+    :param dtype: run the network in this dtype (e.g. torch.bfloat16), input and logits stay float32.
+    """
+
+    class FullResolutionOutput(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            # A copy, .to() would change the dtype of the caller's network too.
+            self.network = network if dtype is None else copy.deepcopy(network).to(dtype)
+
+        def forward(self, image):
+            output = self.network(image if dtype is None else image.to(dtype))
+            output = output[0] if isinstance(output, (list, tuple)) else output
+            return output if dtype is None else output.float()
+
+    return FullResolutionOutput().eval()
+
+
+def export_torchscript(torch, network, example, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with torch.inference_mode():
+        traced = torch.jit.trace(network, example)
+        torch.jit.save(torch.jit.optimize_for_inference(torch.jit.freeze(traced)), path)
+    print(f"Exported {path}")
+
+
+def export_onnx(torch, network, example, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with torch.inference_mode():
+        torch.onnx.export(network, example, path, input_names=["image"], output_names=["logits"],
+                          # Rows and columns too, RegionOfInterest runs the network on windows of the frame.
+                          dynamic_axes={"image": {0: "batch", 2: "rows", 3: "columns"},
+                                        "logits": {0: "batch", 2: "rows", 3: "columns"}},
+                          opset_version=17, do_constant_folding=True)
+    print(f"Exported {path}")
+
+
+def export(torch, engine, paths, formats):
+    """
+    :param engine: TorchInference with the network of every fold.
+    :param paths: {format: [path per fold]}
+    """
+    example = torch.zeros((1, 1) + engine.plans.patch_size)
+    for index, network in enumerate(engine.networks):
+        network = wrap_network(torch, network)
+        for export_format in formats:
+            if export_format == "torchscript":
+                export_torchscript(torch, network, example, paths[export_format][index])
+            else:
+                export_onnx(torch, network, example, paths[export_format][index])
+
+
+def parity(reference, engine, images):
+    """
+    :return: largest logit difference and fraction of pixels with a different label, over all images.
+    """
+    logit_difference = 0.0
+    differing = 0
+    total = 0
+    for image in images.values():
+        count = reference.fill_batch([image])
+        expected = reference.logits(count).float().cpu().numpy()
+        engine.fill_batch([image])
+        logits = np.asarray(engine.logits(count))
+        logit_difference = max(logit_difference, float(np.abs(logits - expected).max()))
+        differing += np.count_nonzero(logits.argmax(1) != expected.argmax(1))
+        total += expected[:, 0].size
+    return logit_difference, differing / max(total, 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the CNN to TorchScript / ONNX and check parity.")
+    parser.add_argument("model", nargs="?", default="MODEL_512_V3", help="folder in ../MODELS")
+    parser.add_argument("--formats", nargs="+", default=["torchscript", "onnx"], choices=["torchscript", "onnx"])
+    parser.add_argument("--images", default="../susceptibility-simulation/test-images",
+                        help="images for the parity check")
+    parser.add_argument("--threads", type=int, default=None, help="inference threads for the check")
+    parser.add_argument("--tolerance", type=float, default=0.001,
+                        help="largest allowed fraction of pixels with a different label")
+    parser.add_argument("--check-only", action="store_true", help="only check already exported files")
+    arguments = parser.parse_args()
+
+    import torch
+    cnn = CNNModel(control=None, cnn_model=arguments.model, inference="direct", threads=arguments.threads)
+    cnn.prepare_engine("cpu")
+    export_paths = {export_format: exported_model_paths(cnn.path_to_model_directory, cnn.folds, export_format)
+                    for export_format in arguments.formats}
+    if not arguments.check_only:
+        export(torch, cnn.engine, export_paths, arguments.formats)
+
+    test_images = load_images(arguments.images)
+    failed = False
+    for export_format in arguments.formats:
+        if export_format == "torchscript":
+            exported = TorchScriptInference(torch, export_paths[export_format], cnn.plans, threads=arguments.threads)
+        else:
+            exported = OnnxInference(export_paths[export_format], cnn.plans, threads=arguments.threads)
+        difference, mismatch = parity(cnn.engine, exported, test_images)
+        passed = mismatch <= arguments.tolerance
+        failed |= not passed
+        print(f"{export_format:<12} {len(test_images)} images, max logit difference {difference:.2e}, "
+              f"labels differ in {mismatch * 100:.4f}% of pixels: {'ok' if passed else 'FAILED'}")
+    sys.exit(1 if failed else 0)
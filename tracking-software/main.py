@@ -7,37 +7,39 @@ This program consists of multiple modules:
     using my own library (pip install accessi). It should be used as kind-of singleton.
 
 - Access-i Websocket: Used only to receive images from MRI, uses accessi library.
-    This function is ran as a separate thread and images from MRI are sent to ZMQ port.
+    This function is ran as a separate process and images from MRI are sent to ZMQ port.
 
 - CNN Model: Responsible for running inference on images received from ZMQ (websocket).
-    This function is ran as a separate thread and output prediction is sent to ZMQ port.
+    This function is ran as a separate process and output prediction is sent to ZMQ port.
 
 - Guidewire Tracking: Responsible for running tracking Guidewire which is detected using the CNN.
-    This function is ran as a separate thread and output is sent to ZMQ port.
+    This function is ran as a separate process and output is sent to ZMQ port.
     This function also sends guidewire location data to ScanSuite, over ZMQ.
 
 - Collision Detection: Responsible for creating a haptic feedback loop to CathBot Master device.
     This function is ran as a separate thread, the output is sent to a CAN bus using USB-CAN adapter.
 
+The websocket, CNN and tracking processes are started and watched by PipelineSupervisor.
+
 Some helper classes have been made, e.g. VideoViewer, ImageData and ArtifactTracker.
 
 ScanSuite is a standalone program, which can also be launched through the main UI.
 
 """
 
+import os
 import sys
 
 sys.path.append("./modules")
 sys.path.append("./cathbot_canbus_interface")
 import multiprocessing
 from typing import Literal
+from datetime import datetime
 from threading import Thread
 from main_ui import Ui_MainWindow
 import modules.accessi_local as Access
 from PySide6.QtWidgets import QApplication, QMainWindow, QFileDialog, QTableWidgetItem
-from modules.AccessiWebsocket import AccessiWebsocket
-from modules.CNNModel import CNNModel
-from modules.GuidewireTracking import GuidewireTracking
+from modules.PipelineSupervisor import PipelineSupervisor, access_config_snapshot
 from modules.VideoViewer import VideoViewer
 from modules.AccessiClient import AccessiClient
 
@@ -69,6 +71,47 @@ VERSION_DEFAULT = "v2"
 CLIENT_NAME_DEFAULT = "Martin Reinok Python Client"
 OUTPUT_DIRECTORY_DEFAULT = "C:\\Users\\s2981416\\Desktop\\MRI_LOG\\13.05.2024 non-clinical tests"
 CNN_MODEL_DEFAULT = "MODEL_512_V3"
+# "direct": the network runs without nnUNetPredictor's pipeline, "predictor": through it (reference for accuracy),
+# "torchscript" / "onnx": CPU optimized export (python export_model.py first).
+CNN_INFERENCE = "direct"
+# Inference threads of the CNN stage, None uses the cores it is pinned to.
+CNN_THREADS = None
+# "int8" / "bf16" reduced precision model (python quantize_model.py first), None for float32.
+# It is only loaded if its centroid detection F1 against float32 is at least CNN_VARIANT_MIN_ACCURACY.
+CNN_VARIANT = None
+CNN_VARIANT_MIN_ACCURACY = 0.98
+# Frames that queue up while the CNN runs are inferred together, up to this many (1 = one frame at a time).
+# The batch size adapts so that one batch stays under CNN_BATCH_LATENCY_TARGET seconds.
+CNN_MAX_BATCH_SIZE = 1
+CNN_BATCH_LATENCY_TARGET = 0.15
+# More than 1: that many inference processes, each with the model and its share of the CNN cores.
+# Results are published in acquisition order, a frame is dropped when a newer one finished first
+# (unless it finishes within CNN_REORDER_WAIT seconds).
+CNN_WORKERS = 1
+CNN_REORDER_WAIT = 0.0
+# Test time augmentation: "off", "full" or a tuple of mirror axes (0 rows, 1 columns), each axis doubles the inference.
+# With a latency target (seconds) it is reduced while inference is slower and restored when there is room again.
+CNN_TTA = "full"
+CNN_TTA_LATENCY_TARGET = 0.15
+# Infer only CNN_ROI_WINDOW pixel windows around the tracked markers (multiple of 128 for MODEL_512_V3),
+# the whole frame every CNN_ROI_FULL_FRAME_INTERVAL frames and when a track is lost. Needs the tracking stage.
+CNN_ROI = False
+CNN_ROI_WINDOW = 128
+CNN_ROI_FULL_FRAME_INTERVAL = 10
+# "coarse_to_fine": whole frames are first inferred CNN_COARSE_SCALE times smaller, then at full resolution
+# only in CNN_ROI_WINDOW windows around what was found. "full": the whole frame at full resolution.
+# python compare_detection.py compares the two.
+CNN_DETECTION = "full"
+CNN_COARSE_SCALE = 2
+# Images between websocket, CNN and tracking go through shared memory, ZMQ only carries notifications.
+SHARED_MEMORY_TRANSPORT = True
+# Record the raw imageStream to <output directory>/Sessions (SessionRecorder), e.g. for replay with accessi_stand_in.py.
+RECORD_SESSION = False
+# Websocket, CNN and tracking run as processes pinned to their own cores. False runs them as threads (debugging).
+PROCESS_STAGES = True
+# All Access-i requests of this machine (main window, stages, 3D Suite) share one session through AccessiGateway
+# on this port. None talks to the host directly from every process.
+ACCESS_GATEWAY_PORT = 7790
 
 
 class MyMainWindow(QMainWindow):
@@ -89,22 +132,16 @@ class MyMainWindow(QMainWindow):
         self.ui.field_client_name.setText(CLIENT_NAME_DEFAULT)
         self.ui.field_output_directory.setText(OUTPUT_DIRECTORY_DEFAULT)
 
-        """
-        Threads
-        """
-        self.websocket_thread = None
-        self.tracking_thread = None
-        self.cnn_thread = None
-
         """
         Modules
         """
         self.access_client: AccessiClient = AccessiClient(self.ui)
-        self.accessi_websocket: AccessiWebsocket = AccessiWebsocket(access_instance=self.access_client.Access,
-                                                                    window=self)
-        self.cnn: CNNModel = CNNModel(window=self, subscribe_port=None, cnn_model=None)
-        self.tracking: GuidewireTracking = GuidewireTracking(window=self, subscribe_port=None)
-        self.accessi_websocket.status_websocket_signal.connect(self.update_websocket_status)
+        self.supervisor = PipelineSupervisor(use_processes=PROCESS_STAGES)
+        self.supervisor.stage_status_signal.connect(self.update_stage_status)
+        if ACCESS_GATEWAY_PORT is not None:
+            self.access_client.Access.config.gateway_port = ACCESS_GATEWAY_PORT
+            self.supervisor.start_stage("gateway", access_config_snapshot(self.access_client.Access),
+                                        port=ACCESS_GATEWAY_PORT)
 
         """
         Buttons
@@ -133,26 +170,20 @@ class MyMainWindow(QMainWindow):
         self.ui.check_tracking_output.stateChanged.connect(self.show_tracking_output)
         self.ui.check_guidewire_tracking_active.stateChanged.connect(self.set_tracking_active)
         self.ui.check_tracking_move_slice.stateChanged.connect(self.set_tracking_move_slice)
+        self.ui.check_save_latency_data.stateChanged.connect(self.set_save_latency)
         self.ui.combo_accessi_image_format.currentTextChanged.connect(self.set_image_format)
+        self.set_save_latency()
+        self.set_tracking_move_slice()
+        self.supervisor.set_flag("raw16bit", self.ui.combo_accessi_image_format.currentText() == "raw16bit")
 
         """
         Combo
         """
-        for method in [method for method in dir(Access.ParameterStandard) if
-                       callable(getattr(Access.ParameterStandard, method)) and method.startswith("get_")]:
-            self.ui.combo_get_parameter_choice.addItem(method)
-
-        for method in [method for method in dir(Access.ParameterStandard) if
-                       callable(getattr(Access.ParameterStandard, method)) and method.startswith("set_")]:
-            self.ui.combo_set_parameter_choice.addItem(method)
-
-        for method in [method for method in dir(Access.Table) if
-                       callable(getattr(Access.Table, method)) and method.startswith("get_")]:
-            self.ui.combo_get_parameter_choice.addItem(method)
-
-        for method in [method for method in dir(Access.Table) if
-                       callable(getattr(Access.Table, method)) and method.startswith("set_")]:
-            self.ui.combo_set_parameter_choice.addItem(method)
+        for name, descriptor in Access.parameter_registry.items():
+            if descriptor.kind == "get":
+                self.ui.combo_get_parameter_choice.addItem(name)
+            else:
+                self.ui.combo_set_parameter_choice.addItem(name)
 
         # for method in [method for method in dir(Access.ParameterConfigured) if
         #                callable(getattr(Access.ParameterConfigured, method)) and method.startswith("get_")]:
@@ -164,49 +195,88 @@ class MyMainWindow(QMainWindow):
 
     def set_websocket_active(self):
         if self.ui.check_websocket_active.isChecked():
-            if self.websocket_thread is None:
-                self.websocket_thread = Thread(target=self.accessi_websocket.run_websocket_thread, daemon=True)
-                self.websocket_thread.start()
-            for checkbox in [self.ui.check_websocket_output, self.ui.check_websocket_save, self.ui.check_cnn_active]:
-                checkbox.setEnabled(True)
-                checkbox.stateChanged.emit(checkbox.isChecked())
+            self.supervisor.start_stage("websocket", access_config_snapshot(self.access_client.Access),
+                                        shared_memory=SHARED_MEMORY_TRANSPORT, record_path=self.session_path())
+            # Output checkboxes are enabled when the websocket reports "ready" (port is bound).
             self.ui.check_websocket_active.setEnabled(False)
         else:
-            self.websocket_thread = None
+            self.supervisor.stop_stage("websocket")
 
     def set_cnn_active(self):
         if self.ui.check_cnn_active.isChecked():
-            self.cnn = CNNModel(window=self, subscribe_port=self.accessi_websocket.PUBLISH_PORT,
-                                cnn_model=CNN_MODEL_DEFAULT)
-            self.cnn.status_cnn_signal.connect(self.update_cnn_status)
-            self.cnn_thread = Thread(target=self.cnn.start, daemon=True, args=[DEVICE])
-            self.cnn_thread.start()
-            # Checkboxes are toggled in the thread due to long imports.
+            access_config = access_config_snapshot(self.access_client.Access)
+            cnn_settings = dict(cnn_model=CNN_MODEL_DEFAULT, shared_memory=SHARED_MEMORY_TRANSPORT, device=DEVICE,
+                                inference=CNN_INFERENCE, threads=CNN_THREADS, variant=CNN_VARIANT,
+                                min_variant_accuracy=CNN_VARIANT_MIN_ACCURACY, tta=CNN_TTA,
+                                tta_latency_target=CNN_TTA_LATENCY_TARGET, roi=CNN_ROI, roi_window=CNN_ROI_WINDOW,
+                                roi_full_frame_interval=CNN_ROI_FULL_FRAME_INTERVAL, detection=CNN_DETECTION,
+                                coarse_scale=CNN_COARSE_SCALE)
+            self.supervisor.start_stage("cnn", access_config, max_batch_size=CNN_MAX_BATCH_SIZE,
+                                        batch_latency_target=CNN_BATCH_LATENCY_TARGET, workers=CNN_WORKERS,
+                                        reorder_wait=CNN_REORDER_WAIT, **cnn_settings)
+            if CNN_WORKERS > 1:
+                self.supervisor.start_workers("cnn", CNN_WORKERS, access_config, **cnn_settings)
+            # Checkboxes are enabled when the CNN reports "ready", imports and model loading take long.
         else:
-            self.cnn_thread = None
+            self.supervisor.stop_stage("cnn")
 
     def set_tracking_active(self):
         if self.ui.check_guidewire_tracking_active.isChecked():
-            self.tracking = GuidewireTracking(window=self, subscribe_port=self.cnn.PUBLISH_PORT)
-            self.tracking.status_guidewire_tracking_signal.connect(self.update_guidewire_tracking_status)
-            self.tracking.status_move_slice_signal.connect(self.update_move_mri_slice_status)
-            self.tracking_thread = Thread(target=self.tracking.start, daemon=True)
-            self.tracking_thread.start()
-            for checkbox in [self.ui.check_tracking_output]:
-                checkbox.setEnabled(True)
-                checkbox.stateChanged.emit(checkbox.isChecked())
+            self.supervisor.start_stage("tracking", access_config_snapshot(self.access_client.Access),
+                                        shared_memory=SHARED_MEMORY_TRANSPORT)
         else:
-            self.tracking_thread = None
+            self.supervisor.stop_stage("tracking")
+
+    def session_path(self):
+        if not RECORD_SESSION:
+            return None
+        folder = os.path.join(self.ui.field_output_directory.text(), "Sessions")
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, datetime.now().strftime("session_%Y%m%d_%H%M%S"))
+
+    def update_stage_status(self, stage, kind, text):
+        """
+        Status messages of the stage processes, forwarded by PipelineSupervisor.
+        """
+        if kind == "ready":
+            self.enable_stage_outputs(stage)
+        elif kind == "status" and stage == "websocket":
+            self.update_websocket_status(text)
+        elif kind == "status" and (stage == "cnn" or stage.startswith("cnn_worker")):
+            self.update_cnn_status(text)
+        elif kind == "status" and stage == "tracking":
+            self.update_guidewire_tracking_status(text)
+        elif kind == "move_slice":
+            self.update_move_mri_slice_status(text)
+        elif kind in ("health", "error", "latency"):
+            self.ui.statusbar.showMessage(f"{stage}: {text}")
+
+    def enable_stage_outputs(self, stage):
+        if stage == "websocket":
+            checkboxes = [self.ui.check_websocket_output, self.ui.check_websocket_save, self.ui.check_cnn_active]
+        elif stage == "cnn":
+            checkboxes = [self.ui.check_cnn_output, self.ui.check_cnn_save, self.ui.check_guidewire_tracking_active,
+                          self.ui.check_tracking_move_slice, self.ui.check_collision_detection_active,
+                          self.ui.check_cathbot_collision_feedback, self.ui.check_collision_save,
+                          self.ui.check_tracking_save]
+        elif stage == "tracking":
+            checkboxes = [self.ui.check_tracking_output]
+        else:
+            return
+        for checkbox in checkboxes:
+            checkbox.setEnabled(True)
+            checkbox.stateChanged.emit(checkbox.isChecked())
 
     def open_scan_suite(self):
         # For updates during runtime, I import it again.
         from scan_suite import ScanSuiteWindow
         self.scan_suite = multiprocessing.Process(target=ScanSuiteWindow.start,
-                                                  args=(str(self.tracking.RAW_COORDINATE_PUBLISH_PORT),
+                                                  args=(str(self.supervisor.port("tracking_raw_coordinate")),
                                                         str(self.ui.field_ip_address.text()),
                                                         str(self.ui.field_version.text()),
                                                         self.ui.check_collision_detection_active.isChecked(),
-                                                        self.ui.check_cathbot_collision_feedback.isChecked()))
+                                                        self.ui.check_cathbot_collision_feedback.isChecked(),
+                                                        self.access_client.Access.config.gateway_port))
         self.scan_suite.start()
 
     def open_cathbot_interface(self):
@@ -217,27 +287,30 @@ class MyMainWindow(QMainWindow):
 
     def show_websocket_output(self):
         if self.ui.check_websocket_output.isChecked():
-            viewer = VideoViewer(window=self, zmq_port=self.accessi_websocket.PUBLISH_PORT, window_name="MRI Image",
+            viewer = VideoViewer(window=self, zmq_port=self.supervisor.port("websocket"), window_name="MRI Image",
                                  checkbox=self.ui.check_websocket_output, websocket_dataformat=True,
                                  save_images_button=self.ui.check_websocket_save, save_images_folder="Websocket")
             Thread(target=viewer.start, daemon=True).start()
 
     def show_cnn_output(self):
         if self.ui.check_cnn_output.isChecked():
-            viewer = VideoViewer(window=self, zmq_port=self.cnn.PUBLISH_PORT, window_name="CNN Prediction",
+            viewer = VideoViewer(window=self, zmq_port=self.supervisor.port("cnn"), window_name="CNN Prediction",
                                  checkbox=self.ui.check_cnn_output,
                                  save_images_button=self.ui.check_cnn_save, save_images_folder="CNN")
             Thread(target=viewer.start, daemon=True).start()
 
     def show_tracking_output(self):
         if self.ui.check_tracking_output.isChecked():
-            viewer = VideoViewer(window=self, zmq_port=self.tracking.PUBLISH_PORT, window_name="Guidewire Tracking",
+            viewer = VideoViewer(window=self, zmq_port=self.supervisor.port("tracking"), window_name="Guidewire Tracking",
                                  checkbox=self.ui.check_tracking_output,
                                  save_images_button=self.ui.check_tracking_save, save_images_folder="Tracking")
             Thread(target=viewer.start, daemon=True).start()
 
     def set_tracking_move_slice(self):
-        self.tracking.move_slice = self.ui.check_tracking_move_slice.isChecked()
+        self.supervisor.set_flag("move_slice", self.ui.check_tracking_move_slice.isChecked())
+
+    def set_save_latency(self):
+        self.supervisor.set_flag("save_latency", self.ui.check_save_latency_data.isChecked())
 
     def update_guidewire_tracking_status(self, status):
         self.ui.status_guidewire_tracking.setText(status)
@@ -261,10 +334,12 @@ class MyMainWindow(QMainWindow):
             pass
         if self.scan_suite is not None:
             self.scan_suite.kill()
+        self.supervisor.stop_all()
         QMainWindow.closeEvent(self, event)
 
     def set_image_format(self):
         self.access_client.Access.Image.set_image_format(self.ui.combo_accessi_image_format.currentText())
+        self.supervisor.set_flag("raw16bit", self.ui.combo_accessi_image_format.currentText() == "raw16bit")
 
     def select_output_directory(self):
         directory = select_directory(self.ui.field_output_directory.text())
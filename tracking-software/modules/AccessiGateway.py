@@ -0,0 +1,180 @@
+"""
+One local process that owns the Access-i session for every tool on this machine (main window, pipeline stages,
+3D Suite). accessi_local.send_request goes here instead of to the host when config.gateway_port is set.
+
+    reads (GET)          answered from a shared cache for config.gateway_cache_max_age seconds,
+                         identical reads already on their way to the host are joined instead of sent again.
+    parameter writes     one write per parameter (and index) at a time, while it runs only the newest next value
+                         is kept (latest wins), the callers it replaced get the reply of the write that went out.
+                         Any write clears the read cache (allowSideEffects can change other parameters).
+    register/deregister  the first register creates the session, the others get the same reply.
+                         The session is deregistered when the last client deregisters.
+Everything else is passed through.
+
+Clients talk over ZMQ REQ -> ROUTER: request json {url, data, type, timeout}, reply [status, body],
+status 0 means the host could not be reached and the body is the error.
+"""
+
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import zmq
+import accessi_local as Access
+from StageControl import StageControl, bind_port
+
+RESULT_ADDRESS = "inproc://gateway_results"
+DEREGISTER_REPLY = json.dumps({"result": {"success": True, "reason": "Session still used by other clients",
+                                          "time": ""}}).encode()
+
+
+def host_of(url):
+    return url.split("/SRC", 1)[0]
+
+
+class AccessiGateway:
+
+    def __init__(self, control, port=None):
+        self.control: StageControl = control
+        self.port = port
+        self.context = zmq.Context()
+        self.router = None
+        self.results = None
+        self.thread_sockets = threading.local()
+        self.result_sockets = []
+        self.executor = None
+        self.job_id = 0
+        # job id -> key, key -> identities waiting for that job
+        self.jobs = {}
+        self.waiting = {}
+        # parameter write key -> (url, data, timeout, identities) of the next write
+        self.queued_writes = {}
+        self.cache = {}
+        # host -> session id, register reply, number of registered clients, deregister url
+        self.sessions = {}
+
+    def run(self):
+        self.router = self.context.socket(zmq.ROUTER)
+        self.port = bind_port(self.router, self.control.port("gateway") or self.port)
+        self.control.publish_port("gateway", self.port)
+        self.results = self.context.socket(zmq.PULL)
+        self.results.bind(RESULT_ADDRESS)
+        self.executor = ThreadPoolExecutor(max_workers=Access.config.pool_size, thread_name_prefix="gateway")
+        poller = zmq.Poller()
+        poller.register(self.router, zmq.POLLIN)
+        poller.register(self.results, zmq.POLLIN)
+        while self.control.is_set("gateway_active"):
+            events = dict(poller.poll(100))
+            if self.results in events:
+                while self.results.poll(0):
+                    self.finish(*self.results.recv_multipart())
+            if self.router in events:
+                while self.router.poll(0):
+                    identity, _, request = self.router.recv_multipart()
+                    self.handle(identity, json.loads(request))
+        self.close()
+
+    def handle(self, identity, request):
+        url, data, request_type = request["url"], request["data"] or {}, request["type"]
+        timeout = request.get("timeout")
+        if isinstance(timeout, list):
+            # A (connect, read) tuple arrives as a json list, requests only takes it as a tuple.
+            timeout = tuple(timeout)
+        host = host_of(url)
+        if url.endswith("/authorization/register"):
+            if host in self.sessions:
+                self.sessions[host]["clients"] += 1
+                self.reply([identity], 200, self.sessions[host]["reply"])
+            else:
+                self.submit(("register", host, url), identity, url, data, request_type, timeout)
+            return
+        if host in self.sessions and "sessionId" in data:
+            data["sessionId"] = self.sessions[host]["session_id"]
+        if url.endswith("/authorization/deregister") and host in self.sessions:
+            self.sessions[host]["clients"] -= 1
+            if self.sessions[host]["clients"] > 0:
+                self.reply([identity], 200, DEREGISTER_REPLY)
+                return
+            del self.sessions[host]
+        if request_type == "GET":
+            key = ("read", url, json.dumps(data, sort_keys=True))
+            cached = self.cache.get(key)
+            if cached is not None and time.monotonic() - cached[0] < Access.config.gateway_cache_max_age:
+                self.reply([identity], 200, cached[1])
+            else:
+                self.submit(key, identity, url, data, request_type, timeout)
+            return
+        self.cache.clear()
+        if "/parameter/" in url:
+            key = ("write", url, data.get("index", 0))
+            if key in self.waiting:
+                identities = self.queued_writes[key][3] if key in self.queued_writes else []
+                self.queued_writes[key] = (url, data, timeout, identities + [identity])
+            else:
+                self.submit(key, identity, url, data, request_type, timeout)
+            return
+        self.submit(("pass", self.job_id), identity, url, data, request_type, timeout)
+
+    def submit(self, key, identity, url, data, request_type, timeout):
+        """
+        Joins the job for key if there is one, else sends the request to the host.
+        """
+        if key in self.waiting:
+            self.waiting[key].append(identity)
+            return
+        self.waiting[key] = [identity]
+        self.job_id += 1
+        self.jobs[self.job_id] = key
+        self.executor.submit(self.execute, self.job_id, url, data, request_type, timeout)
+
+    def execute(self, job_id, url, data, request_type, timeout):
+        """
+        Runs in an executor thread, the result goes back to the loop over an inproc socket per thread.
+        """
+        socket = getattr(self.thread_sockets, "socket", None)
+        if socket is None:
+            socket = self.thread_sockets.socket = self.context.socket(zmq.PUSH)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.connect(RESULT_ADDRESS)
+            self.result_sockets.append(socket)
+        try:
+            response = Access.http_request(url, data, request_type, timeout)
+            status, body = response.status_code, response.content
+        except Exception as error:
+            status, body = 0, str(error).encode()
+        socket.send_multipart([str(job_id).encode(), str(status).encode(), body])
+
+    def finish(self, job_id, status, body):
+        key = self.jobs.pop(int(job_id))
+        status = int(status)
+        if status == 200:
+            if key[0] == "read":
+                self.cache[key] = (time.monotonic(), body)
+            elif key[0] == "register":
+                reply = json.loads(body)
+                if reply["result"]["success"]:
+                    self.sessions[key[1]] = {"session_id": reply["sessionId"], "reply": body,
+                                             "clients": len(self.waiting[key]),
+                                             "deregister_url": key[2].replace("/register", "/deregister")}
+        self.reply(self.waiting.pop(key), status, body)
+        if key in self.queued_writes:
+            url, data, timeout, identities = self.queued_writes.pop(key)
+            self.submit(key, identities[0], url, data, "POST", timeout)
+            self.waiting[key].extend(identities[1:])
+
+    def reply(self, identities, status, body):
+        for identity in identities:
+            self.router.send_multipart([identity, b"", str(status).encode(), body])
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for socket in self.result_sockets:
+            socket.close()
+        for host, session in self.sessions.items():
+            try:
+                Access.http_request(session["deregister_url"], {"sessionId": session["session_id"]}, "POST")
+            except Exception as error:
+                print(f"Gateway could not deregister from {host}: {error}")
+        self.router.close(linger=0)
+        self.results.close(linger=0)
+        self.context.term()
@@ -3,43 +3,59 @@
 """
 
 import zmq
-import json
 import asyncio
 import accessi_local as Access
-from PySide6.QtCore import Signal, QObject
-from shared_methods import convert_websocket_data_to_image, calculate_latency
+from shared_methods import calculate_latency
+from LatencyLogger import close_latency_loggers
+from binary_frame import pack_frame, unpack_header, send_frame
+from SharedFrameRing import RingWriter
+from SessionRecorder import SessionRecorder
+from StageControl import StageControl, bind_port
+import frame_trace
 
 
-class AccessiWebsocket(QObject):
-    status_websocket_signal = Signal(str)
+class AccessiWebsocket:
 
-    def __init__(self, access_instance, window):
-        super().__init__()
+    def __init__(self, control, shared_memory=False, record_path=None):
+        """
+        :param record_path: record the raw imageStream to this session file (SessionRecorder), None to not record.
+        """
         self.PUBLISH_PORT = None
-        self.Access: Access = access_instance
-        self.window = window
+        self.Access = Access
+        self.control: StageControl = control
+        self.shared_memory = shared_memory
+        self.recorder = SessionRecorder(record_path) if record_path else None
 
     async def get_websocket_data(self, connected_event: asyncio.Event):
-        print(self.Access)
         async with await Access.connect_websocket() as websocket:
             connected_event.set()
             context = zmq.Context()
             publisher_socket = context.socket(zmq.PUB)
-            self.PUBLISH_PORT = publisher_socket.bind_to_random_port("tcp://127.0.0.1")
+            self.PUBLISH_PORT = bind_port(publisher_socket, self.control.port("websocket"))
+            self.control.publish_port("websocket", self.PUBLISH_PORT)
+            self.control.emit("ready")
+            ring_writer = RingWriter(self.PUBLISH_PORT) if self.shared_memory else None
+            frame_id = 0
+            session_id = frame_trace.new_session_id()
             while True:
                 try:
                     message = await websocket.recv()
-                    decoded_message = json.dumps(Access.handle_websocket_message(message)).encode()
+                    received = frame_trace.now()
+                    service, request, response, _ = Access.handle_websocket_message(message)
                     # Only publish if raw16bit
-                    if self.window.ui.combo_accessi_image_format.currentText() == "raw16bit":
-                        publisher_socket.send(decoded_message)
-                        _, metadata = convert_websocket_data_to_image(decoded_message)
-                        if self.window.ui.check_save_latency_data.isChecked():
+                    if "imageStream" in (service, request) and self.control.is_set("raw16bit"):
+                        frame_id += 1
+                        frame = pack_frame(response, frame_id, frame_trace.make_trace_id(session_id, frame_id), received)
+                        send_frame(publisher_socket, frame, ring_writer)
+                        if self.recorder is not None:
+                            self.recorder.record(frame)
+                        metadata = unpack_header(frame[0])
+                        if self.control.is_set("save_latency"):
                             latency = calculate_latency(metadata, write_to_file=True, filename="WebSocket_Latency")
                         else:
                             latency = calculate_latency(metadata)
 
-                        self.status_websocket_signal.emit(f"Latency: {latency}s")
+                        self.control.emit("status", f"Latency: {latency}s")
                 except Exception as err:
                     if "received 1000 (OK); then sent 1000 (OK)" not in str(err):
                         print(f"Websocket error: {err}")
@@ -53,8 +69,11 @@ class AccessiWebsocket(QObject):
             image_service = Access.Image.connect_to_default_web_socket()
             print(f"Access-i ImageServiceConnection: {image_service}")
             Access.Image.set_image_format("raw16bit")
-            while self.window.ui.check_websocket_active.isChecked():
+            while self.control.is_set("websocket_active"):
                 await asyncio.sleep(0.05)
+            close_latency_loggers()
+            if self.recorder is not None:
+                self.recorder.close()
         except Exception as error:
             print("An error occurred:", error)
 
@@ -2,89 +2,312 @@
 
 """
 
-import cv2
+import os
+import json
+import time
 import zmq
-import pickle
 import numpy as np
-from PySide6.QtCore import Signal, QObject
 from ImageData import ImageData
-from shared_methods import convert_websocket_data_to_image, calculate_latency
+from ImagePublisher import ImagePublisher
+from shared_methods import calculate_latency
+from LatencyLogger import close_latency_loggers
+from FrameNormalizer import FrameNormalizer
+from ModelPlans import ModelPlans
+from InferenceEngine import (TorchInference, TorchScriptInference, OnnxInference, AdaptiveBatchSize, TTAPolicy,
+                             exported_model_paths, variant_report_path, tta_level_name, VARIANT_BACKENDS)
+from binary_frame import receive_latest_frame, receive_frames
+from InferencePool import InferenceDispatcher
+from RegionOfInterest import TrackedRegions
+from CoarseToFine import CoarseToFineDetector
+from StageControl import StageControl
+from frame_trace import mark
 
 
-class CNNModel(QObject):
-    status_cnn_signal = Signal(str)
+def pinned_core_count():
+    """
+    :return: number of cores this process may run on (PipelineSupervisor.set_cpu_affinity), None if unknown.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    try:
+        import psutil
+        return len(psutil.Process().cpu_affinity())
+    except (ImportError, AttributeError):
+        # psutil has no cpu_affinity on macOS.
+        return None
+
 
-    def __init__(self, window, subscribe_port, cnn_model):
-        super().__init__()
+class CNNModel:
+
+    def __init__(self, control, cnn_model, shared_memory=False, inference="direct", threads=None, variant=None,
+                 min_variant_accuracy=0.98, max_batch_size=1, batch_latency_target=0.15, workers=1, reorder_wait=0.0,
+                 tta="full", tta_latency_target=None, roi=False, roi_window=128, roi_full_frame_interval=10,
+                 detection="full", coarse_scale=2):
+        """
+        :param inference: "direct" runs the network itself in PyTorch (InferenceEngine),
+            "torchscript" / "onnx" run the CPU optimized export of export_model.py,
+            "predictor" goes through nnUNetPredictor (reference, to check the accuracy of the other paths).
+        :param threads: inference threads, None uses the cores the stage is pinned to.
+        :param variant: "int8" / "bf16" model of quantize_model.py (runs on its own backend, see VARIANT_BACKENDS).
+            Only used if its detection F1 in variants.json reaches min_variant_accuracy, else inference stays as given.
+        :param max_batch_size: frames that queued up during an inference are run together, up to this many.
+            1 turns batching off. Not with the "predictor" inference.
+        :param batch_latency_target: seconds a batch may take, the batch size adapts to stay under it.
+        :param workers: more than 1 makes this stage the dispatcher of that many inference worker stages
+            (InferencePool, started with PipelineSupervisor.start_workers). Workers infer one frame at a time.
+        :param reorder_wait: seconds a worker's result waits for older frames of other workers (ReorderBuffer).
+        :param tta: test time augmentation by mirroring: "off", "full" (the axes the model allows) or a tuple of
+            mirror axes (0 rows, 1 columns). FrameMetadata.tta tells which axes a frame got.
+            The "predictor" inference is the reference and always uses the mirroring of the checkpoint.
+        :param tta_latency_target: seconds inference may take, TTA is reduced above it and restored when there is
+            room again (TTAPolicy). None always uses the tta setting. Not with the "predictor" inference.
+        :param roi: infer only windows of roi_window pixels (patch coordinates) around the markers that
+            GuidewireTracking follows, the whole frame every roi_full_frame_interval frames and when a track is lost
+            (RegionOfInterest). Needs an InferenceEngine backend, used in the one frame at a time loop only.
+        :param detection: how a whole frame is inferred, "full" at full resolution or "coarse_to_fine":
+            coarse_scale times smaller first, then full resolution roi_window windows around what it found
+            (CoarseToFine, InferenceEngine backends only, not with batching).
+        """
         self.PUBLISH_PORT = None
-        self.SUBSCRIBE_PORT = subscribe_port
+        self.SUBSCRIBE_PORT = None
         self.path_to_model_directory = f"../MODELS/{cnn_model}"
         self.checkpoint_name = "checkpoint_final.pth"
         self.folds = (4,)
         self.model = None
-        self.window = window
+        self.control: StageControl = control
         self.input_image_dimensions = None
+        self.plans = ModelPlans(self.path_to_model_directory)
+        self.inference = inference
+        self.threads = threads
+        self.variant = variant
+        self.min_variant_accuracy = min_variant_accuracy
+        self.engine = None
+        self.max_batch_size = max_batch_size
+        self.batch_size = AdaptiveBatchSize(max_batch_size, batch_latency_target)
+        self.workers = workers
+        self.reorder_wait = reorder_wait
+        self.tta = tta
+        self.tta_latency_target = tta_latency_target
+        self.tta_policy = TTAPolicy(())
+        self.regions = None
+        self.feedback_socket = None
+        self.roi_window = roi_window
+        self.detection = detection
+        self.coarse_scale = coarse_scale
+        self.detector = None
+        if roi:
+            if any(roi_window % divisor for divisor in self.plans.size_divisor):
+                raise ValueError(f"ROI window {roi_window} is not a multiple of {self.plans.size_divisor}, "
+                                 f"the network downsamples by that much")
+            self.regions = TrackedRegions(roi_window, self.plans.patch_size, roi_full_frame_interval)
+        self.normalizer = FrameNormalizer()
+        self.shared_memory = shared_memory
 
     def prepare_cnn(self, torch, nnUNetPredictor, path_to_model_directory, checkpoint_name, folds, DEVICE):
         """
         Returns the model which is prepared to predict.
         """
-        print(f"GPU: {torch.cuda.get_device_name(0)}")
-        predictor = nnUNetPredictor(tile_step_size=1, use_gaussian=True, use_mirroring=True,
+        if torch.cuda.is_available():
+            print(f"GPU: {torch.cuda.get_device_name(0)}")
+        # One tile per frame, so the Gaussian weighting cancels out. Mirroring on the allowed_mirroring_axes of the
+        # checkpoint, the InferenceEngine backends mirror themselves (TTAPolicy).
+        predictor = nnUNetPredictor(tile_step_size=1, use_gaussian=False, use_mirroring=True,
                                     perform_everything_on_device=True, device=torch.device(DEVICE, 0),
                                     verbose=False, verbose_preprocessing=False, allow_tqdm=False)
         predictor.initialize_from_trained_model_folder(path_to_model_directory, checkpoint_name=checkpoint_name,
                                                        use_folds=folds)
         return predictor
 
-    def predict(self, image_data):
+    def prepare_engine(self, DEVICE):
+        """
+        Loads the model for the chosen inference. The exported backends do not need nnU-Net at all.
+        """
+        # imports are here because they take a long time. They are in the stage process.
+        threads = self.threads
+        if threads is None:
+            threads = pinned_core_count()
+        variant = self.accepted_variant()
+        if variant is not None:
+            self.inference = VARIANT_BACKENDS[variant]
+        if self.inference == "onnx":
+            self.engine = OnnxInference(exported_model_paths(self.path_to_model_directory, self.folds, "onnx",
+                                                             variant), self.plans, self.max_batch_size, threads)
+        else:
+            import torch
+            if self.inference == "torchscript":
+                self.engine = TorchScriptInference(torch, exported_model_paths(self.path_to_model_directory,
+                                                                               self.folds, "torchscript", variant),
+                                                   self.plans, DEVICE, self.max_batch_size, threads)
+            else:
+                from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+                self.model = self.prepare_cnn(torch=torch, nnUNetPredictor=nnUNetPredictor,
+                                              path_to_model_directory=self.path_to_model_directory, folds=self.folds,
+                                              checkpoint_name=self.checkpoint_name, DEVICE=DEVICE)
+                if self.inference == "direct":
+                    self.engine = TorchInference(torch, self.model, self.plans, DEVICE, self.max_batch_size, threads)
+        self.tta_policy = TTAPolicy(self.mirror_axes(), self.tta_latency_target if self.engine is not None else None)
+        if self.detection == "coarse_to_fine":
+            if self.engine is not None:
+                self.detector = CoarseToFineDetector(self.engine, self.coarse_scale, self.roi_window)
+            else:
+                print("Coarse to fine detection needs an InferenceEngine backend, the whole frame is inferred.")
+
+    def mirror_axes(self):
+        """
+        :return: mirror axes of the tta setting. "full" are the axes the model was trained with
+            (allowed_mirroring_axes of the checkpoint), all spatial axes for the exported models.
+        """
+        if self.engine is None and self.model is not None:
+            # nnUNetPredictor reference
+            return tuple(self.model.allowed_mirroring_axes or ())
+        if self.tta == "off":
+            return ()
+        if self.tta == "full":
+            if self.model is not None:
+                return tuple(self.model.allowed_mirroring_axes or ())
+            return tuple(range(len(self.plans.patch_size)))
+        return tuple(self.tta)
+
+    def accepted_variant(self):
+        """
+        :return: self.variant if quantize_model.py measured it at or above min_variant_accuracy, else None.
+        """
+        if self.variant is None:
+            return None
+        report_path = variant_report_path(self.path_to_model_directory)
+        accuracy = None
+        if os.path.exists(report_path):
+            with open(report_path) as file:
+                accuracy = json.load(file).get(self.variant, {}).get("f1")
+        if accuracy is not None and accuracy >= self.min_variant_accuracy:
+            return self.variant
+        message = (f"{self.variant} model not used: detection F1 {accuracy} < {self.min_variant_accuracy}"
+                   if accuracy is not None else f"{self.variant} model not used: not checked by quantize_model.py")
+        if self.control is not None:
+            self.control.emit("status", message)
+        print(message)
+        return None
+
+    def predict(self, image_data, mirror_axes=(), windows=None):
+        """
+        :param windows: [(top, left)] to infer only those windows of the frame (RegionOfInterest), None for all of it.
+        """
         try:
+            if self.engine is not None and windows:
+                return self.engine.predict_windows(image_data, windows, self.regions.window_size, mirror_axes)
+            if self.detector is not None:
+                return self.detector.predict(image_data, mirror_axes)
+            if self.engine is not None:
+                return self.engine.predict([image_data], mirror_axes)[0]
             # image_data = cv2.imread("new_guidewire-img-00001-00001.png", cv2.IMREAD_GRAYSCALE)
-            image = cv2.resize(image_data, (350, 350)).astype(np.float32) / 255.0
-            cnn_input = image.reshape(1, 1, image.shape[0], image.shape[1])
-            props = {'spacing': (999, 1, 1)}
-            return self.model.predict_single_npy_array(cnn_input, props, None, None, False)[0]
+            # Patch size, spacing and intensity range as in plans.json, nnU-Net does not resample or pad again.
+            cnn_input = self.plans.preprocess(image_data)
+            return self.model.predict_single_npy_array(cnn_input, self.plans.properties, None, None, False)[0]
 
         except Exception as error:
             print(f"Error occurred in prediction: {error}")
         return None
 
+    def predict_tta(self, image_data, windows=None):
+        """
+        predict with the mirror axes of the TTA policy, which then gets the time it took.
+        :return: label map (None on error) and the mirror axes used.
+        """
+        mirror_axes = self.tta_policy.mirror_axes
+        start = time.perf_counter()
+        output_image = self.predict(image_data, mirror_axes, windows)
+        self.tta_policy.update(time.perf_counter() - start)
+        return output_image, mirror_axes
+
+    def receive_tracker_positions(self, context):
+        """
+        Newest marker positions from GuidewireTracking, for the windows of the next frame.
+        """
+        if self.feedback_socket is None:
+            port = self.control.port("tracking_feedback")
+            if port is None:
+                return
+            self.feedback_socket = context.socket(zmq.SUB)
+            self.feedback_socket.setsockopt(zmq.CONFLATE, 1)
+            self.feedback_socket.connect("tcp://127.0.0.1:" + str(port))
+            self.feedback_socket.subscribe("")
+        try:
+            self.regions.update(self.feedback_socket.recv(zmq.NOBLOCK))
+        except zmq.error.Again:
+            pass
+
+    def predict_batch(self, subscriber_socket, publisher):
+        """
+        Runs the frames that queued up during the last inference (up to the adaptive batch size) as one batch.
+        Results are published oldest first, so downstream still sees the acquisition order.
+        """
+        frames = receive_frames(subscriber_socket, self.batch_size.size)
+        # The normalizer reuses its buffer, every frame of the batch needs its own.
+        images = [self.normalizer.normalize(pixels).copy() for pixels, _ in frames]
+        self.input_image_dimensions = (frames[-1][1].columns, frames[-1][1].rows)
+        mirror_axes = self.tta_policy.mirror_axes
+        start = time.perf_counter()
+        try:
+            output_images = self.engine.predict(images, mirror_axes)
+        except Exception as error:
+            print(f"Error occurred in prediction: {error}")
+            return
+        seconds = time.perf_counter() - start
+        self.batch_size.update(len(images), seconds)
+        self.tta_policy.update(seconds)
+        for image, (pixels, metadata), output_image in zip(images, frames, output_images):
+            self.publish(publisher, output_image, image.shape, pixels, metadata, mirror_axes)
+
+    def publish(self, publisher, output_image, shape, pixels, metadata, mirror_axes):
+        output_image = self.plans.postprocess((output_image * 255).astype(np.uint8), shape)
+        mark(metadata, "inferred")
+        metadata.tta = mirror_axes
+        output = ImageData(image_data=output_image, metadata=metadata, pixels=pixels)
+        publisher.send(output)
+
+        if self.control.is_set("save_latency"):
+            latency = calculate_latency(metadata, write_to_file=True, filename="CNN_Latency")
+        else:
+            latency = calculate_latency(metadata)
+        self.control.emit("status", f"Latency: {latency}s, TTA: {tta_level_name(mirror_axes)}")
+
     def start(self, DEVICE):
-        # imports are here because they take a long time. They are in a separate thread.
-        import torch
-        from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+        if self.workers > 1:
+            InferenceDispatcher(self.control, self, self.reorder_wait).run()
+            close_latency_loggers()
+            return
+        self.SUBSCRIBE_PORT = self.control.wait_for_port("websocket")
         context = zmq.Context()
         subscriber_socket = context.socket(zmq.SUB)
-        subscriber_socket.setsockopt(zmq.CONFLATE, 1)
+        # Frames can be multipart, CONFLATE does not work with them. receive_latest_frame drops old frames instead.
         subscriber_socket.connect("tcp://127.0.0.1:" + str(self.SUBSCRIBE_PORT))
         subscriber_socket.subscribe("")
-        publisher_socket = context.socket(zmq.PUB)
-        self.PUBLISH_PORT = publisher_socket.bind_to_random_port("tcp://127.0.0.1")
-        self.model = self.prepare_cnn(torch=torch, nnUNetPredictor=nnUNetPredictor,
-                                      path_to_model_directory=self.path_to_model_directory, folds=self.folds,
-                                      checkpoint_name=self.checkpoint_name, DEVICE=DEVICE)
-        for checkbox in [self.window.ui.check_cnn_output, self.window.ui.check_cnn_save,
-                         self.window.ui.check_guidewire_tracking_active,
-                         self.window.ui.check_tracking_move_slice, self.window.ui.check_collision_detection_active,
-                         self.window.ui.check_cathbot_collision_feedback, self.window.ui.check_collision_save,
-                         self.window.ui.check_tracking_save]:
-            checkbox.setEnabled(True)
-            checkbox.stateChanged.emit(checkbox.isChecked())
-        while self.window.ui.check_cnn_active.isChecked():
-            data = subscriber_socket.recv()
-            image, metadata = convert_websocket_data_to_image(data)
-            if image is None:
+        publisher = ImagePublisher(context, shared_memory=self.shared_memory, port=self.control.port("cnn"))
+        self.PUBLISH_PORT = publisher.PORT
+        self.prepare_engine(DEVICE)
+        # Port is published only now, the UI enables the dependent checkboxes when it sees "ready".
+        self.control.publish_port("cnn", self.PUBLISH_PORT)
+        self.control.emit("ready")
+        batching = self.max_batch_size > 1 and self.engine is not None
+        if self.regions is not None and (batching or self.engine is None):
+            print("ROI inference needs an InferenceEngine backend without batching, the whole frame is inferred.")
+            self.regions = None
+        while self.control.is_set("cnn_active"):
+            if batching:
+                self.predict_batch(subscriber_socket, publisher)
                 continue
-            self.input_image_dimensions = (metadata.value.image.dimensions.columns, metadata.value.image.dimensions.rows)
-            output_image = self.predict(image)
+            # Copied, the pixels are published with the result after inference.
+            pixels, metadata = receive_latest_frame(subscriber_socket, copy=True)
+            image = self.normalizer.normalize(pixels)
+            self.input_image_dimensions = (metadata.columns, metadata.rows)
+            windows = None
+            if self.regions is not None:
+                self.receive_tracker_positions(context)
+                windows = self.regions.windows()
+            output_image, mirror_axes = self.predict_tta(image, windows)
             if output_image is not None:
-                output_image = (output_image * 255).astype(np.uint8)
-                output_image = cv2.resize(output_image, self.input_image_dimensions)
-                output = ImageData(image_data=output_image, metadata=metadata)
-                publisher_socket.send(pickle.dumps(output))
-
-                if self.window.ui.check_save_latency_data.isChecked():
-                    latency = calculate_latency(metadata, write_to_file=True, filename="CNN_Latency")
-                else:
-                    latency = calculate_latency(metadata)
-                self.status_cnn_signal.emit(f"Latency: {latency}s")
+                self.publish(publisher, output_image, image.shape, pixels, metadata, mirror_axes)
+        if self.feedback_socket is not None:
+            self.feedback_socket.close()
+        publisher.close()
+        close_latency_loggers()
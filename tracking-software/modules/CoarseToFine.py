@@ -0,0 +1,57 @@
+"""
+Coarse to fine detection: the network first runs on the whole frame at a lower resolution to find candidate
+susceptibility artifacts, then at full resolution only on windows around them.
+The full resolution pass over the whole frame stays the reference (CNNModel detection="full"),
+compare_detection.py measures accuracy and latency of both on test-images and the synthetic dataset.
+"""
+
+import cv2
+import numpy as np
+from RegionOfInterest import centred_window
+
+
+class CoarseToFineDetector:
+
+    def __init__(self, engine, coarse_scale=2, window_size=128):
+        """
+        :param engine: InferenceEngine backend with the model.
+        :param coarse_scale: the coarse pass sees the frame this many times smaller per axis.
+        :param window_size: side of the full resolution windows around the candidates, in patch pixels.
+        """
+        self.engine = engine
+        self.patch_size = engine.plans.patch_size
+        self.coarse_scale = coarse_scale
+        self.window_size = window_size
+        self.coarse_shape = tuple(size // coarse_scale for size in self.patch_size)
+        for shape in (self.coarse_shape, (window_size,) * len(self.patch_size)):
+            if any(size % divisor for size, divisor in zip(shape, engine.plans.size_divisor)):
+                raise ValueError(f"{shape} is not a multiple of {engine.plans.size_divisor}, "
+                                 f"the network downsamples by that much")
+        self.coarse_input = np.empty((1, 1) + self.coarse_shape, dtype=np.float32)
+        self.windows = []
+
+    def candidates(self, coarse_labels):
+        """
+        :return: (x, y) in patch pixels of every artifact found by the coarse pass.
+        """
+        count, _, _, centroids = cv2.connectedComponentsWithStats(coarse_labels, connectivity=8)
+        # Component 0 is the background.
+        return [(x * self.coarse_scale, y * self.coarse_scale) for x, y in centroids[1:count]]
+
+    def predict(self, image, mirror_axes=()):
+        """
+        :param image: 2D uint8 frame.
+        :return: uint8 label map at the patch size, background outside the windows.
+        """
+        self.engine.fill_batch([image])
+        # cv2 wants (width, height)
+        self.coarse_input[0, 0] = cv2.resize(self.engine.batch[0, 0], self.coarse_shape[::-1],
+                                             interpolation=cv2.INTER_AREA)
+        coarse_labels = self.engine.window_labels(self.coarse_input, mirror_axes)[0]
+        self.windows = sorted({centred_window(x, y, self.window_size, self.patch_size)
+                               for x, y in self.candidates(coarse_labels)})
+        if not self.windows:
+            return np.zeros(self.patch_size, dtype=np.uint8)
+        if len(self.windows) * self.window_size ** 2 >= self.patch_size[0] * self.patch_size[1]:
+            return self.engine.labels(1, mirror_axes)[0]
+        return self.engine.label_windows(self.windows, self.window_size, mirror_axes)
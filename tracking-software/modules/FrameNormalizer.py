@@ -0,0 +1,99 @@
+"""
+
+"""
+
+import numpy as np
+
+
+class FrameNormalizer:
+    """
+    uint16 -> uint8 conversion without float temporaries.
+    A 65536 entry lookup table maps raw values to 0-255, np.take writes straight into a preallocated buffer.
+
+    The window follows a percentile of a subsampled frame (every n-th pixel) and is smoothed over frames,
+    so the brightness does not jump around like it did with image / image.max().
+    The lookup table is only rebuilt when the window moved noticeably.
+    One instance per stream, it keeps state between frames.
+    """
+
+    def __init__(self, high_percentile=99.9, low_percentile=None, smoothing=0.2, subsample=4, tolerance=0.01):
+        """
+        :param high_percentile: raw value at this percentile becomes 255.
+        :param low_percentile: raw value at this percentile becomes 0. None keeps 0 as black (like image.max() did).
+        :param smoothing: weight of the newest frame in the running window (1 = no smoothing).
+        :param subsample: step in both directions when sampling the frame for the window.
+        :param tolerance: relative window change that triggers a lookup table rebuild.
+        """
+        self.high_percentile = high_percentile
+        self.low_percentile = low_percentile
+        self.smoothing = smoothing
+        self.subsample = subsample
+        self.tolerance = tolerance
+        self.window = None
+        self.lut_window = None
+        self.lut = np.zeros(65536, dtype=np.uint8)
+        self.lut_scratch = np.empty(65536, dtype=np.int64)
+        self.levels = np.arange(65536, dtype=np.int64)
+        self.output = None
+        self.sample = None
+
+    def normalize(self, frame, update_window=True):
+        """
+        :param frame: 2D uint16 image.
+        :param update_window: False keeps the current window (e.g. for a second view of the same frame).
+        :return: uint8 image. This buffer is reused on the next call, copy it if it has to be kept.
+        """
+        if self.output is None or self.output.shape != frame.shape:
+            self.output = np.empty(frame.shape, dtype=np.uint8)
+        if update_window or self.window is None:
+            self.update_window(frame)
+        np.take(self.lut, frame, out=self.output, mode='clip')
+        return self.output
+
+    def update_window(self, frame):
+        sample_view = frame[::self.subsample, ::self.subsample]
+        if self.sample is None or self.sample.size != sample_view.size:
+            self.sample = np.empty(sample_view.size, dtype=frame.dtype)
+        np.copyto(self.sample.reshape(sample_view.shape), sample_view)
+        last = self.sample.size - 1
+        high_index = int(last * self.high_percentile / 100)
+        if self.low_percentile is None:
+            self.sample.partition(high_index)
+            low = 0
+        else:
+            low_index = int(last * self.low_percentile / 100)
+            self.sample.partition((low_index, high_index))
+            low = float(self.sample[low_index])
+        high = float(self.sample[high_index])
+
+        if self.window is None:
+            self.window = (low, high)
+        else:
+            self.window = (self.window[0] + self.smoothing * (low - self.window[0]),
+                           self.window[1] + self.smoothing * (high - self.window[1]))
+        if self.lut_window is None or self.window_moved():
+            self.build_lut(*self.window)
+
+    def window_moved(self):
+        width = max(self.lut_window[1] - self.lut_window[0], 1)
+        return (abs(self.window[0] - self.lut_window[0]) > self.tolerance * width or
+                abs(self.window[1] - self.lut_window[1]) > self.tolerance * width)
+
+    def build_lut(self, low, high):
+        low = int(low)
+        width = max(int(high) - low, 1)
+        # Integer scaling: (value - low) * 255 // width, clipped to 0-255
+        np.subtract(self.levels, low, out=self.lut_scratch)
+        np.multiply(self.lut_scratch, 255, out=self.lut_scratch)
+        np.floor_divide(self.lut_scratch, width, out=self.lut_scratch)
+        np.clip(self.lut_scratch, 0, 255, out=self.lut_scratch)
+        self.lut[:] = self.lut_scratch
+        self.lut_window = (low, low + width)
+
+    @property
+    def level(self):
+        return None if self.window is None else (self.window[0] + self.window[1]) / 2
+
+    @property
+    def width(self):
+        return None if self.window is None else self.window[1] - self.window[0]
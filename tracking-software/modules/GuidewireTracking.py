@@ -4,33 +4,36 @@
 
 import cv2
 import zmq
-import pickle
 import numpy as np
 import accessi_local as Access
-from PySide6.QtCore import Signal, QObject
 from ImageData import ImageData
+from ImagePublisher import ImagePublisher, subscribe_image_data, receive_image_data, TOPIC_LEAN, TOPIC_PIXELS
 from ArtifactTracker import ArtifactTracker
+from RegionOfInterest import pack_tracker_positions
 from shared_methods import calculate_latency
+from LatencyLogger import close_latency_loggers
+from StageControl import StageControl, bind_port
+from frame_trace import mark, StageLatencyWindow
 
 
-class GuidewireTracking(QObject):
-    status_guidewire_tracking_signal = Signal(str)
-    status_move_slice_signal = Signal(str)
+class GuidewireTracking:
 
-    def __init__(self, window, subscribe_port):
-        super().__init__()
+    def __init__(self, control, shared_memory=False):
+        self.control: StageControl = control
         self.PUBLISH_PORT = None
         self.RAW_COORDINATE_PUBLISH_PORT = None
-        self.SUBSCRIBE_PORT = subscribe_port
-        self.move_slice = False
+        self.SUBSCRIBE_PORT = None
         self.MRI: Access.ParameterStandard = Access.ParameterStandard()
         self.voxel_size = None
         self.subscriber_socket = None
-        self.publisher_socket = None
-        self.raw_coordinate_publisher_socket = None
+        self.publisher = None
+        self.raw_coordinate_publisher = None
+        self.feedback_socket = None
+        self.subscribed_pixels = False
         self.previous_positions = None
-        self.window = window
         self.trackers = []
+        self.shared_memory = shared_memory
+        self.latency_window = StageLatencyWindow()
 
     @staticmethod
     def find_artifact_centroids(image, kernel: int = 7):
@@ -56,37 +59,52 @@ class GuidewireTracking(QObject):
 
     def convert_px_to_mm(self, px, metadata):
         if self.voxel_size is None:
-            self.voxel_size = metadata.value.image.dimensions.voxelSize.column
+            self.voxel_size = metadata.voxel_size[0]
         return self.voxel_size * px
 
     def start(self, movement_threshold_mm=3):
+        self.SUBSCRIBE_PORT = self.control.wait_for_port("cnn")
         context = zmq.Context()
         self.subscriber_socket = context.socket(zmq.SUB)
         self.subscriber_socket.setsockopt(zmq.CONFLATE, 1)
         self.subscriber_socket.connect("tcp://127.0.0.1:" + str(self.SUBSCRIBE_PORT))
-        self.subscriber_socket.subscribe("")
-        self.publisher_socket = context.socket(zmq.PUB)
-        self.raw_coordinate_publisher_socket = context.socket(zmq.PUB)
-        self.PUBLISH_PORT = self.publisher_socket.bind_to_random_port("tcp://127.0.0.1")
-        self.RAW_COORDINATE_PUBLISH_PORT = self.raw_coordinate_publisher_socket.bind_to_random_port("tcp://127.0.0.1")
+        subscribe_image_data(self.subscriber_socket, pixels=False)
+        self.publisher = ImagePublisher(context, shared_memory=self.shared_memory, port=self.control.port("tracking"))
+        self.raw_coordinate_publisher = ImagePublisher(context, shared_memory=self.shared_memory,
+                                                       port=self.control.port("tracking_raw_coordinate"))
+        self.PUBLISH_PORT = self.publisher.PORT
+        self.RAW_COORDINATE_PUBLISH_PORT = self.raw_coordinate_publisher.PORT
+        self.control.publish_port("tracking", self.PUBLISH_PORT)
+        self.control.publish_port("tracking_raw_coordinate", self.RAW_COORDINATE_PUBLISH_PORT)
+        self.control.emit("ready")
+        # Tracker positions back to the CNN stage, for its region of interest inference.
+        self.feedback_socket = context.socket(zmq.PUB)
+        self.control.publish_port("tracking_feedback",
+                                  bind_port(self.feedback_socket, self.control.port("tracking_feedback")))
         tracker_id = 0
         self.trackers = []
-        while self.window.ui.check_guidewire_tracking_active.isChecked():
-            data = self.subscriber_socket.recv()
-            prediction: ImageData = pickle.loads(data)
-            if prediction.image is None:
+        while self.control.is_set("tracking_active"):
+            self.update_pixel_subscription()
+            prediction: ImageData = receive_image_data(self.subscriber_socket, copy=True)
+            if prediction is None or prediction.image is None:
                 continue
+            Access.geometry_cache.update_from_metadata(prediction.metadata)
             centroids, threshold = self.find_artifact_centroids(prediction.image)
+            mark(prediction.metadata, "tracked")
 
             # Send Centroids Data to socket.
-            centroids_mm = [[element * prediction.metadata.value.image.dimensions.voxelSize.column for element in sublist] for sublist in centroids]
-            output_3d_suite = ImageData(metadata=prediction.metadata, artifact_coordinates=centroids_mm)
-            self.raw_coordinate_publisher_socket.send(pickle.dumps(output_3d_suite))
+            centroids_mm = [[element * prediction.metadata.voxel_size[0] for element in sublist] for sublist in centroids]
+            output_3d_suite = ImageData(metadata=prediction.metadata, artifact_coordinates=centroids_mm,
+                                        pixels=prediction.pixels)
+            self.raw_coordinate_publisher.send(output_3d_suite)
 
-            if self.window.ui.check_save_latency_data.isChecked():
+            if self.control.is_set("save_latency"):
                 latency = calculate_latency(prediction.metadata, write_to_file=True, filename="Tracking_Latency")
             else:
                 latency = calculate_latency(prediction.metadata)
+            self.latency_window.add(prediction.metadata)
+            if self.latency_window.count % 50 == 0:
+                self.control.emit("latency", self.latency_window.summary())
 
             for tracker in self.trackers:
                 tracker.update(centroids)
@@ -98,6 +116,9 @@ class GuidewireTracking(QObject):
                 for centroid in centroids:
                     self.trackers.append(ArtifactTracker(centroid, tracker_id))
                     tracker_id += 1
+            self.feedback_socket.send(pack_tracker_positions(
+                [tracker.coordinates for tracker in self.trackers if tracker.track_lost == 0],
+                lost=any(tracker.track_lost for tracker in self.trackers), shape=prediction.image.shape))
 
             average_movement = []
             largest_movement = None
@@ -119,40 +140,58 @@ class GuidewireTracking(QObject):
 
             if largest_movement is not None and len(largest_movement.movement_vector) > 1:
                 # average_movement = np.mean(average_movement, axis=0)
-                self.status_guidewire_tracking_signal.emit(f"({len(self.trackers)}) Move: {largest_movement.movement_vector[0]} | {largest_movement.movement_vector[1]} (px)")
+                self.control.emit("status", f"({len(self.trackers)}) Move: {largest_movement.movement_vector[0]} | {largest_movement.movement_vector[1]} (px)")
             elif not largest_movement and len(self.trackers) > 0:
-                self.status_guidewire_tracking_signal.emit(f"({len(self.trackers)}) No movement detected")
+                self.control.emit("status", f"({len(self.trackers)}) No movement detected")
             else:
-                self.status_guidewire_tracking_signal.emit("No guidewire detected.")
+                self.control.emit("status", "No guidewire detected.")
 
             output = ImageData(image_data=threshold, metadata=prediction.metadata)
-            self.publisher_socket.send(pickle.dumps(output))
+            self.publisher.send(output)
 
-            if self.move_slice and largest_movement is not None and len(largest_movement.movement_vector) > 1:
+            if self.control.is_set("move_slice") and largest_movement is not None and len(largest_movement.movement_vector) > 1:
                 self.move_slice_to_target(side_to_side_x=int(self.convert_px_to_mm(largest_movement.movement_vector[0], prediction.metadata)),
                                           forward_z=int(self.convert_px_to_mm(largest_movement.movement_vector[1], prediction.metadata)),
                                           largest_movement_tracker=largest_movement)
+        self.publisher.close()
+        self.raw_coordinate_publisher.close()
+        self.feedback_socket.close()
+        close_latency_loggers()
+
+    def update_pixel_subscription(self):
+        """
+        The raw frame is only pulled from the CNN while something (3D Suite) subscribed to it here.
+        """
+        self.raw_coordinate_publisher.update_subscriptions()
+        if self.raw_coordinate_publisher.wants_pixels != self.subscribed_pixels:
+            self.subscribed_pixels = self.raw_coordinate_publisher.wants_pixels
+            subscribe_image_data(self.subscriber_socket, pixels=self.subscribed_pixels)
+            self.subscriber_socket.unsubscribe(TOPIC_LEAN if self.subscribed_pixels else TOPIC_PIXELS)
 
     def move_slice_to_target(self, side_to_side_x, forward_z, largest_movement_tracker):
         current_location = self.MRI.get_slice_position_dcs().value
         target_location = [current_location.x + side_to_side_x,
                            current_location.y,
                            current_location.z + forward_z]
-        answer = self.MRI.set_slice_position_dcs(x=target_location[0], y=target_location[1],
-                                                 z=target_location[2])
-        self.status_move_slice_signal.emit(f"Move({forward_z},{side_to_side_x}): {answer.result.success}, "
-                                           f"{answer.result.reason}, valueSet: {answer.valueSet}")
+        with self.MRI.slice_transaction() as slice_update:
+            slice_update.set_position(*target_location)
+        answer = slice_update.reply
+        self.control.emit("move_slice", f"Move({forward_z},{side_to_side_x}): {answer.result.success}, "
+                                        f"{answer.result.reason}, valueSet: {answer.positionSet}")
         """
         Wait for changes to take effect (this is not good)
         """
         allowed_difference = 2
         while True:
-            data = self.subscriber_socket.recv()
-            prediction: ImageData = pickle.loads(data)
-            new_location = prediction.metadata.value.image.coordinates.mrSliceDcs.position
-            diff_x = abs(new_location.x - target_location[0]) < allowed_difference
-            diff_y = abs(new_location.y - target_location[1]) < allowed_difference
-            diff_z = abs(new_location.z - target_location[2]) < allowed_difference
+            prediction: ImageData = receive_image_data(self.subscriber_socket, copy=True)
+            if prediction is None:
+                continue
+            new_location = prediction.metadata.slice_position
+            if new_location is None:
+                continue
+            diff_x = abs(new_location[0] - target_location[0]) < allowed_difference
+            diff_y = abs(new_location[1] - target_location[1]) < allowed_difference
+            diff_z = abs(new_location[2] - target_location[2]) < allowed_difference
             if all([diff_x, diff_y, diff_z]):
                 # Retain the tracker that was used to move
                 self.trackers = [ArtifactTracker(largest_movement_tracker.initial_coordinate, largest_movement_tracker.id)]
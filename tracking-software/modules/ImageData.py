@@ -2,9 +2,40 @@
 
 """
 
+from frame_trace import STAGES
+
+
+class FrameMetadata:
+    """
+    Lean per-frame metadata that travels between the stages. It has no pixel data,
+    the raw frame is only attached (ImageData.pixels) for subscribers that ask for it.
+    trace_id and stage_times follow the frame through the pipeline, see frame_trace.py.
+    tta: mirror axes of the test time augmentation the CNN used, () for none, None before the CNN.
+    slice_position: (x, y, z) dcs of the slice, None if the frame had no coordinates.
+    """
+    __slots__ = ("frame_id", "trace_id", "received_time", "acquisition_time", "columns", "rows", "voxel_size",
+                 "slice_position", "stage_times", "tta")
+
+    def __init__(self, frame_id=None, trace_id=None, received_time=None, acquisition_time=None, columns=None,
+                 rows=None, voxel_size=(0, 0, 0), slice_position=None, stage_times=None, tta=None):
+        self.frame_id = frame_id
+        self.trace_id = trace_id
+        self.received_time = received_time
+        self.acquisition_time = acquisition_time
+        self.columns = columns
+        self.rows = rows
+        self.voxel_size = voxel_size
+        self.slice_position = slice_position
+        self.stage_times = [0.0] * len(STAGES) if stage_times is None else list(stage_times)
+        self.tta = tta
+
+    def __repr__(self):
+        return f"FrameMetadata({', '.join(f'{name}={getattr(self, name)}' for name in self.__slots__)})"
+
 
 class ImageData:
-    def __init__(self, image_data=None, metadata=None, artifact_coordinates=None):
+    def __init__(self, image_data=None, metadata=None, artifact_coordinates=None, pixels=None):
         self.image = image_data
-        self.metadata = metadata
+        self.metadata: FrameMetadata = metadata
         self.artifact_coordinates = artifact_coordinates
+        self.pixels = pixels
@@ -0,0 +1,92 @@
+"""
+
+"""
+
+import zmq
+import pickle
+from ImageData import ImageData
+from SharedFrameRing import RingWriter, is_notification, read_notification
+from StageControl import bind_port
+
+TOPIC_LEAN = b"L"
+TOPIC_PIXELS = b"P"
+
+
+class ImagePublisher:
+    """
+    Publishes ImageData to subscribers. Every subscriber chooses if it wants the raw frame attached:
+    subscribe_image_data(socket, pixels=True) subscribes to TOPIC_PIXELS, otherwise to TOPIC_LEAN.
+    XPUB tells when the first pixel subscriber subscribes and the last one unsubscribes,
+    so the pixels are only pickled while somebody actually wants them.
+    NOTE: a subscriber that is killed without unsubscribing keeps the pixels on until the publisher restarts.
+
+    With shared_memory the image and pixels are written to a SharedFrameRing and both topics only get
+    the ring notification, the lean subscribers simply ignore the pixels in the slot.
+    """
+
+    def __init__(self, context, shared_memory=False, port=None):
+        """
+        :param port: None binds a random port.
+        """
+        self.socket = context.socket(zmq.XPUB)
+        self.PORT = bind_port(self.socket, port)
+        self.wants_pixels = False
+        self.ring_writer = RingWriter(self.PORT) if shared_memory else None
+
+    def update_subscriptions(self):
+        while True:
+            try:
+                event = self.socket.recv(zmq.NOBLOCK)
+            except zmq.error.Again:
+                return
+            if event[1:] == TOPIC_PIXELS:
+                self.wants_pixels = event[0] == 1
+
+    def send(self, image_data: ImageData):
+        self.update_subscriptions()
+        if self.ring_writer is not None:
+            self.send_shared_memory(image_data)
+            return
+        pixels = image_data.pixels
+        image_data.pixels = None
+        self.socket.send(TOPIC_LEAN + pickle.dumps(image_data))
+        if self.wants_pixels and pixels is not None:
+            image_data.pixels = pixels
+            self.socket.send(TOPIC_PIXELS + pickle.dumps(image_data))
+
+    def send_shared_memory(self, image_data: ImageData):
+        image, pixels = image_data.image, image_data.pixels if self.wants_pixels else None
+        image_data.image, image_data.pixels = None, None
+        notification = self.ring_writer.write(pickle.dumps(image_data), [image, pixels])
+        image_data.image, image_data.pixels = image, pixels
+        self.socket.send(TOPIC_LEAN + notification)
+        if pixels is not None:
+            self.socket.send(TOPIC_PIXELS + notification)
+
+    def close(self):
+        self.socket.close()
+        if self.ring_writer is not None:
+            self.ring_writer.close()
+
+
+def subscribe_image_data(socket, pixels=False):
+    socket.subscribe(TOPIC_PIXELS if pixels else TOPIC_LEAN)
+
+
+def receive_image_data(socket, copy=False) -> ImageData:
+    """
+    :param copy: copy image and pixels out of shared memory, for receivers that keep them (SharedFrameRing.read).
+    :return: ImageData, or None if it came through shared memory and was already overwritten.
+    """
+    data = socket.recv(copy=False).buffer
+    topic, body = data[:len(TOPIC_LEAN)], data[len(TOPIC_LEAN):]
+    if not is_notification(body):
+        return pickle.loads(body)
+    frame = read_notification(body, copy)
+    if frame is None:
+        return None
+    metadata, (image, pixels) = frame
+    image_data: ImageData = pickle.loads(metadata)
+    image_data.image = image
+    image_data.pixels = pixels if bytes(topic) == TOPIC_PIXELS else None
+    return image_data
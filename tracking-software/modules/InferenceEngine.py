@@ -0,0 +1,307 @@
+"""
+Runs the segmentation network directly, without nnUNetPredictor.predict_single_npy_array.
+
+For a 2D frame at the patch size the predictor's extra work is all overhead: generic preprocessing
+(resampling, cropping), the sliding window tiler (one tile), Gaussian weighting (cancels out for one tile) and
+the export pipeline (resampling back, softmax to labels on the CPU). nnU-Net only supplies the network and
+its weights here. The predictor path stays in CNNModel as the reference ("predictor" inference).
+
+Backends, all with the same predict(images):
+    TorchInference        the nnU-Net network in eager PyTorch.
+    TorchScriptInference  frozen TorchScript made by export_model.py (conv/batchnorm folded, CPU optimized).
+    OnnxInference         ONNX made by export_model.py, run by onnxruntime (optional dependency).
+The int8 (ONNX) and bf16 (TorchScript) variants of quantize_model.py run on the same backends.
+Test time augmentation mirrors like nnU-Net: the logits of every combination of the mirror axes are averaged.
+"""
+
+import os
+import copy
+import itertools
+from abc import ABC, abstractmethod
+import numpy as np
+
+EXPORT_FOLDER = "exported"
+EXPORT_EXTENSIONS = {"torchscript": ".torchscript.pt", "onnx": ".onnx"}
+# Reduced precision variants made by quantize_model.py and the backend that runs them.
+VARIANT_BACKENDS = {"int8": "onnx", "bf16": "torchscript"}
+VARIANT_REPORT = "variants.json"
+
+
+def exported_model_paths(path_to_model_directory, folds, backend, variant=None):
+    """
+    :return: one exported file per fold, as written by export_model.py (quantize_model.py for variants).
+    """
+    suffix = f".{variant}" if variant else ""
+    return [os.path.join(path_to_model_directory, EXPORT_FOLDER, f"fold_{fold}{suffix}{EXPORT_EXTENSIONS[backend]}")
+            for fold in folds]
+
+
+def variant_report_path(path_to_model_directory):
+    return os.path.join(path_to_model_directory, EXPORT_FOLDER, VARIANT_REPORT)
+
+
+def mirror_combinations(mirror_axes):
+    """
+    :param mirror_axes: spatial axes (0 = rows, 1 = columns) as in nnU-Net's allowed_mirroring_axes.
+    :return: every non-empty combination, as axes of the (batch, channel, rows, columns) array.
+    """
+    axes = [axis + 2 for axis in mirror_axes]
+    return [combination for count in range(1, len(axes) + 1) for combination in itertools.combinations(axes, count)]
+
+
+def tta_level_name(mirror_axes):
+    if not mirror_axes:
+        return "off"
+    return "mirror " + "+".join(("rows", "columns", "slices")[axis] for axis in mirror_axes)
+
+
+class AdaptiveBatchSize:
+    """
+    How many of the frames that queued up during the last inference go into the next batch.
+    A batch slower than latency_target shrinks the limit by one, a full batch well inside the target grows it,
+    so batching only adds as much latency as the target allows.
+    """
+
+    def __init__(self, max_batch_size, latency_target, headroom=0.7):
+        self.max_batch_size = max_batch_size
+        self.latency_target = latency_target
+        self.headroom = headroom
+        self.size = 1
+
+    def update(self, batch_size, seconds):
+        """
+        :param batch_size: frames in the batch that was just run.
+        :param seconds: its inference time.
+        """
+        if seconds > self.latency_target and self.size > 1:
+            self.size -= 1
+        elif (seconds < self.latency_target * self.headroom and batch_size >= self.size
+              and self.size < self.max_batch_size):
+            self.size += 1
+
+
+class TTAPolicy:
+    """
+    Which mirror axes the test time augmentation uses, 2^axes forward passes per frame.
+    The levels go from the configured axes down to off, one axis less per step.
+    With a latency_target a frame slower than the target steps down, and it steps back up once the time the
+    next level would take (from the smoothed time per forward pass) is well inside the target.
+    """
+
+    def __init__(self, mirror_axes, latency_target=None, headroom=0.7, smoothing=0.2):
+        """
+        :param latency_target: seconds the inference of a frame may take, None keeps the configured axes.
+        """
+        self.levels = [tuple(mirror_axes[:count]) for count in range(len(mirror_axes), -1, -1)]
+        self.level = 0
+        self.latency_target = latency_target
+        self.headroom = headroom
+        self.smoothing = smoothing
+        self.pass_time = None
+
+    @property
+    def mirror_axes(self):
+        return self.levels[self.level]
+
+    def update(self, seconds):
+        """
+        :param seconds: inference time of the frame (or batch) that used the current level.
+        """
+        if self.latency_target is None:
+            return
+        pass_time = seconds / 2 ** len(self.mirror_axes)
+        self.pass_time = pass_time if self.pass_time is None else \
+            self.pass_time + self.smoothing * (pass_time - self.pass_time)
+        if seconds > self.latency_target and self.level < len(self.levels) - 1:
+            self.level += 1
+        elif (self.level > 0 and
+              self.pass_time * 2 ** len(self.levels[self.level - 1]) < self.latency_target * self.headroom):
+            self.level -= 1
+
+
+class Inference(ABC):
+    """
+    Shared part of the backends: frames -> preallocated float32 batch at the patch size.
+    """
+
+    def __init__(self, plans, max_batch_size=1):
+        """
+        :param plans: ModelPlans of the model.
+        """
+        self.plans = plans
+        self.max_batch_size = max_batch_size
+        self.batch = np.empty((max_batch_size, 1) + plans.patch_size, dtype=np.float32)
+
+    def fill_batch(self, images):
+        count = len(images)
+        if count > self.max_batch_size:
+            raise ValueError(f"Batch of {count} frames, the engine was made for {self.max_batch_size}")
+        for index, image in enumerate(images):
+            self.batch[index] = self.plans.preprocess(image)[0]
+            self.plans.normalize(self.batch[index])
+        return count
+
+    def predict(self, images, mirror_axes=()):
+        """
+        :param images: list of 2D uint8 frames (any size, resized to the patch size).
+        :param mirror_axes: test time augmentation, () for none.
+        :return: list of uint8 label maps at the patch size.
+        """
+        return list(self.labels(self.fill_batch(images), mirror_axes))
+
+    def predict_windows(self, image, windows, window_size, mirror_axes=()):
+        """
+        Runs the network only on square windows of one frame (RegionOfInterest), all windows as one batch.
+        The frame is preprocessed and normalized as a whole first, like nnU-Net does before it tiles.
+        :param windows: [(top, left)] in patch coordinates.
+        :return: uint8 label map at the patch size, background outside the windows.
+        """
+        self.fill_batch([image])
+        return self.label_windows(windows, window_size, mirror_axes)
+
+    def label_windows(self, windows, window_size, mirror_axes=()):
+        """
+        predict_windows on the frame already in the batch.
+        """
+        crops = np.stack([self.batch[0, :, top:top + window_size, left:left + window_size] for top, left in windows])
+        output = np.zeros(self.plans.patch_size, dtype=np.uint8)
+        for (top, left), labels in zip(windows, self.window_labels(crops, mirror_axes)):
+            region = output[top:top + window_size, left:left + window_size]
+            np.maximum(region, labels, out=region)
+        return output
+
+    @abstractmethod
+    def labels(self, count, mirror_axes=()):
+        """
+        :return: uint8 label maps of the first count frames in the batch.
+        """
+
+    @abstractmethod
+    def window_labels(self, crops, mirror_axes=()):
+        """
+        :param crops: (windows, 1, size, size) float32 crops of the batch.
+        :return: uint8 label maps of the crops.
+        """
+
+
+class TorchInference(Inference):
+    """
+    Batched forward pass into preallocated tensors. With several folds the logits are summed, like the predictor.
+    """
+
+    def __init__(self, torch, predictor, plans, device, max_batch_size=1, threads=None):
+        """
+        :param predictor: nnUNetPredictor after initialize_from_trained_model_folder (network and fold weights).
+        :param threads: torch intra-op threads, None leaves torch's default (OMP_NUM_THREADS of the stage).
+        """
+        super().__init__(plans, max_batch_size)
+        self.torch = torch
+        self.device = torch.device(device)
+        if threads:
+            torch.set_num_threads(threads)
+        self.networks = self.load_networks(predictor)
+        self.input = torch.empty(self.batch.shape, dtype=torch.float32, device=self.device)
+        self.output = torch.empty((max_batch_size,) + plans.patch_size, dtype=torch.int64, device=self.device)
+
+    def load_networks(self, predictor):
+        networks = []
+        for parameters in predictor.list_of_parameters:
+            network = copy.deepcopy(predictor.network)
+            network.load_state_dict(parameters)
+            networks.append(network.to(self.device).eval())
+        return networks
+
+    def forward(self, batch):
+        logits = None
+        for network in self.networks:
+            output = network(batch)
+            if isinstance(output, (list, tuple)):
+                # Deep supervision outputs, the first one is full resolution.
+                output = output[0]
+            logits = output if logits is None else logits + output
+        return logits
+
+    def mirrored(self, batch, mirror_axes):
+        logits = self.forward(batch)
+        combinations = mirror_combinations(mirror_axes)
+        for dims in combinations:
+            logits = logits + self.torch.flip(self.forward(self.torch.flip(batch, dims)), dims)
+        return logits / (len(combinations) + 1) if combinations else logits
+
+    def logits(self, count, mirror_axes=()):
+        with self.torch.inference_mode():
+            self.input[:count].copy_(self.torch.from_numpy(self.batch[:count]))
+            return self.mirrored(self.input[:count], mirror_axes)
+
+    def labels(self, count, mirror_axes=()):
+        with self.torch.inference_mode():
+            self.torch.argmax(self.logits(count, mirror_axes), dim=1, out=self.output[:count])
+            return self.output[:count].to(self.torch.uint8).cpu().numpy()
+
+    def window_labels(self, crops, mirror_axes=()):
+        with self.torch.inference_mode():
+            logits = self.mirrored(self.torch.from_numpy(crops).to(self.device), mirror_axes)
+            return self.torch.argmax(logits, dim=1).to(self.torch.uint8).cpu().numpy()
+
+
+class TorchScriptInference(TorchInference):
+
+    def __init__(self, torch, paths, plans, device="cpu", max_batch_size=1, threads=None):
+        """
+        :param paths: exported TorchScript file per fold (exported_model_paths).
+        """
+        self.paths = paths
+        super().__init__(torch, None, plans, device, max_batch_size, threads)
+
+    def load_networks(self, predictor):
+        return [self.torch.jit.load(path, map_location=self.device).eval() for path in self.paths]
+
+
+class OnnxInference(Inference):
+
+    def __init__(self, paths, plans, max_batch_size=1, threads=None):
+        """
+        :param paths: exported ONNX file per fold (exported_model_paths).
+        :param threads: onnxruntime intra-op threads, None lets onnxruntime use all cores.
+        """
+        super().__init__(plans, max_batch_size)
+        try:
+            import onnxruntime
+        except ImportError as error:
+            raise ImportError("The onnx backend needs onnxruntime (pip install onnxruntime)") from error
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.sessions = [onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+                         for path in paths]
+        self.input_name = self.sessions[0].get_inputs()[0].name
+        self.output = np.empty((max_batch_size,) + plans.patch_size, dtype=np.int64)
+
+    def forward(self, batch):
+        logits = None
+        for session in self.sessions:
+            output = session.run(None, {self.input_name: batch})[0]
+            logits = output if logits is None else logits + output
+        return logits
+
+    def mirrored(self, batch, mirror_axes):
+        logits = self.forward(batch)
+        combinations = mirror_combinations(mirror_axes)
+        for axes in combinations:
+            logits += np.flip(self.forward(np.ascontiguousarray(np.flip(batch, axes))), axes)
+        return logits / (len(combinations) + 1) if combinations else logits
+
+    def logits(self, count, mirror_axes=()):
+        return self.mirrored(self.batch[:count], mirror_axes)
+
+    def labels(self, count, mirror_axes=()):
+        np.argmax(self.logits(count, mirror_axes), axis=1, out=self.output[:count])
+        return self.output[:count].astype(np.uint8)
+
+    def window_labels(self, crops, mirror_axes=()):
+        """
+        Needs an export with dynamic rows and columns (export_model.py since window inference).
+        """
+        return self.mirrored(crops, mirror_axes).argmax(axis=1).astype(np.uint8)
@@ -0,0 +1,229 @@
+"""
+Several CNN inference processes behind the CNN stage, for machines with more cores than one torch instance
+keeps busy.
+
+    dispatcher ("cnn" stage)          receives and normalizes the frames, gives each one to the next idle worker
+                                      (round robin) and publishes the results in acquisition order.
+    workers ("cnn_worker_<index>")    hold the model each and send back the label map of a frame.
+
+Frames are numbered when they are sent out, the ReorderBuffer puts the results back in that order.
+A frame that is still being inferred when a newer one finished is stale: the newer result is not held back for it
+(longer than reorder_wait) and its own result is dropped when it comes.
+Dispatcher and workers talk over ZMQ ROUTER <-> DEALER on the "cnn_workers" port.
+"""
+
+import os
+import time
+import struct
+import zmq
+import numpy as np
+from ImagePublisher import ImagePublisher
+from binary_frame import receive_latest_frame
+from StageControl import StageControl, bind_port
+
+# sequence, rows, columns of the image (or label map) that follows.
+JOB = struct.Struct("<QHH")
+READY = b"ready"
+# Sent with READY: id of the worker process, sequence of the last frame it finished (-1 for none).
+# A READY that crossed a new job still names an older frame, a restarted worker has a new id.
+READY_STATE = struct.Struct("<8sq")
+# An idle worker says it is ready this often, so a restarted dispatcher finds it again.
+READY_INTERVAL = 1.0
+
+
+class ReorderBuffer:
+    """
+    Results of frames inferred in parallel, back in the order the frames were sent out.
+    """
+
+    def __init__(self, max_wait=0.0):
+        """
+        :param max_wait: seconds a finished result waits for older frames that are still being inferred.
+            0 publishes it right away and drops the older ones.
+        """
+        self.max_wait = max_wait
+        # sequence -> frame, sent out and not finished yet
+        self.frames = {}
+        # sequence -> (frame, result, time it finished)
+        self.results = {}
+        self.dropped = 0
+
+    def dispatched(self, sequence, frame):
+        self.frames[sequence] = frame
+
+    def completed(self, sequence, result):
+        """
+        :param result: None if the worker failed, the frame is then forgotten.
+        """
+        frame = self.frames.pop(sequence, None)
+        if frame is None:
+            # Stale, a newer frame was already published.
+            self.dropped += 1
+            return
+        if result is not None:
+            self.results[sequence] = (frame, result, time.monotonic())
+
+    def release(self):
+        """
+        :return: [(frame, result)] that can be published now, oldest first.
+        """
+        released = []
+        now = time.monotonic()
+        for sequence in sorted(self.results):
+            frame, result, finished = self.results[sequence]
+            older = [other for other in self.frames if other < sequence]
+            if older and now - finished < self.max_wait:
+                break
+            for other in older:
+                del self.frames[other]
+            del self.results[sequence]
+            released.append((frame, result))
+        return released
+
+
+class InferenceDispatcher:
+
+    def __init__(self, control, cnn, reorder_wait=0.0):
+        """
+        :param cnn: CNNModel of the stage, for its normalizer, plans and publish (it does not load the model).
+        :param reorder_wait: see ReorderBuffer.max_wait
+        """
+        self.control: StageControl = control
+        self.cnn = cnn
+        self.reorder = ReorderBuffer(reorder_wait)
+        # worker identities in the order they registered, identity -> sequence of the frame it works on,
+        # identity -> process id of READY_STATE
+        self.workers = []
+        self.busy = {}
+        self.runs = {}
+        self.next_worker = 0
+        self.sequence = 0
+        self.pending = None
+        self.ready = False
+
+    def run(self):
+        context = zmq.Context()
+        subscriber_socket = context.socket(zmq.SUB)
+        subscriber_socket.connect("tcp://127.0.0.1:" + str(self.control.wait_for_port("websocket")))
+        subscriber_socket.subscribe("")
+        router = context.socket(zmq.ROUTER)
+        router.setsockopt(zmq.LINGER, 0)
+        self.control.publish_port("cnn_workers", bind_port(router, self.control.port("cnn_workers")))
+        publisher = ImagePublisher(context, shared_memory=self.cnn.shared_memory, port=self.control.port("cnn"))
+        self.cnn.PUBLISH_PORT = publisher.PORT
+        poller = zmq.Poller()
+        poller.register(subscriber_socket, zmq.POLLIN)
+        poller.register(router, zmq.POLLIN)
+        while self.control.is_set("cnn_active"):
+            events = dict(poller.poll(100))
+            if router in events:
+                while router.poll(0):
+                    self.receive(router.recv_multipart())
+            if subscriber_socket in events:
+                # Only the newest frame waits for a worker, older ones are dropped like in receive_latest_frame.
+                # Copied, the pixels are kept until the worker's result is published.
+                self.pending = receive_latest_frame(subscriber_socket, copy=True)
+            if self.pending is not None:
+                self.dispatch(router)
+            for (pixels, metadata, shape), (labels, mirror_axes) in self.reorder.release():
+                self.cnn.publish(publisher, labels, shape, pixels, metadata, mirror_axes)
+        publisher.close()
+        router.close()
+        subscriber_socket.close()
+
+    def receive(self, message):
+        identity, header, *payload = message
+        if header == READY:
+            run, last_sequence = READY_STATE.unpack(payload[0])
+            if identity not in self.workers:
+                self.workers.append(identity)
+            if self.runs.get(identity) != run:
+                # New worker process, a frame sent to the old one is lost.
+                self.runs[identity] = run
+                self.busy.pop(identity, None)
+            elif last_sequence >= self.busy.get(identity, -1):
+                self.busy.pop(identity, None)
+            if not self.ready:
+                # The CNN is ready once the first worker has its model, the UI enables the dependent checkboxes.
+                self.ready = True
+                self.control.publish_port("cnn", self.cnn.PUBLISH_PORT)
+                self.control.emit("ready")
+            return
+        sequence, rows, columns = JOB.unpack(header)
+        self.busy.pop(identity, None)
+        labels, mirror_axes = payload
+        if labels:
+            labels = np.frombuffer(labels, dtype=np.uint8).reshape((rows, columns))
+            self.reorder.completed(sequence, (labels, tuple(mirror_axes)))
+        else:
+            self.reorder.completed(sequence, None)
+
+    def idle_worker(self):
+        """
+        :return: identity of the next idle worker after the last one used, None if all are busy.
+        """
+        for offset in range(len(self.workers)):
+            index = (self.next_worker + offset) % len(self.workers)
+            if self.workers[index] not in self.busy:
+                self.next_worker = index + 1
+                return self.workers[index]
+        return None
+
+    def dispatch(self, router):
+        identity = self.idle_worker()
+        if identity is None:
+            return
+        pixels, metadata = self.pending
+        self.pending = None
+        image = self.cnn.normalizer.normalize(pixels)
+        self.cnn.input_image_dimensions = (metadata.columns, metadata.rows)
+        self.reorder.dispatched(self.sequence, (pixels, metadata, image.shape))
+        router.send_multipart([identity, JOB.pack(self.sequence, *image.shape), image])
+        self.busy[identity] = self.sequence
+        self.sequence += 1
+
+
+class InferenceWorker:
+
+    def __init__(self, control, cnn, index):
+        """
+        :param cnn: CNNModel that loads the model in this process.
+        """
+        self.control: StageControl = control
+        self.cnn = cnn
+        self.identity = f"worker_{index}".encode()
+        self.run_id = os.urandom(8)
+        self.last_sequence = -1
+
+    def run(self, DEVICE):
+        self.cnn.prepare_engine(DEVICE)
+        context = zmq.Context()
+        socket = context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.IDENTITY, self.identity)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect("tcp://127.0.0.1:" + str(self.control.wait_for_port("cnn_workers")))
+        self.send_ready(socket)
+        last_ready = time.monotonic()
+        while self.control.is_set("cnn_active"):
+            if not socket.poll(100):
+                if time.monotonic() - last_ready > READY_INTERVAL:
+                    self.send_ready(socket)
+                    last_ready = time.monotonic()
+                continue
+            header, pixels = socket.recv_multipart()
+            sequence, rows, columns = JOB.unpack(header)
+            image = np.frombuffer(pixels, dtype=np.uint8).reshape((rows, columns))
+            labels, mirror_axes = self.cnn.predict_tta(image)
+            self.last_sequence = sequence
+            # The result tells the dispatcher this worker is idle again.
+            last_ready = time.monotonic()
+            if labels is None:
+                socket.send_multipart([header, b"", b""])
+                continue
+            labels = np.ascontiguousarray(labels, dtype=np.uint8)
+            socket.send_multipart([JOB.pack(sequence, *labels.shape), labels, bytes(mirror_axes)])
+        socket.close()
+        context.term()
+
+    def send_ready(self, socket):
+        socket.send_multipart([READY, READY_STATE.pack(self.run_id, self.last_sequence)])
@@ -0,0 +1,118 @@
+"""
+Latency logs, written in the background.
+
+File layout: MAGIC, one line of json (numpy dtype of a record), then fixed size binary records.
+Records are appended in batches, so a file can be read with np.memmap / np.fromfile at any time
+(a partly written last record is ignored by read_latency_log).
+"""
+
+import json
+import time
+import atexit
+import threading
+from collections import deque
+import numpy as np
+from frame_trace import STAGES
+
+MAGIC = b"LATLOG1\n"
+LOG_EXTENSION = ".latlog"
+# acquisition: seconds since midnight of the scanner acquisition time (the old image_id),
+# logged: time.time() when the stage logged the frame, stage_times: frame_trace stamps.
+RECORD_DTYPE = np.dtype([("trace_id", "<u8"), ("frame_id", "<u4"), ("acquisition", "<f8"), ("logged", "<f8"),
+                         ("latency", "<f8"), ("stage_times", "<f8", (len(STAGES),))])
+
+
+class LatencyLogger:
+    """
+    log() only appends a tuple to a deque, a background thread turns the pending records into one numpy
+    array and writes it with a single call. It flushes every flush_interval seconds, or earlier when
+    batch_size records are pending. Records of a terminated process since the last flush are lost.
+    """
+
+    def __init__(self, filename, flush_interval=1.0, batch_size=256):
+        self.path = filename + LOG_EXTENSION
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = deque()
+        self.wake = threading.Event()
+        self.running = True
+        self.file = open(self.path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC + json.dumps(RECORD_DTYPE.descr).encode() + b"\n")
+            self.file.flush()
+        self.thread = threading.Thread(target=self.run, daemon=True, name=f"LatencyLogger {filename}")
+        self.thread.start()
+
+    def log(self, metadata, acquisition, latency):
+        self.pending.append((metadata.trace_id or 0, metadata.frame_id or 0, acquisition, time.time(), latency,
+                             metadata.stage_times))
+        if len(self.pending) >= self.batch_size:
+            self.wake.set()
+
+    def run(self):
+        while self.running:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        count = len(self.pending)
+        if count == 0:
+            return
+        records = np.empty(count, dtype=RECORD_DTYPE)
+        for index in range(count):
+            records[index] = self.pending.popleft()
+        records.tofile(self.file)
+        self.file.flush()
+
+    def close(self):
+        self.running = False
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+
+
+loggers = {}
+loggers_lock = threading.Lock()
+
+
+def get_latency_logger(filename):
+    """
+    One logger per file and process, created on first use.
+    """
+    logger = loggers.get(filename)
+    if logger is None:
+        with loggers_lock:
+            if filename not in loggers:
+                loggers[filename] = LatencyLogger(filename)
+            logger = loggers[filename]
+    return logger
+
+
+def close_latency_loggers():
+    with loggers_lock:
+        while loggers:
+            loggers.popitem()[1].close()
+
+
+atexit.register(close_latency_loggers)
+
+
+def read_latency_log(path, mmap=True):
+    """
+    :return: structured array of RECORD_DTYPE (memory mapped by default, nothing is read until used).
+    """
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a latency log")
+        dtype = np.dtype([tuple(tuple(part) if isinstance(part, list) else part for part in field)
+                          for field in json.loads(file.readline())])
+        offset = file.tell()
+        file.seek(0, 2)
+        count = (file.tell() - offset) // dtype.itemsize
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    if mmap:
+        return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+    return np.fromfile(path, dtype=dtype, count=count, offset=offset)
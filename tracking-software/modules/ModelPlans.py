@@ -0,0 +1,95 @@
+"""
+
+"""
+
+import os
+import json
+import cv2
+import numpy as np
+
+
+class ModelPlans:
+    """
+    What the nnU-Net model was trained on, from plans.json and dataset.json in the model folder:
+    patch size, spacing and intensity normalization of one configuration.
+    Frames are brought to exactly that before they go in, so nnU-Net's own preprocessing
+    (resampling to the plans spacing, padding to the patch size) has nothing left to do.
+    """
+
+    def __init__(self, path_to_model_directory, configuration="2d"):
+        with open(os.path.join(path_to_model_directory, "plans.json")) as file:
+            plans = json.load(file)
+        with open(os.path.join(path_to_model_directory, "dataset.json")) as file:
+            dataset = json.load(file)
+        self.configuration = plans["configurations"][configuration]
+        # (rows, columns), as the network sees the image.
+        self.patch_size = tuple(self.configuration["patch_size"])
+        # 2D models still get a 3D spacing, the first axis is the (unused) slice direction.
+        spacing = self.configuration["spacing"]
+        if len(spacing) == 2:
+            spacing = [plans["original_median_spacing_after_transp"][0]] + spacing
+        self.spacing = tuple(spacing)
+        # The network downsamples by this much per axis, inputs have to be a multiple of it.
+        strides = (self.configuration.get("architecture", {}).get("arch_kwargs", {}).get("strides")
+                   or self.configuration.get("pool_op_kernel_sizes", []))
+        self.size_divisor = tuple(int(np.prod([stride[axis] for stride in strides]))
+                                  for axis in range(len(self.patch_size)))
+        self.normalization_schemes = self.configuration["normalization_schemes"]
+        self.intensity_properties = plans["foreground_intensity_properties_per_channel"]
+        self.channel_names = dataset["channel_names"]
+        self.labels = dataset["labels"]
+        self.file_ending = dataset.get("file_ending")
+        self.input = np.empty((1, 1) + self.patch_size, dtype=np.float32)
+
+    @property
+    def properties(self):
+        """
+        The props nnUNetPredictor.predict_single_npy_array wants with the image.
+        """
+        return {"spacing": self.spacing}
+
+    def preprocess(self, image):
+        """
+        :param image: 2D uint8 frame (FrameNormalizer output).
+        :return: (1, 1, rows, columns) float32 at the patch size. The buffer is reused on the next call.
+        NoNormalization: the network gets the values as they were in the training images (0-255 png),
+        the other schemes are applied by nnU-Net itself on these same values.
+        """
+        if image.shape != self.patch_size:
+            # cv2 wants (width, height)
+            image = cv2.resize(image, self.patch_size[::-1], interpolation=cv2.INTER_LINEAR)
+        self.input[0, 0] = image
+        return self.input
+
+    def normalize(self, array, channel=0):
+        """
+        The normalization nnU-Net's preprocessor would apply, in place on float32 input.
+        Only needed when nnU-Net's preprocessing is skipped (InferenceEngine), the predictor does it itself.
+        """
+        scheme = self.normalization_schemes[channel]
+        if scheme == "NoNormalization":
+            return array
+        if scheme == "ZScoreNormalization":
+            array -= array.mean()
+            array /= max(array.std(), 1e-8)
+        elif scheme == "CTNormalization":
+            properties = self.intensity_properties[str(channel)]
+            np.clip(array, properties["percentile_00_5"], properties["percentile_99_5"], out=array)
+            array -= properties["mean"]
+            array /= max(properties["std"], 1e-8)
+        elif scheme == "RescaleTo01Normalization":
+            array -= array.min()
+            array /= max(array.max(), 1e-8)
+        else:
+            raise ValueError(f"Normalization {scheme} is not supported outside of nnU-Net")
+        return array
+
+    def postprocess(self, segmentation, shape):
+        """
+        :param segmentation: 2D label map at the patch size.
+        :param shape: (rows, columns) of the original frame.
+        """
+        if segmentation.shape == tuple(shape):
+            return segmentation
+        # Labels, no interpolation between them.
+        return cv2.resize(segmentation, tuple(shape)[::-1], interpolation=cv2.INTER_NEAREST)
@@ -0,0 +1,228 @@
+"""
+Runs the websocket, CNN and tracking stages (and the Access-i gateway) in their own processes.
+The CNN can have worker processes of its own (InferencePool), they run as stages "cnn_worker_<index>".
+Each stage gets a StageControl (StageControl.py) instead of the main window.
+"""
+
+import os
+import time
+import queue
+import multiprocessing
+from threading import Thread
+from PySide6.QtCore import Signal, QObject, QTimer
+from StageControl import StageControl
+
+PORT_NAMES = ("websocket", "cnn", "tracking", "tracking_raw_coordinate", "gateway", "cnn_workers",
+              "tracking_feedback")
+FLAG_NAMES = ("websocket_active", "cnn_active", "tracking_active", "gateway_active", "save_latency", "raw16bit",
+              "move_slice")
+ACCESS_CONFIG_FIELDS = ("ip_address", "port", "version", "websocket_port", "protocol", "websocket_protocol", "session_id",
+                        "ssl_verify", "timeout", "gateway_port")
+
+
+def set_cpu_affinity(cores):
+    if not cores:
+        return
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+        return
+    try:
+        import psutil
+        psutil.Process().cpu_affinity(list(cores))
+    except ImportError:
+        print("CPU affinity not set, psutil is not installed.")
+
+
+def default_affinity():
+    """
+    Websocket and tracking get a core each, the CNN the rest. The UI process is left unpinned.
+    """
+    cores = list(range(os.cpu_count() or 1))
+    if len(cores) < 4:
+        return {}
+    return {"websocket": [cores[0]], "tracking": [cores[1]], "cnn": cores[2:]}
+
+
+def access_config_snapshot(access):
+    return {field: getattr(access.config, field) for field in ACCESS_CONFIG_FIELDS}
+
+
+def run_stage(name, control: StageControl, access_config, cores, kwargs):
+    """
+    Entry point of a stage process (or thread).
+    """
+    set_cpu_affinity(cores)
+    if cores:
+        # Torch / OpenCV should not spawn more threads than the stage has cores.
+        os.environ.setdefault("OMP_NUM_THREADS", str(len(cores)))
+    import accessi_local as Access
+    for field, value in access_config.items():
+        setattr(Access.config, field, value)
+    try:
+        if name == "websocket":
+            from AccessiWebsocket import AccessiWebsocket
+            AccessiWebsocket(control=control, **kwargs).run_websocket_thread()
+        elif name == "cnn":
+            from CNNModel import CNNModel
+            device = kwargs.pop("device")
+            CNNModel(control=control, **kwargs).start(device)
+        elif name.startswith("cnn_worker"):
+            from CNNModel import CNNModel
+            from InferencePool import InferenceWorker
+            device = kwargs.pop("device")
+            index = kwargs.pop("index")
+            InferenceWorker(control, CNNModel(control=control, **kwargs), index).run(device)
+        elif name == "tracking":
+            from GuidewireTracking import GuidewireTracking
+            GuidewireTracking(control=control, **kwargs).start()
+        elif name == "gateway":
+            from AccessiGateway import AccessiGateway
+            AccessiGateway(control=control, **kwargs).run()
+    except Exception as error:
+        control.emit("error", str(error))
+        raise
+
+
+class PipelineSupervisor(QObject):
+    """
+    Starts the stages, forwards their status to the UI (stage_status_signal: stage, kind, text)
+    and watches their health. A stage that dies while it should be active is restarted on the same ports.
+    """
+    stage_status_signal = Signal(str, str, str)
+
+    def __init__(self, use_processes=True, affinity=None, max_restarts=2, poll_interval_ms=100):
+        super().__init__()
+        self.use_processes = use_processes
+        self.affinity = default_affinity() if affinity is None else affinity
+        self.max_restarts = max_restarts
+        self.status_queue = multiprocessing.Queue()
+        self.ports = {name: multiprocessing.Value("i", 0) for name in PORT_NAMES}
+        self.flags = {name: multiprocessing.Event() for name in FLAG_NAMES}
+        self.stages = {}
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.poll)
+        self.timer.start(poll_interval_ms)
+
+    def set_flag(self, name, value):
+        if value:
+            self.flags[name].set()
+        else:
+            self.flags[name].clear()
+
+    def port(self, name):
+        return self.ports[name].value or None
+
+    def is_running(self, name):
+        return name in self.stages and self.stages[name]["worker"].is_alive()
+
+    def start_stage(self, name, access_config, **kwargs):
+        if self.is_running(name):
+            self.resume_stage(self.stages[name])
+            return
+        self.set_flag(f"{name}_active", True)
+        restarts = self.stages[name]["restarts"] if name in self.stages else 0
+        self.stages[name] = {"access_config": access_config, "kwargs": kwargs, "restarts": restarts,
+                             "stop_deadline": None, "flag": f"{name}_active", "cores": self.affinity.get(name)}
+        self.launch(name)
+
+    def start_workers(self, name, count, access_config, **kwargs):
+        """
+        Worker processes of a stage, "<name>_worker_<index>". They run and stop with the stage's flag
+        and share its cores, every worker gets its own block of them.
+        """
+        cores = self.affinity.get(name) or []
+        for index in range(count):
+            worker_name = f"{name}_worker_{index}"
+            if self.is_running(worker_name):
+                self.resume_stage(self.stages[worker_name])
+                continue
+            restarts = self.stages[worker_name]["restarts"] if worker_name in self.stages else 0
+            worker_cores = cores[index * len(cores) // count:(index + 1) * len(cores) // count]
+            self.stages[worker_name] = {"access_config": access_config, "kwargs": dict(kwargs, index=index),
+                                        "restarts": restarts, "stop_deadline": None, "flag": f"{name}_active",
+                                        "cores": worker_cores or None}
+            self.launch(worker_name)
+
+    def resume_stage(self, stage):
+        """
+        Started again within the grace period of stop_stage: the stage keeps running if its loop has not seen
+        the cleared flag yet, else it is launched again when it exits (without counting as a restart).
+        """
+        if stage["stop_deadline"] is None:
+            return
+        self.set_flag(stage["flag"], True)
+        stage["stop_deadline"] = None
+        stage["resume_on_exit"] = True
+
+    def launch(self, name):
+        stage = self.stages[name]
+        control = StageControl(name, self.status_queue, self.ports, self.flags)
+        cores = stage["cores"] if self.use_processes else None
+        args = (name, control, stage["access_config"], cores, dict(stage["kwargs"]))
+        if self.use_processes:
+            worker = multiprocessing.Process(target=run_stage, args=args, daemon=True, name=name)
+        else:
+            worker = Thread(target=run_stage, args=args, daemon=True, name=name)
+        worker.start()
+        stage["worker"] = worker
+        pid = worker.pid if self.use_processes else os.getpid()
+        self.stage_status_signal.emit(name, "health", f"running (pid {pid}, cores {cores or 'all'})")
+
+    def stop_stage(self, name, grace_period=2):
+        """
+        Stage loops exit on their own when the flag is cleared, a process stuck on a socket is terminated
+        after the grace period. Worker stages of the stage stop with it.
+        """
+        flag = f"{name}_active"
+        self.set_flag(flag, False)
+        for stage in self.stages.values():
+            if stage["flag"] == flag:
+                stage["stop_deadline"] = time.monotonic() + grace_period
+
+    def stop_all(self, gateway_grace_period=3):
+        """
+        The gateway is given time to exit on its own first, its close() deregisters the sessions
+        other clients (3D Suite) left behind on the scanner.
+        """
+        for stage in self.stages.values():
+            self.set_flag(stage["flag"], False)
+        if "gateway" in self.stages:
+            self.stages["gateway"]["worker"].join(gateway_grace_period)
+        for stage in self.stages.values():
+            worker = stage["worker"]
+            if self.use_processes and worker.is_alive():
+                worker.terminate()
+
+    def poll(self):
+        while True:
+            try:
+                name, kind, text = self.status_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.stage_status_signal.emit(name, kind, text)
+        for name, stage in self.stages.items():
+            self.check_health(name, stage)
+
+    def check_health(self, name, stage):
+        worker = stage["worker"]
+        if worker.is_alive():
+            if stage["stop_deadline"] is not None and time.monotonic() > stage["stop_deadline"]:
+                if self.use_processes:
+                    worker.terminate()
+                stage["stop_deadline"] = None
+            return
+        if stage.get("reported_exit") is worker:
+            return
+        stage["reported_exit"] = worker
+        exit_code = worker.exitcode if self.use_processes else None
+        if not self.flags[stage["flag"]].is_set():
+            self.stage_status_signal.emit(name, "health", "stopped")
+        elif stage.pop("resume_on_exit", False):
+            self.launch(name)
+        elif stage["restarts"] < self.max_restarts:
+            stage["restarts"] += 1
+            self.stage_status_signal.emit(name, "health", f"exited ({exit_code}), restart "
+                                                          f"{stage['restarts']}/{self.max_restarts}")
+            self.launch(name)
+        else:
+            self.stage_status_signal.emit(name, "health", f"exited ({exit_code}), not restarted")
@@ -0,0 +1,86 @@
+"""
+Region of interest inference: the CNN runs only on windows around the markers GuidewireTracking is following.
+
+GuidewireTracking sends the positions of its trackers after every frame on the "tracking_feedback" port
+(pack_tracker_positions), the CNN stage keeps the newest ones in TrackedRegions and asks it per frame which
+windows to infer. A full frame pass is still done every full_frame_interval frames (new markers only show up
+there), when a track is lost, when there are no trackers and when the positions are old.
+"""
+
+import time
+import struct
+import numpy as np
+
+# frame rows, frame columns, a track is lost, number of positions. (x, y) uint16 pairs follow.
+FEEDBACK = struct.Struct("<HHBH")
+
+
+def pack_tracker_positions(positions, lost, shape):
+    """
+    :param positions: (x, y) pixel coordinates of the tracked markers in the segmentation.
+    :param lost: a tracker did not find its marker in this frame.
+    :param shape: (rows, columns) of the segmentation.
+    """
+    return FEEDBACK.pack(shape[0], shape[1], lost, len(positions)) + np.array(positions, dtype=np.uint16).tobytes()
+
+
+def centred_window(x, y, window_size, patch_size):
+    """
+    :return: (top, left) of the window centred on (x, y), moved inside the frame.
+    """
+    rows, columns = patch_size
+    top = min(max(int(round(y)) - window_size // 2, 0), rows - window_size)
+    left = min(max(int(round(x)) - window_size // 2, 0), columns - window_size)
+    return top, left
+
+
+def unpack_tracker_positions(message):
+    """
+    :return: [(x, y)], lost, (rows, columns)
+    """
+    rows, columns, lost, count = FEEDBACK.unpack_from(message)
+    positions = np.frombuffer(message, dtype=np.uint16, count=count * 2, offset=FEEDBACK.size).reshape((count, 2))
+    return [tuple(position) for position in positions.tolist()], bool(lost), (rows, columns)
+
+
+class TrackedRegions:
+    """
+    Picks the windows for the next frame from the newest tracker positions, in network input (patch) coordinates.
+    """
+
+    def __init__(self, window_size, patch_size, full_frame_interval=10, max_age=0.5):
+        """
+        :param window_size: side of the square windows in pixels, a multiple of ModelPlans.size_divisor.
+        :param full_frame_interval: every this many frames the whole frame is inferred.
+        :param max_age: seconds after which tracker positions are too old to place windows.
+        """
+        self.window_size = window_size
+        self.patch_size = patch_size
+        self.full_frame_interval = full_frame_interval
+        self.max_age = max_age
+        self.positions = []
+        self.lost = True
+        self.received = 0.0
+        self.frames_since_full_frame = 0
+
+    def update(self, message):
+        positions, self.lost, (rows, columns) = unpack_tracker_positions(message)
+        # Tracker positions are in frame pixels, the network sees the frame resized to the patch size.
+        scale_x, scale_y = self.patch_size[1] / columns, self.patch_size[0] / rows
+        self.positions = [(x * scale_x, y * scale_y) for x, y in positions]
+        self.received = time.monotonic()
+
+    def windows(self):
+        """
+        :return: [(top, left)] of the windows for the next frame, None for a full frame pass.
+        """
+        full_frame = (self.lost or not self.positions or time.monotonic() - self.received > self.max_age
+                      or self.frames_since_full_frame + 1 >= self.full_frame_interval)
+        windows = None if full_frame else sorted({centred_window(x, y, self.window_size, self.patch_size)
+                                                  for x, y in self.positions})
+        # Windows that together cover as much as the frame are no cheaper than the frame.
+        if windows is None or len(windows) * self.window_size ** 2 >= self.patch_size[0] * self.patch_size[1]:
+            self.frames_since_full_frame = 0
+            return None
+        self.frames_since_full_frame += 1
+        return windows
@@ -0,0 +1,133 @@
+"""
+Raw imageStream recording.
+
+A session is two append-only files:
+    <name>.mrisession  MAGIC, then per frame the binary frame header (binary_frame.HEADER) and the raw uint16 pixels,
+                       each frame starting at an 8 byte aligned offset.
+    <name>.mrisession.idx  one INDEX_DTYPE record per frame, written after the frame itself is on disk,
+                           so every indexed frame is complete even if the recorder was killed.
+SessionReader memory maps both, frames are numpy views straight into the file (nothing is loaded into RAM).
+"""
+
+import os
+import threading
+from collections import deque
+import numpy as np
+from binary_frame import HEADER, unpack_header
+from shared_methods import acquisition_seconds
+
+MAGIC = b"MRISESS1"
+SESSION_EXTENSION = ".mrisession"
+INDEX_EXTENSION = ".idx"
+ALIGNMENT = 8
+HEADER_SIZE = -(-HEADER.size // ALIGNMENT) * ALIGNMENT
+INDEX_DTYPE = np.dtype([("offset", "<u8"), ("pixel_bytes", "<u4"), ("columns", "<u2"), ("rows", "<u2")])
+
+
+class SessionRecorder:
+    """
+    record() only queues the (already packed) frame, a background thread appends it to the session.
+    """
+
+    def __init__(self, path, flush_interval=0.5):
+        if not path.endswith(SESSION_EXTENSION):
+            path += SESSION_EXTENSION
+        self.path = path
+        self.flush_interval = flush_interval
+        self.data_file = open(path, "ab")
+        self.index_file = open(path + INDEX_EXTENSION, "ab")
+        if self.data_file.tell() == 0:
+            self.data_file.write(MAGIC)
+        self.offset = self.data_file.tell()
+        self.pending = deque()
+        self.wake = threading.Event()
+        self.running = True
+        self.frame_count = 0
+        self.thread = threading.Thread(target=self.run, daemon=True, name="SessionRecorder")
+        self.thread.start()
+
+    def record(self, frame):
+        """
+        :param frame: [header, pixels] from binary_frame.pack_frame
+        """
+        self.pending.append(frame)
+        self.wake.set()
+
+    def run(self):
+        while self.running:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.write_pending()
+
+    def write_pending(self):
+        if not self.pending:
+            return
+        index = []
+        while self.pending:
+            header, pixels = self.pending.popleft()
+            metadata = unpack_header(header)
+            padding = -(self.offset + HEADER_SIZE + len(pixels)) % ALIGNMENT
+            self.data_file.write(header)
+            self.data_file.write(bytes(HEADER_SIZE - len(header)))
+            self.data_file.write(pixels)
+            self.data_file.write(bytes(padding))
+            index.append((self.offset, len(pixels), metadata.columns, metadata.rows))
+            self.offset += HEADER_SIZE + len(pixels) + padding
+        self.data_file.flush()
+        np.array(index, dtype=INDEX_DTYPE).tofile(self.index_file)
+        self.index_file.flush()
+        self.frame_count += len(index)
+
+    def close(self):
+        self.running = False
+        self.wake.set()
+        self.thread.join()
+        self.write_pending()
+        self.data_file.close()
+        self.index_file.close()
+
+
+class SessionReader:
+    """
+    reader[i] -> (uint16 image view, FrameMetadata). The views are read only and point into the memory map,
+    copy them if the reader is closed before they are used.
+    """
+
+    def __init__(self, path):
+        if not path.endswith(SESSION_EXTENSION):
+            path += SESSION_EXTENSION
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        if bytes(self.data[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a recorded session")
+        # A half written last index record (recorder killed) is ignored.
+        count = os.path.getsize(path + INDEX_EXTENSION) // INDEX_DTYPE.itemsize
+        if count:
+            self.index = np.memmap(path + INDEX_EXTENSION, dtype=INDEX_DTYPE, mode="r", shape=(count,))
+        else:
+            self.index = np.empty(0, dtype=INDEX_DTYPE)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, position):
+        entry = self.index[position]
+        offset = int(entry["offset"])
+        metadata = unpack_header(self.data[offset:offset + HEADER.size].tobytes())
+        image = self.data[offset + HEADER_SIZE:offset + HEADER_SIZE + int(entry["pixel_bytes"])].view(np.uint16)
+        return image.reshape((int(entry["columns"]), int(entry["rows"]))), metadata
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def acquisition_times(self):
+        """
+        :return: acquisition time of every frame (seconds since midnight), e.g. to replay at the recorded rate.
+        """
+        return np.array([acquisition_seconds(self[position][1].acquisition_time) for position in range(len(self))])
+
+    def close(self):
+        # The mapping itself goes away with the last view into it.
+        self.data = None
+        self.index = None
@@ -0,0 +1,221 @@
+"""
+
+"""
+
+import os
+import time
+import struct
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+RING_MAGIC = b"RING"
+# magic, slot, sequence, writer id, ring generation (creation time), ring name length (name follows)
+NOTIFICATION = struct.Struct("<4sIQIQH")
+# sequence, metadata length, number of arrays
+SLOT_HEADER = struct.Struct("<QII")
+# dtype, shape (up to 3 dimensions, 0 = unused), nbytes. An empty dtype marks a missing (None) array.
+ARRAY_HEADER = struct.Struct("<4sIIII")
+MAX_ARRAYS = 4
+METADATA_SIZE = 4096
+SLOT_OVERHEAD = SLOT_HEADER.size + MAX_ARRAYS * ARRAY_HEADER.size + METADATA_SIZE
+
+
+class SharedFrameRing:
+    """
+    Zero-copy frame transport between stages.
+    The writer owns a shared memory block split into fixed size slots, each frame goes into the next slot
+    and only a small notification (ring name, slot, sequence) is sent over ZMQ.
+    Readers attach to the same memory and get numpy views straight into the slot.
+
+    A writer that needs a bigger ring (or restarts) creates a new one, the writer id and generation in the
+    notification tell readers to let go of the ring that writer used before.
+
+    Readers are expected to use CONFLATE (latest wins) on the notification socket. A slot stays valid until the
+    writer comes around again, i.e. for slot_count frames. Anything that holds a frame longer reads it with copy=True.
+    The slot sequence works like a seqlock: the writer sets it to 0 while it writes, readers check it again after
+    they read, so a frame the writer came around to while it was read is dropped instead of torn.
+    """
+
+    def __init__(self, slot_size, slot_count=16, name=None, writer=0):
+        """
+        :param slot_size: bytes available for arrays in one slot.
+        :param name: attach to an existing ring (reader). None creates a new ring (writer).
+        :param writer: id of the writer, the same for all rings it creates (also after a restart), see RingWriter.
+        """
+        self.owner = name is None
+        self.writer = writer
+        self.generation = time.time_ns()
+        if self.owner:
+            self.slot_size = SLOT_OVERHEAD + slot_size
+            self.slot_count = slot_count
+            self.shm = shared_memory.SharedMemory(create=True, size=self.slot_size * slot_count + 8)
+            struct.pack_into("<II", self.shm.buf, 0, self.slot_size, self.slot_count)
+        else:
+            self.shm = attach_shared_memory(name)
+            self.slot_size, self.slot_count = struct.unpack_from("<II", self.shm.buf, 0)
+        self.name = self.shm.name
+        self.sequence = 0
+        if self.owner:
+            # Readers in the same process (stages running as threads) use the writer's mapping.
+            attached_rings[self.name] = self
+
+    def slot_offset(self, slot):
+        return 8 + slot * self.slot_size
+
+    def fits(self, arrays):
+        return sum(array.nbytes for array in arrays if array is not None) <= self.slot_size - SLOT_OVERHEAD
+
+    def write(self, metadata: bytes, arrays):
+        """
+        :param metadata: small bytes blob (binary frame header, pickled ImageData without arrays, ...)
+        :param arrays: list of numpy arrays or None, returned in the same order by read().
+        :return: notification bytes to send to the readers.
+        """
+        if len(metadata) > METADATA_SIZE or len(arrays) > MAX_ARRAYS or not self.fits(arrays):
+            raise ValueError(f"Frame does not fit in a slot of ring {self.name}")
+        self.sequence += 1
+        slot = self.sequence % self.slot_count
+        offset = self.slot_offset(slot)
+        buffer = self.shm.buf
+        # Sequence 0 while writing, readers holding the old sequence see it is gone.
+        SLOT_HEADER.pack_into(buffer, offset, 0, len(metadata), len(arrays))
+        descriptor_offset = offset + SLOT_HEADER.size
+        metadata_offset = descriptor_offset + MAX_ARRAYS * ARRAY_HEADER.size
+        buffer[metadata_offset:metadata_offset + len(metadata)] = metadata
+        data_offset = metadata_offset + METADATA_SIZE
+        for index, array in enumerate(arrays):
+            if array is None:
+                ARRAY_HEADER.pack_into(buffer, descriptor_offset + index * ARRAY_HEADER.size, b"", 0, 0, 0, 0)
+                continue
+            shape = tuple(array.shape) + (0,) * (3 - array.ndim)
+            ARRAY_HEADER.pack_into(buffer, descriptor_offset + index * ARRAY_HEADER.size,
+                                   array.dtype.str.encode(), *shape, array.nbytes)
+            target = np.ndarray(array.shape, dtype=array.dtype, buffer=buffer, offset=data_offset)
+            np.copyto(target, array)
+            data_offset += array.nbytes
+        SLOT_HEADER.pack_into(buffer, offset, self.sequence, len(metadata), len(arrays))
+        name = self.name.encode()
+        return NOTIFICATION.pack(RING_MAGIC, slot, self.sequence, self.writer, self.generation, len(name)) + name
+
+    def read(self, slot, sequence, copy=False):
+        """
+        :param copy: copy the arrays out of the slot. Without it they are views into shared memory,
+            is_current tells if they are still intact after they were used.
+        :return: metadata bytes and list of arrays, or None if the slot was overwritten before or while it was read.
+        """
+        offset = self.slot_offset(slot)
+        buffer = self.shm.buf
+        current, metadata_length, array_count = SLOT_HEADER.unpack_from(buffer, offset)
+        if current != sequence:
+            return None
+        descriptor_offset = offset + SLOT_HEADER.size
+        metadata_offset = descriptor_offset + MAX_ARRAYS * ARRAY_HEADER.size
+        metadata = bytes(buffer[metadata_offset:metadata_offset + metadata_length])
+        data_offset = metadata_offset + METADATA_SIZE
+        arrays = []
+        for index in range(array_count):
+            dtype, d0, d1, d2, nbytes = ARRAY_HEADER.unpack_from(buffer, descriptor_offset + index * ARRAY_HEADER.size)
+            dtype = dtype.rstrip(b"\x00")
+            if not dtype:
+                arrays.append(None)
+                continue
+            shape = tuple(dimension for dimension in (d0, d1, d2) if dimension)
+            array = np.ndarray(shape, dtype=np.dtype(dtype.decode()), buffer=buffer, offset=data_offset)
+            if copy:
+                array = array.copy()
+            else:
+                array.flags.writeable = False
+            arrays.append(array)
+            data_offset += nbytes
+        if not self.is_current(slot, sequence):
+            return None
+        return metadata, arrays
+
+    def is_current(self, slot, sequence):
+        return SLOT_HEADER.unpack_from(self.shm.buf, self.slot_offset(slot))[0] == sequence
+
+    def close(self):
+        if self.owner:
+            attached_rings.pop(self.name, None)
+            self.shm.unlink()
+        try:
+            self.shm.close()
+        except BufferError:
+            # A reader still holds a view, the mapping goes away with the last view.
+            pass
+
+
+attached_rings = {}
+# writer id -> (generation, name) of the newest ring of that writer this process attached to
+writer_rings = {}
+
+
+def attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 registers attached memory too, and the tracker would unlink it when this process exits.
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == "posix":
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def is_notification(message) -> bool:
+    return bytes(message[:len(RING_MAGIC)]) == RING_MAGIC
+
+
+def read_notification(message, copy=False):
+    """
+    :param message: notification bytes/memoryview (as created by SharedFrameRing.write).
+    :param copy: see SharedFrameRing.read
+    :return: metadata bytes and arrays, None if the frame was overwritten before it was read.
+    """
+    _, slot, sequence, writer, generation, name_length = NOTIFICATION.unpack_from(message, 0)
+    name = bytes(message[NOTIFICATION.size:NOTIFICATION.size + name_length]).decode()
+    current = writer_rings.get(writer)
+    if current is not None and current[1] != name:
+        if generation < current[0]:
+            # From a ring the writer already replaced.
+            return None
+        # The writer moved to a new ring, the old one is not used anymore.
+        old_ring = attached_rings.get(current[1])
+        if old_ring is not None and not old_ring.owner:
+            del attached_rings[current[1]]
+            old_ring.close()
+    if name not in attached_rings:
+        try:
+            attached_rings[name] = SharedFrameRing(slot_size=None, name=name)
+        except FileNotFoundError:
+            # Already unlinked by the writer.
+            return None
+    writer_rings[writer] = (generation, name)
+    return attached_rings[name].read(slot, sequence, copy)
+
+
+class RingWriter:
+    """
+    Creates the ring on the first frame, sized for that frame, and a new one if a later frame does not fit
+    (e.g. resolution changed). Readers attach by the name in the notification so they follow along.
+    """
+
+    def __init__(self, writer, slot_count=16):
+        """
+        :param writer: id that stays the same when the stage restarts, e.g. the port the notifications go out on.
+        """
+        self.writer = writer
+        self.slot_count = slot_count
+        self.ring = None
+
+    def write(self, metadata: bytes, arrays):
+        if self.ring is None or not self.ring.fits(arrays):
+            if self.ring is not None:
+                self.ring.close()
+            needed = sum(array.nbytes for array in arrays if array is not None)
+            self.ring = SharedFrameRing(slot_size=2 * needed, slot_count=self.slot_count, writer=self.writer)
+        return self.ring.write(metadata, arrays)
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
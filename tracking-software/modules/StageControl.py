@@ -0,0 +1,49 @@
+"""
+What a stage gets instead of the main window, so it can run in its own process:
+the UI checkboxes become multiprocessing Events, the ports a stage binds are shared through
+multiprocessing Values and status text goes back to the UI over a Queue.
+"""
+
+import time
+
+
+class StageControl:
+    """
+    Everything a stage needs from the outside. Picklable, so it can be handed to a stage process.
+    """
+
+    def __init__(self, name, status_queue, ports, flags):
+        self.name = name
+        self.status_queue = status_queue
+        self.ports = ports
+        self.flags = flags
+
+    def is_set(self, flag):
+        return self.flags[flag].is_set()
+
+    def emit(self, kind, text=""):
+        self.status_queue.put((self.name, kind, text))
+
+    def port(self, name):
+        """
+        :return: previously bound port (to re-bind the same port after a restart), None if not bound yet.
+        """
+        return self.ports[name].value or None
+
+    def publish_port(self, name, port):
+        self.ports[name].value = port
+
+    def wait_for_port(self, name, poll_interval=0.05):
+        while not self.ports[name].value:
+            time.sleep(poll_interval)
+        return self.ports[name].value
+
+
+def bind_port(socket, port=None):
+    """
+    Binds to the given port (restarted stage keeps its address for the subscribers) or a random one.
+    """
+    if port:
+        socket.bind(f"tcp://127.0.0.1:{port}")
+        return port
+    return socket.bind_to_random_port("tcp://127.0.0.1")
@@ -4,10 +4,12 @@
 import os
 import cv2
 import zmq
-import pickle
 from datetime import datetime
 from ImageData import ImageData
-from shared_methods import convert_websocket_data_to_image
+from ImagePublisher import subscribe_image_data, receive_image_data
+from FrameNormalizer import FrameNormalizer
+from binary_frame import unpack_frame
+from frame_trace import mark, StageLatencyWindow
 
 
 class VideoViewer:
@@ -20,6 +22,8 @@ class VideoViewer:
         self.save_images_button = save_images_button
         self.save_images_folder = save_images_folder
         self.window = window
+        self.normalizer = FrameNormalizer()
+        self.latency_window = StageLatencyWindow()
 
     def start(self):
         if self.zmq_port is None:
@@ -29,19 +33,23 @@ class VideoViewer:
         context = zmq.Context()
         subscriber_socket = context.socket(zmq.SUB)
         subscriber_socket.connect("tcp://127.0.0.1:" + str(self.zmq_port))
-        subscriber_socket.subscribe("")
+        if self.websocket:
+            subscriber_socket.subscribe("")
+        else:
+            subscribe_image_data(subscriber_socket, pixels=False)
         subscriber_socket.RCVTIMEO = 200
 
         while self.checkbox.isChecked():
             try:
-                data = subscriber_socket.recv()
                 if self.websocket:
-                    image, metadata = convert_websocket_data_to_image(data)
+                    image, metadata = unpack_frame(subscriber_socket.recv_multipart(copy=False))
                     if image is None:
-                        cv2.waitKey(1)
                         continue
+                    image = self.normalizer.normalize(image)
                 else:
-                    imagedata: ImageData = pickle.loads(data)
+                    imagedata: ImageData = receive_image_data(subscriber_socket)
+                    if imagedata is None:
+                        continue
                     image = imagedata.image
                     metadata = imagedata.metadata
                 selected_resolution_text = self.window.ui.combo_show_output_dimensions.currentText()
@@ -49,10 +57,12 @@ class VideoViewer:
                 resized_image = cv2.resize(image, (width, height))
                 cv2.imshow(self.window_name, resized_image)
                 cv2.waitKey(1)
+                mark(metadata, "rendered")
+                self.latency_window.add(metadata)
                 if self.save_images_button.isChecked():
                     save_folder = os.path.join(self.window.ui.field_output_directory.text(), self.save_images_folder)
                     os.makedirs(save_folder, exist_ok=True)
-                    timestamp = datetime.strptime(metadata.value.image.acquisition.time, '%H%M%S.%f')
+                    timestamp = datetime.strptime(metadata.acquisition_time, '%H%M%S.%f')
                     filename = f"{timestamp.strftime('%H%M%S.%f')[:-3]}.jpg"
                     cv2.imwrite(os.path.join(save_folder, filename), resized_image)
             except zmq.error.Again:
@@ -63,6 +73,8 @@ class VideoViewer:
                 print(f"Error: {e}")
                 break
         else:
+            if self.latency_window.count:
+                print(f"{self.window_name}: {self.latency_window.summary()}")
             try:
                 cv2.destroyWindow(self.window_name)
             except:
@@ -13,14 +13,22 @@ Only insecure HTTPS is currently supported.
 
 from types import SimpleNamespace
 from math import atan2, degrees
-from typing import Literal
+from typing import Literal, get_args, get_origin
+import inspect
 import numpy as np
+import zmq
 import websockets
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
 import asyncio
 import json
 import ssl
+import os
+import time
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -35,9 +43,23 @@ class config:
     version = "v2"
     websocket_port = 7788
     protocol = "https"
+    websocket_protocol = "wss"
     session_id = None
     ssl_verify = False
+    # Seconds (or a (connect, read) tuple) a call may take. Every service call also takes timeout= for itself.
     timeout = 2
+    # Services whose calls take longer than reading or setting a value, e.g. register or opening a template.
+    service_timeouts = {"authorization": 10, "hostControl": 10, "templateExecution": 30, "templateModification": 30}
+    # Keep-alive connections per host (one TLS handshake per connection, not per request).
+    pool_size = 4
+    # Slice geometry from the imageStream / local set calls is used for this long (s) before asking the host again.
+    geometry_max_age = 1.0
+    # After a local set, stream values that differ from it are ignored for this long (s), the host is still applying it.
+    geometry_pending_timeout = 5.0
+    # Local AccessiGateway port, requests go through the gateway (shared session) instead of straight to the host.
+    gateway_port = None
+    # How long the gateway answers a read from its cache (s).
+    gateway_cache_max_age = 0.25
     headers = {"Content-Type": "application/json"}
 
     @staticmethod
@@ -50,7 +72,104 @@ class config:
 
     @staticmethod
     def websocket_default_url():
-        return f"wss://{config.ip_address}:{config.websocket_port}/SRC?sessionId={config.session_id}"
+        return f"{config.websocket_protocol}://{config.ip_address}:{config.websocket_port}/SRC?sessionId={config.session_id}"
+
+
+ORIENTATION_VECTORS = ("normal", "phase", "read")
+
+
+def vector_tuple(value):
+    return value.x, value.y, value.z
+
+
+def vector_object(vector):
+    return SimpleNamespace(x=vector[0], y=vector[1], z=vector[2])
+
+
+def cached_reply(**values):
+    return SimpleNamespace(result=SimpleNamespace(success=True, reason="cached", time=""), **values)
+
+
+class GeometryCache:
+    """
+    Slice geometry (index 0) as last seen in this process: from imageStream frames, replies of get calls and
+    local set calls (write through). The ParameterStandard getters answer from here while the value is younger
+    than config.geometry_max_age, so in steady state (frames coming in) they cost no request.
+
+    Frames still show the old geometry for a while after a set call, so after a local write the stream
+    only replaces the value once it matches (or config.geometry_pending_timeout passed).
+    Values are plain tuples/floats: position (x, y, z), orientation ((normal), (phase), (read)).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.pending = {}
+
+    def get(self, name, max_age=None):
+        with self.lock:
+            entry = self.values.get(name)
+        if entry is None or time.monotonic() - entry[1] > (config.geometry_max_age if max_age is None else max_age):
+            return None
+        return entry[0]
+
+    def write(self, name, value):
+        now = time.monotonic()
+        with self.lock:
+            self.values[name] = (value, now)
+            self.pending[name] = (value, now)
+
+    def observe(self, name, value):
+        now = time.monotonic()
+        with self.lock:
+            pending = self.pending.get(name)
+            if pending is not None:
+                if not np.allclose(pending[0], value, atol=0.5) and now - pending[1] < config.geometry_pending_timeout:
+                    return
+                del self.pending[name]
+            self.values[name] = (value, now)
+
+    def invalidate(self, name=None):
+        with self.lock:
+            if name is None:
+                self.values.clear()
+                self.pending.clear()
+            else:
+                self.values.pop(name, None)
+                self.pending.pop(name, None)
+
+    def update_from_image(self, image):
+        """
+        :param image: response["value"]["image"] of an imageStream message.
+        """
+        coordinates = image.get("coordinates", {}).get("mrSliceDcs", {})
+        if "position" in coordinates:
+            position = coordinates["position"]
+            self.observe("slice_position_dcs", (position["x"], position["y"], position["z"]))
+        if all(name in coordinates for name in ORIENTATION_VECTORS):
+            self.observe("slice_orientation_dcs", tuple((coordinates[name]["x"], coordinates[name]["y"],
+                                                         coordinates[name]["z"]) for name in ORIENTATION_VECTORS))
+        dimensions = image.get("dimensions", {})
+        voxel_size = dimensions.get("voxelSize", {})
+        if "slice" in voxel_size:
+            self.observe("slice_thickness", voxel_size["slice"])
+        if "column" in voxel_size and "columns" in dimensions:
+            # Read FOV = columns * column voxel size (reconstructed image, no oversampling).
+            self.observe("field_of_view_read", voxel_size["column"] * dimensions["columns"])
+
+    def update_from_metadata(self, metadata):
+        """
+        :param metadata: FrameMetadata of a frame from the pipeline (stages other than the websocket).
+        """
+        if metadata.slice_position is not None:
+            self.observe("slice_position_dcs", tuple(metadata.slice_position))
+        if metadata.voxel_size[2]:
+            self.observe("slice_thickness", metadata.voxel_size[2])
+        if metadata.voxel_size[0] and metadata.columns:
+            self.observe("field_of_view_read", metadata.voxel_size[0] * metadata.columns)
+
+
+geometry_cache = GeometryCache()
 
 
 class Remote:
@@ -60,7 +179,7 @@ class Remote:
     """
 
     @staticmethod
-    def get_is_active():
+    def get_is_active(timeout=None):
         """
         Response example:
          - "result": {"success":true,"reason":"ok","time":"20170608_143325.423"},
@@ -68,17 +187,17 @@ class Remote:
          - "isProductionSystem":true
         """
         url = f"{config.base_url_remote()}/getIsActive"
-        return send_request(url, data=None, request_type="GET")
+        return send_request(url, data=None, request_type="GET", timeout=timeout)
 
     @staticmethod
-    def get_version():
+    def get_version(timeout=None):
         """
         Response example:
          - "result": {"success":true,"reason":"ok","time":"20170608_143325.423"},
          - "value":"2.0"
         """
         url = f"{config.base_url_remote()}/getVersion"
-        return send_request(url, data=None, request_type="GET")
+        return send_request(url, data=None, request_type="GET", timeout=timeout)
 
 
 class Authorization:
@@ -95,7 +214,7 @@ class Authorization:
                  expire_date="20400115", system_id="99999999999999", is_read_option_available=True,
                  is_execute_option_available=True, is_advanced_option_available=True, version="1.0",
                  hash="drXXpUNoR8GVxi3GhXL2Gt3S7XSS8MPTyTM75ehUxnfIUBhmmPr%2BL2qTXWnS0csVoGiFoUZS1pVCteO3JxGO7A%3D%3D",
-                 informal_name="utwente"):
+                 informal_name="utwente", timeout=None):
         """
         Response example:
          - "result": {"success":true,"reason":"ok","time":"20170608_143325.423"},
@@ -117,12 +236,12 @@ class Authorization:
             "Hash": hash
         },
             "name": informal_name}
-        reply = send_request(url, data, request_type="POST")
+        reply = send_request(url, data, request_type="POST", timeout=timeout)
         config.session_id = reply.sessionId
         return reply
 
     @staticmethod
-    def get_is_registered():
+    def get_is_registered(timeout=None):
         """
         Response example:
          - result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -131,17 +250,17 @@ class Authorization:
         """
         url = f"{config.base_url()}/authorization/getIsRegistered"
         data = {"sessionId": config.session_id}
-        return send_request(url, data=data, request_type="GET")
+        return send_request(url, data=data, request_type="GET", timeout=timeout)
 
     @staticmethod
-    def deregister():
+    def deregister(timeout=None):
         """
         Response example:
          - result":{"success":true,"reason":"ok","time":"20170608T143325.423"}
         """
         url = f"{config.base_url()}/authorization/deregister"
         data = {"sessionId": config.session_id}
-        return send_request(url, data=data, request_type="POST")
+        return send_request(url, data=data, request_type="POST", timeout=timeout)
 
 
 class HostControl:
@@ -155,7 +274,7 @@ class HostControl:
     """
 
     @staticmethod
-    def get_state():
+    def get_state(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -167,27 +286,27 @@ class HostControl:
         """
         url = f"{config.base_url()}/hostControl/getState"
         data = {"sessionId": config.session_id}
-        return send_request(url, data=data, request_type="GET")
+        return send_request(url, data=data, request_type="GET", timeout=timeout)
 
     @staticmethod
-    def request_host_control():
+    def request_host_control(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"}
         """
         url = f"{config.base_url()}/hostControl/requestControl"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, request_type="POST")
+        return send_request(url, data, request_type="POST", timeout=timeout)
 
     @staticmethod
-    def release_host_control():
+    def release_host_control(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"}
         """
         url = f"{config.base_url()}/hostControl/releaseControl"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, request_type="POST")
+        return send_request(url, data, request_type="POST", timeout=timeout)
 
 
 class SystemInformation:
@@ -198,7 +317,7 @@ class SystemInformation:
     """
 
     @staticmethod
-    def get_system_info():
+    def get_system_info(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -211,10 +330,10 @@ class SystemInformation:
         """
         url = f"{config.base_url()}/systemInformation/getSystemInfo"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, request_type="GET")
+        return send_request(url, data, request_type="GET", timeout=timeout)
 
     @staticmethod
-    def get_isocenter_position():
+    def get_isocenter_position(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -223,10 +342,10 @@ class SystemInformation:
         """
         url = f"{config.base_url()}/systemInformation/getIsocenterPosition"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, request_type="GET")
+        return send_request(url, data, request_type="GET", timeout=timeout)
 
     @staticmethod
-    def get_handball_state():
+    def get_handball_state(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -234,10 +353,10 @@ class SystemInformation:
         """
         url = f"{config.base_url()}/systemInformation/getHandballState"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, request_type="GET")
+        return send_request(url, data, request_type="GET", timeout=timeout)
 
     @staticmethod
-    def get_serial_number():
+    def get_serial_number(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -245,7 +364,7 @@ class SystemInformation:
         """
         url = f"{config.base_url()}/systemInformation/getSerialNumber"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, request_type="GET")
+        return send_request(url, data, request_type="GET", timeout=timeout)
 
 
 class TemplateExecution:
@@ -259,7 +378,7 @@ class TemplateExecution:
     """
 
     @staticmethod
-    def get_templates():
+    def get_templates(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -269,10 +388,10 @@ class TemplateExecution:
         """
         url = f"{config.base_url()}/templateExecution/getTemplates"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def get_state():
+    def get_state(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -291,10 +410,10 @@ class TemplateExecution:
         """
         url = f"{config.base_url()}/templateExecution/getState"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def get_remaining_measurement_time_in_seconds():
+    def get_remaining_measurement_time_in_seconds(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -303,47 +422,47 @@ class TemplateExecution:
         """
         url = f"{config.base_url()}/templateExecution/getRemainingMeasurementTimeInSeconds"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def start(template_id):
+    def start(template_id, timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"}
         """
         url = f"{config.base_url()}/templateExecution/start"
         data = {"sessionId": config.session_id, "id": template_id}
-        return send_request(url, data, "POST")
+        return send_request(url, data, "POST", timeout=timeout)
 
     @staticmethod
-    def stop():
+    def stop(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"}
         """
         url = f"{config.base_url()}/templateExecution/stop"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "POST")
+        return send_request(url, data, "POST", timeout=timeout)
 
     @staticmethod
-    def pause():
+    def pause(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"}
         """
         url = f"{config.base_url()}/templateExecution/pause"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "POST")
+        return send_request(url, data, "POST", timeout=timeout)
 
     @staticmethod
-    def continue_():
+    def continue_(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"}
         """
         url = f"{config.base_url()}/templateExecution/continue"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "POST")
+        return send_request(url, data, "POST", timeout=timeout)
 
 
 class TemplateModification:
@@ -354,7 +473,7 @@ class TemplateModification:
     """
 
     @staticmethod
-    def get_state():
+    def get_state(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -370,27 +489,27 @@ class TemplateModification:
         """
         url = f"{config.base_url()}/templateModification/getState"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def open(template_id):
+    def open(template_id, timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"}
         """
         url = f"{config.base_url()}/templateModification/open"
         data = {"sessionId": config.session_id, "id": template_id}
-        return send_request(url, data, "POST")
+        return send_request(url, data, "POST", timeout=timeout)
 
     @staticmethod
-    def close(save_changes: bool = False):
+    def close(save_changes: bool = False, timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"}
         """
         url = f"{config.base_url()}/templateModification/close"
         data = {"sessionId": config.session_id, "saveChanges": save_changes}
-        return send_request(url, data, "POST")
+        return send_request(url, data, "POST", timeout=timeout)
 
 
 class ParameterStandard:
@@ -408,7 +527,7 @@ class ParameterStandard:
     """
 
     @staticmethod
-    def get_slice_position_dcs():
+    def get_slice_position_dcs(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -416,10 +535,16 @@ class ParameterStandard:
         """
         url = f"{config.base_url()}/parameter/standard/getSlicePositionDcs"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        cached = geometry_cache.get("slice_position_dcs")
+        if cached is not None:
+            return cached_reply(value=vector_object(cached))
+        reply = send_request(url, data, "GET", timeout=timeout)
+        if reply.result.success:
+            geometry_cache.observe("slice_position_dcs", vector_tuple(reply.value))
+        return reply
 
     @staticmethod
-    def set_slice_position_dcs(x=None, y=None, z=None, allow_side_effects=True, index=0):
+    def set_slice_position_dcs(x=None, y=None, z=None, allow_side_effects=True, index=0, timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -430,10 +555,13 @@ class ParameterStandard:
                 "index": index,
                 "value": {"x": x, "y": y, "z": z},
                 "allowSideEffects": allow_side_effects}
-        return send_request(url, data, "POST")
+        reply = send_request(url, data, "POST", timeout=timeout)
+        if reply.result.success and index == 0 and hasattr(reply, "valueSet"):
+            geometry_cache.write("slice_position_dcs", vector_tuple(reply.valueSet))
+        return reply
 
     @staticmethod
-    def get_slice_orientation_dcs():
+    def get_slice_orientation_dcs(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -443,11 +571,18 @@ class ParameterStandard:
         """
         url = f"{config.base_url()}/parameter/standard/getSliceOrientationDcs"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        cached = geometry_cache.get("slice_orientation_dcs")
+        if cached is not None:
+            return cached_reply(**{name: vector_object(vector) for name, vector in zip(ORIENTATION_VECTORS, cached)})
+        reply = send_request(url, data, "GET", timeout=timeout)
+        if reply.result.success:
+            geometry_cache.observe("slice_orientation_dcs",
+                                   tuple(vector_tuple(getattr(reply, name)) for name in ORIENTATION_VECTORS))
+        return reply
 
     @staticmethod
     def set_slice_orientation_dcs(normal: tuple = (0, 0, 0), phase: tuple = (0, 0, 0), read: tuple = (0, 0, 0),
-                                  allow_side_effects=True, index=0):
+                                  allow_side_effects=True, index=0, timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -462,11 +597,15 @@ class ParameterStandard:
                 "phase": {"x": phase[0], "y": phase[1], "z": phase[2]},
                 "read": {"x": read[0], "y": read[1], "z": read[2]},
                 "allowSideEffects": allow_side_effects}
-        return send_request(url, data, "POST")
+        reply = send_request(url, data, "POST", timeout=timeout)
+        if reply.result.success and index == 0 and hasattr(reply, "normalSet"):
+            geometry_cache.write("slice_orientation_dcs",
+                                 tuple(vector_tuple(getattr(reply, f"{name}Set")) for name in ORIENTATION_VECTORS))
+        return reply
 
     @staticmethod
     def set_slice_orientation_pcs(normal: tuple = (0, 0, 0), phase: tuple = (0, 0, 0), read: tuple = (0, 0, 0),
-                                  allow_side_effects=True, index=0):
+                                  allow_side_effects=True, index=0, timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -481,10 +620,10 @@ class ParameterStandard:
                 "phase": {"sag": float(phase[0]), "cor": float(phase[1]), "tra": float(phase[2])},
                 "read": {"sag": float(read[0]), "cor": float(read[1]), "tra": float(read[2])},
                 "allowSideEffects": allow_side_effects}
-        return send_request(url, data, "POST")
+        return send_request(url, data, "POST", timeout=timeout)
 
     @staticmethod
-    def get_slice_orientation_pcs():
+    def get_slice_orientation_pcs(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -494,10 +633,10 @@ class ParameterStandard:
         """
         url = f"{config.base_url()}/parameter/standard/getSliceOrientationPcs"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def get_number_of_slice_groups():
+    def get_number_of_slice_groups(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -505,10 +644,10 @@ class ParameterStandard:
         """
         url = f"{config.base_url()}/parameter/standard/getNumberOfSliceGroups"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def get_number_of_slices():
+    def get_number_of_slices(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -516,10 +655,11 @@ class ParameterStandard:
         """
         url = f"{config.base_url()}/parameter/standard/getNumberOfSlices"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def set_slice_orientation_degrees_dcs(roll_degrees, pitch_degrees, yaw_degrees, allow_side_effects=True, index=0):
+    def set_slice_orientation_degrees_dcs(roll_degrees, pitch_degrees, yaw_degrees, allow_side_effects=True, index=0,
+                                          timeout=None):
         """
         This math is not completely verified but seems to work.
         Response example:
@@ -542,7 +682,8 @@ class ParameterStandard:
         read = np.array([rotation_matrix[2, 0], rotation_matrix[2, 1], rotation_matrix[2, 2]])
 
         # Set the slice orientation using the RAS coordinate system
-        return ParameterStandard.set_slice_orientation_dcs(normal, phase, read, allow_side_effects, index)
+        return ParameterStandard.set_slice_orientation_dcs(normal, phase, read, allow_side_effects, index,
+                                                           timeout=timeout)
 
     @staticmethod
     def euler_to_rotation_matrix(angles=(0, 0, 0)):
@@ -559,7 +700,7 @@ class ParameterStandard:
         return np.dot(R_z, np.dot(R_y, R_x))
 
     @staticmethod
-    def get_slice_orientation_degrees_dcs():
+    def get_slice_orientation_degrees_dcs(timeout=None):
         """
         This math is not completely verified but seems to work.
         Response example:
@@ -568,7 +709,7 @@ class ParameterStandard:
          - "phase":{0},
          - "read":{180}
         """
-        answer = ParameterStandard.get_slice_orientation_dcs()
+        answer = ParameterStandard.get_slice_orientation_dcs(timeout=timeout)
         if not answer.result.success:
             return answer.result.reason
 
@@ -589,7 +730,7 @@ class ParameterStandard:
         return answer
 
     @staticmethod
-    def get_slice_thickness():
+    def get_slice_thickness(timeout=None):
         """
         Unit:mm
         Response example:
@@ -598,10 +739,16 @@ class ParameterStandard:
         """
         url = f"{config.base_url()}/parameter/standard/getSliceThickness"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        cached = geometry_cache.get("slice_thickness")
+        if cached is not None:
+            return cached_reply(value=cached)
+        reply = send_request(url, data, "GET", timeout=timeout)
+        if reply.result.success:
+            geometry_cache.observe("slice_thickness", reply.value)
+        return reply
 
     @staticmethod
-    def get_field_of_view_read():
+    def get_field_of_view_read(timeout=None):
         """
         Unit:mm
         Response example:
@@ -610,10 +757,16 @@ class ParameterStandard:
         """
         url = f"{config.base_url()}/parameter/standard/getFieldOfViewRead"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        cached = geometry_cache.get("field_of_view_read")
+        if cached is not None:
+            return cached_reply(value=cached)
+        reply = send_request(url, data, "GET", timeout=timeout)
+        if reply.result.success:
+            geometry_cache.observe("field_of_view_read", reply.value)
+        return reply
 
     @staticmethod
-    def set_field_of_view_read(value, allow_side_effects=True):
+    def set_field_of_view_read(value, allow_side_effects=True, timeout=None):
         """
         Unit:mm
         Response example:
@@ -624,10 +777,13 @@ class ParameterStandard:
         data = {"sessionId": config.session_id,
                 "value": value,
                 "allowSideEffects": allow_side_effects}
-        return send_request(url, data, "POST")
+        reply = send_request(url, data, "POST", timeout=timeout)
+        if reply.result.success and hasattr(reply, "valueSet"):
+            geometry_cache.write("field_of_view_read", reply.valueSet)
+        return reply
 
     @staticmethod
-    def set_slice_thickness(value, allow_side_effects=True):
+    def set_slice_thickness(value, allow_side_effects=True, timeout=None):
         """
         Unit:mm
         Response example:
@@ -636,10 +792,13 @@ class ParameterStandard:
         """
         url = f"{config.base_url()}/parameter/standard/setSliceThickness"
         data = {"sessionId": config.session_id, "value": float(value), "allowSideEffects": allow_side_effects}
-        return send_request(url, data, "POST")
+        reply = send_request(url, data, "POST", timeout=timeout)
+        if reply.result.success and hasattr(reply, "valueSet"):
+            geometry_cache.write("slice_thickness", reply.valueSet)
+        return reply
 
     @staticmethod
-    def get_base_resolution():
+    def get_base_resolution(timeout=None):
         """
         Unit:mm
         Response example:
@@ -648,10 +807,10 @@ class ParameterStandard:
         """
         url = f"{config.base_url()}/parameter/standard/getBaseResolution"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def set_base_resolution(value, allow_side_effects=True):
+    def set_base_resolution(value, allow_side_effects=True, timeout=None):
         """
         Unit:mm
         Response example:
@@ -660,7 +819,127 @@ class ParameterStandard:
         """
         url = f"{config.base_url()}/parameter/standard/setBaseResolution"
         data = {"sessionId": config.session_id, "value": value, "allowSideEffects": allow_side_effects}
-        return send_request(url, data, "POST")
+        return send_request(url, data, "POST", timeout=timeout)
+
+    @staticmethod
+    def slice_transaction(allow_side_effects=True, index=0, timeout=None):
+        """
+        Collects slice position, orientation, thickness and read FOV changes and sends them together, see SliceTransaction.
+        with ParameterStandard.slice_transaction() as slice_update:
+            slice_update.set_position(0, 0, 10)
+            slice_update.set_orientation_degrees(0, 90, 0)
+        print(slice_update.reply.positionSet)
+        """
+        return SliceTransaction(allow_side_effects, index, timeout)
+
+
+class SliceTransaction:
+    """
+    Only the last value per field is sent and values the geometry cache says are already set are skipped.
+    The remaining requests (one per parameter, Access-i has no combined call) go out one after the other in
+    COMMIT_ORDER: with allowSideEffects a set can move the others (an orientation change moves the position),
+    so the last one to reach the host has to be the same every time. After a set with side effects the later
+    fields are sent even if the cache says they are set, the cache does not know what the side effects did.
+    commit() returns one reply: result (success if all succeeded, reasons of the failed ones),
+    positionSet, normalSet, phaseSet, readSet, thicknessSet, fieldOfViewReadSet (what the host applied,
+    or the current value if nothing had to be sent) and requests (number sent).
+    """
+
+    COMMIT_ORDER = ("slice_orientation_dcs", "slice_position_dcs", "slice_thickness", "field_of_view_read")
+
+    def __init__(self, allow_side_effects=True, index=0, timeout=None):
+        """
+        :param timeout: per request, see send_request.
+        """
+        self.allow_side_effects = allow_side_effects
+        self.index = index
+        self.timeout = timeout
+        self.changes = {}
+        self.reply = None
+
+    def set_position(self, x, y, z):
+        self.changes["slice_position_dcs"] = (x, y, z)
+        return self
+
+    def set_orientation(self, normal, phase, read):
+        self.changes["slice_orientation_dcs"] = (tuple(normal), tuple(phase), tuple(read))
+        return self
+
+    def set_orientation_degrees(self, roll_degrees, pitch_degrees, yaw_degrees):
+        # Same vectors as ParameterStandard.set_slice_orientation_degrees_dcs
+        rotation_matrix = ParameterStandard.euler_to_rotation_matrix((roll_degrees, pitch_degrees, yaw_degrees))
+        return self.set_orientation(*(tuple(row) for row in rotation_matrix))
+
+    def set_thickness(self, value):
+        self.changes["slice_thickness"] = float(value)
+        return self
+
+    def set_field_of_view_read(self, value):
+        self.changes["field_of_view_read"] = value
+        return self
+
+    def request(self, name, value):
+        if name == "slice_position_dcs":
+            return ParameterStandard.set_slice_position_dcs(*value, allow_side_effects=self.allow_side_effects,
+                                                            index=self.index, timeout=self.timeout)
+        if name == "slice_orientation_dcs":
+            return ParameterStandard.set_slice_orientation_dcs(*value, allow_side_effects=self.allow_side_effects,
+                                                               index=self.index, timeout=self.timeout)
+        if name == "slice_thickness":
+            return ParameterStandard.set_slice_thickness(value, allow_side_effects=self.allow_side_effects,
+                                                         timeout=self.timeout)
+        return ParameterStandard.set_field_of_view_read(value, allow_side_effects=self.allow_side_effects,
+                                                        timeout=self.timeout)
+
+    def commit(self):
+        applied = {}
+        reasons = []
+        time_applied = ""
+        sent = 0
+        for name in self.COMMIT_ORDER:
+            if name not in self.changes:
+                continue
+            value = self.changes[name]
+            side_effects = sent > 0 and self.allow_side_effects
+            current = geometry_cache.get(name) if self.index == 0 and not side_effects else None
+            if current is not None and np.allclose(current, value, atol=1e-3):
+                applied[name] = current
+                continue
+            sent += 1
+            try:
+                answer = self.request(name, value)
+            except Exception as error:
+                reasons.append(f"{name}: {error}")
+                continue
+            if not answer.result.success:
+                reasons.append(f"{name}: {answer.result.reason}")
+                continue
+            time_applied = answer.result.time
+            if name == "slice_orientation_dcs":
+                applied[name] = tuple(vector_tuple(getattr(answer, f"{vector}Set")) for vector in ORIENTATION_VECTORS)
+            elif name == "slice_position_dcs":
+                applied[name] = vector_tuple(answer.valueSet)
+            else:
+                applied[name] = answer.valueSet
+        orientation = applied.get("slice_orientation_dcs", (None, None, None))
+        self.reply = SimpleNamespace(
+            result=SimpleNamespace(success=not reasons, reason="; ".join(reasons) or "ok", time=time_applied),
+            positionSet=vector_object(applied["slice_position_dcs"]) if "slice_position_dcs" in applied else None,
+            normalSet=vector_object(orientation[0]) if orientation[0] else None,
+            phaseSet=vector_object(orientation[1]) if orientation[1] else None,
+            readSet=vector_object(orientation[2]) if orientation[2] else None,
+            thicknessSet=applied.get("slice_thickness"),
+            fieldOfViewReadSet=applied.get("field_of_view_read"),
+            requests=sent)
+        self.changes = {}
+        return self.reply
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        if exception_type is None:
+            self.commit()
 
 
 class Table:
@@ -672,7 +951,7 @@ class Table:
     """
 
     @staticmethod
-    def get_current_table_position():
+    def get_current_table_position(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -680,10 +959,10 @@ class Table:
         """
         url = f"{config.base_url()}/table/getCurrentTablePosition"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def get_table_positioning_mode():
+    def get_table_positioning_mode(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -691,10 +970,10 @@ class Table:
         """
         url = f"{config.base_url()}/table/getTablePositioningMode"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def set_table_positioning_mode(value: Literal["isoCenter", "localRange", "fix"] = "isoCenter"):
+    def set_table_positioning_mode(value: Literal["isoCenter", "localRange", "fix"] = "isoCenter", timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -702,10 +981,10 @@ class Table:
         """
         url = f"{config.base_url()}/table/setTablePositioningMode"
         data = {"sessionId": config.session_id, "value": value}
-        return send_request(url, data, "POST")
+        return send_request(url, data, "POST", timeout=timeout)
 
     @staticmethod
-    def get_fix_table_position():
+    def get_fix_table_position(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -713,17 +992,17 @@ class Table:
         """
         url = f"{config.base_url()}/table/getFixTablePosition"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def set_fix_table_position(value: int):
+    def set_fix_table_position(value: int, timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"}
         """
         url = f"{config.base_url()}/table/setFixTablePosition"
         data = {"sessionId": config.session_id, "value": value}
-        return send_request(url, data, "POST")
+        return send_request(url, data, "POST", timeout=timeout)
 
 
 class Image:
@@ -732,17 +1011,17 @@ class Image:
     """
 
     @staticmethod
-    def set_image_format(value: Literal["dicom", "raw16bit"] = "raw16bit"):
+    def set_image_format(value: Literal["dicom", "raw16bit"] = "raw16bit", timeout=None):
         """
         Response example:
          - "result": {"success":true,"reason":"ok","time":"20170608_143325.423"}
         """
         url = f"{config.base_url()}/image/setImageFormat"
         data = {"sessionId": config.session_id, "value": value}
-        return send_request(url, data, "POST")
+        return send_request(url, data, "POST", timeout=timeout)
 
     @staticmethod
-    def get_last_series_number():
+    def get_last_series_number(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -750,17 +1029,17 @@ class Image:
         """
         url = f"{config.base_url()}/image/getLastSeriesNumber"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def connect_to_default_web_socket():
+    def connect_to_default_web_socket(timeout=None):
         """
         Response example:
          - "result": {"success":true,"reason":"ok","time":"20170608_143325.423"}
         """
         url = f"{config.base_url()}/image/connectServiceToDefaultWebSocket"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "POST")
+        return send_request(url, data, "POST", timeout=timeout)
 
 
 class ParameterConfigured:
@@ -770,7 +1049,7 @@ class ParameterConfigured:
     """
 
     @staticmethod
-    def get_configured_parameters():
+    def get_configured_parameters(timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -790,10 +1069,10 @@ class ParameterConfigured:
         """
         url = f"{config.base_url()}/parameter/configured/getConfiguredParameters"
         data = {"sessionId": config.session_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def get_parameter_info(protocol_tag=None):
+    def get_parameter_info(protocol_tag=None, timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -807,10 +1086,10 @@ class ParameterConfigured:
         """
         url = f"{config.base_url()}/parameter/configured/getParameterInfo"
         data = {"sessionId": config.session_id, "protocolTag": protocol_tag}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def get_parameter_value(parameter_id=None):
+    def get_parameter_value(parameter_id=None, timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -818,10 +1097,10 @@ class ParameterConfigured:
         """
         url = f"{config.base_url()}/parameter/configured/getParameterValue"
         data = {"sessionId": config.session_id, "id": parameter_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def get_parameter_description(parameter_id=None):
+    def get_parameter_description(parameter_id=None, timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -829,10 +1108,10 @@ class ParameterConfigured:
         """
         url = f"{config.base_url()}/parameter/configured/getParameterDescription"
         data = {"sessionId": config.session_id, "id": parameter_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def get_parameter_choices(parameter_id=None):
+    def get_parameter_choices(parameter_id=None, timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -840,10 +1119,10 @@ class ParameterConfigured:
         """
         url = f"{config.base_url()}/parameter/configured/getParameterChoices"
         data = {"sessionId": config.session_id, "id": parameter_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def set_parameter_value(parameter_id=None, value=None, allow_side_effects=True):
+    def set_parameter_value(parameter_id=None, value=None, allow_side_effects=True, timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -852,10 +1131,10 @@ class ParameterConfigured:
         url = f"{config.base_url()}/parameter/configured/setParameterValue"
         data = {"sessionId": config.session_id, "id": parameter_id, "value": value,
                 "allowSideEffects": allow_side_effects}
-        return send_request(url, data, "POST")
+        return send_request(url, data, "POST", timeout=timeout)
 
     @staticmethod
-    def get_is_parameter_available(parameter_id=None):
+    def get_is_parameter_available(parameter_id=None, timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -863,10 +1142,10 @@ class ParameterConfigured:
         """
         url = f"{config.base_url()}/parameter/configured/getIsParameterAvailable"
         data = {"sessionId": config.session_id, "id": parameter_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def get_is_parameter_editable(parameter_id=None):
+    def get_is_parameter_editable(parameter_id=None, timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -874,10 +1153,10 @@ class ParameterConfigured:
         """
         url = f"{config.base_url()}/parameter/configured/getIsParameterEditable"
         data = {"sessionId": config.session_id, "id": parameter_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
 
     @staticmethod
-    def get_parameter_limits(parameter_id=None):
+    def get_parameter_limits(parameter_id=None, timeout=None):
         """
         Response example:
          - "result":{"success":true,"reason":"ok","time":"20170608T143325.423"},
@@ -887,7 +1166,157 @@ class ParameterConfigured:
         """
         url = f"{config.base_url()}/parameter/configured/getParameterLimits"
         data = {"sessionId": config.session_id, "id": parameter_id}
-        return send_request(url, data, "GET")
+        return send_request(url, data, "GET", timeout=timeout)
+
+
+class ParameterDescriptor:
+    """
+    A get_ / set_ call of a service, with what it needs from the user.
+    arguments: [(name, kind)] of the values to give (allow_side_effects, index and timeout keep their defaults),
+    kind is "vector" (x, y, z), "int", a tuple of allowed choices or None (number if it is one, else text).
+    """
+
+    def __init__(self, name, service, method):
+        self.name = name
+        self.service = service
+        self.method = method
+        self.kind = name[:3]
+        self.arguments = [(argument.name, ParameterDescriptor.argument_kind(argument))
+                          for argument in inspect.signature(method).parameters.values()
+                          if argument.name not in ("allow_side_effects", "index", "timeout")]
+
+    @staticmethod
+    def argument_kind(argument):
+        if argument.annotation is tuple or isinstance(argument.default, tuple):
+            return "vector"
+        if argument.annotation is int:
+            return "int"
+        if get_origin(argument.annotation) is Literal:
+            return get_args(argument.annotation)
+        return None
+
+    def __call__(self, *args, **kwargs):
+        return self.method(*args, **kwargs)
+
+    def parse(self, text):
+        """
+        :param text: comma separated values as typed in the UI, e.g. "0, 0, 1" or "0,0,1, 0,1,0, 1,0,0".
+        :return: the positional arguments for the call.
+        """
+        values = [value.strip() for value in text.split(",")] if text.strip() else []
+        args = []
+        for name, kind in self.arguments:
+            if not values:
+                break
+            if kind == "vector":
+                args.append(tuple(float(value) for value in values[:3]))
+                values = values[3:]
+                continue
+            value = values.pop(0)
+            if kind == "int":
+                args.append(int(float(value)))
+            elif isinstance(kind, tuple):
+                if value not in kind:
+                    raise ValueError(f"{name} must be one of {', '.join(kind)}")
+                args.append(value)
+            else:
+                try:
+                    args.append(float(value))
+                except ValueError:
+                    args.append(value)
+        if values:
+            raise ValueError(f"{self.name} takes {len(self.arguments)} values, got more")
+        return args
+
+
+def build_parameter_registry(services):
+    """
+    Built once at import, get/set dispatch is a dict lookup instead of searching the module on every call.
+    """
+    registry = {}
+    for service in services:
+        for name in sorted(vars(service)):
+            if (name.startswith("get_") or name.startswith("set_")) and isinstance(vars(service)[name], staticmethod):
+                registry[name] = ParameterDescriptor(name, service, getattr(service, name))
+    return registry
+
+
+parameter_registry = build_parameter_registry((ParameterStandard, Table))
+
+
+def get_parameters(names):
+    """
+    Reads several parameters at once (concurrently, over the pooled connections).
+    :return: {name: reply}
+    """
+    futures = {name: get_request_executor().submit(parameter_registry[name]) for name in names}
+    return {name: future.result() for name, future in futures.items()}
+
+
+def set_parameters(values):
+    """
+    Sets several parameters in one go, in the given order (a set can change the next one as a side effect).
+    :param values: {name: value, tuple of arguments or text to parse}, e.g. {"set_slice_thickness": 3,
+        "set_slice_position_dcs": (0, 0, 10)}
+    :return: {name: reply}
+    """
+    replies = {}
+    for name, value in values.items():
+        descriptor = parameter_registry[name]
+        if isinstance(value, str):
+            args = descriptor.parse(value)
+        elif isinstance(value, (tuple, list)) and (len(descriptor.arguments) > 1 or
+                                                   descriptor.arguments[0][1] != "vector"):
+            args = value
+        else:
+            args = [value]
+        replies[name] = descriptor(*args)
+    return replies
+
+
+request_executor = None
+
+
+def get_request_executor():
+    global request_executor
+    if request_executor is None:
+        request_executor = ThreadPoolExecutor(max_workers=config.pool_size, thread_name_prefix="accessi")
+    return request_executor
+
+
+def asynchronous(service):
+    """
+    Async counterpart of a service class: same methods, as coroutines.
+    The requests run on a thread pool sized like the connection pool, so gathered calls go out concurrently
+    over the pooled keep-alive connections (no extra http library needed).
+    """
+
+    def wrap(method):
+        async def call(*args, **kwargs):
+            return await asyncio.get_running_loop().run_in_executor(get_request_executor(),
+                                                                    partial(method, *args, **kwargs))
+        call.__name__ = method.__name__
+        call.__doc__ = method.__doc__
+        return staticmethod(call)
+
+    methods = {name: wrap(getattr(service, name)) for name, value in vars(service).items()
+               if isinstance(value, staticmethod)}
+    return type(f"Async{service.__name__}", (), {"__doc__": service.__doc__, **methods})
+
+
+AsyncParameterStandard = asynchronous(ParameterStandard)
+AsyncTable = asynchronous(Table)
+AsyncHostControl = asynchronous(HostControl)
+AsyncTemplateExecution = asynchronous(TemplateExecution)
+
+
+async def gather_requests(*requests_to_send, return_exceptions=False):
+    """
+    Sends the requests concurrently. Example:
+    position, thickness = await gather_requests(AsyncParameterStandard.get_slice_position_dcs(),
+                                                AsyncParameterStandard.get_slice_thickness())
+    """
+    return await asyncio.gather(*requests_to_send, return_exceptions=return_exceptions)
 
 
 def handle_websocket_message(data):
@@ -897,6 +1326,8 @@ def handle_websocket_message(data):
         service = message.get('service', '')
         request = message.get('request', '')
         response = message.get('response', '')
+        if "imageStream" in (service, request):
+            geometry_cache.update_from_image(response.get("value", {}).get("image", {}))
     except json.JSONDecodeError as e:
         print("Error decoding JSON:", e)
     return [service, request, response, message]
@@ -909,6 +1340,9 @@ async def connect_websocket():
     """
     try:
         url = config.websocket_default_url()
+        if config.websocket_protocol == "ws":
+            # Plain websocket, only for the local stand-in (accessi_stand_in.py --no-tls).
+            return websockets.connect(url)
         if not config.ssl_verify:
             ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
             ssl_context.check_hostname = False
@@ -923,17 +1357,89 @@ async def connect_websocket():
 
 
 def response_to_object(json_response):
-    return json.loads(json.dumps(json_response.json()), object_hook=lambda d: SimpleNamespace(**d))
+    return content_to_object(json_response.content)
+
+
+def content_to_object(content):
+    # Parsed once, straight from the body into SimpleNamespaces.
+    return json.loads(content, object_hook=lambda d: SimpleNamespace(**d))
+
 
+http_sessions = {}
+
+
+def get_http_session():
+    """
+    One pooled requests.Session per host and process (a forked stage process must not share the parent's sockets).
+    """
+    key = (os.getpid(), config.protocol, config.ip_address, config.port, config.pool_size)
+    session = http_sessions.get(key)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.pool_size)
+        session.mount(f"{config.protocol}://", adapter)
+        session.headers.update(config.headers)
+        http_sessions[key] = session
+    return session
+
+
+def http_request(url, data, request_type, timeout=None):
+    """
+    Straight to the host, :return: the requests.Response.
+    """
+    return get_http_session().request(request_type, url, json=data,
+                                      timeout=config.timeout if timeout is None else timeout,
+                                      verify=config.ssl_verify)
 
-def send_request(url, data, request_type: Literal["GET", "POST"] = "POST"):
-    if request_type == "GET":
-        response = requests.get(url, headers=config.headers, json=data, timeout=config.timeout,
-                                verify=config.ssl_verify)
-    elif request_type == "POST":
-        response = requests.post(url, headers=config.headers, json=data, timeout=config.timeout,
-                                 verify=config.ssl_verify)
-    else:
+
+gateway_sockets = threading.local()
+
+
+def gateway_request(url, data, request_type, timeout=None):
+    """
+    Through the local AccessiGateway. One REQ socket per thread (and process), a socket that timed out is dropped,
+    REQ can not send again before it got its reply.
+    """
+    socket = getattr(gateway_sockets, "socket", None)
+    if socket is None or gateway_sockets.pid != os.getpid():
+        socket = zmq.Context.instance().socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(f"tcp://127.0.0.1:{config.gateway_port}")
+        gateway_sockets.socket, gateway_sockets.pid = socket, os.getpid()
+    timeout = config.timeout if timeout is None else timeout
+    socket.send(json.dumps({"url": url, "data": data, "type": request_type, "timeout": timeout}).encode())
+    # The gateway may first have to wait for a write to the same parameter.
+    if not socket.poll((sum(timeout) if isinstance(timeout, tuple) else timeout) * 2000 + 1000):
+        socket.close()
+        gateway_sockets.socket = None
+        raise requests.exceptions.Timeout(f"No reply from the Access-i gateway for {url}")
+    status, content = socket.recv_multipart()
+    status = int(status)
+    if status == 0:
+        raise requests.exceptions.ConnectionError(content.decode())
+    if status >= 400:
+        raise requests.exceptions.HTTPError(f"{status} Error for url: {url}")
+    return content
+
+
+def service_timeout(url):
+    """
+    :return: config.service_timeouts of the service of url, else config.timeout.
+    """
+    service = url.split("/product/", 1)[-1].split("/", 1)[0]
+    return config.service_timeouts.get(service, config.timeout)
+
+
+def send_request(url, data, request_type: Literal["GET", "POST"] = "POST", timeout=None):
+    """
+    :param timeout: seconds (or (connect, read) tuple) for this call, service_timeout(url) if None.
+    """
+    if request_type not in ("GET", "POST"):
         raise SystemExit(f"request type incorrect {request_type}")
+    if timeout is None:
+        timeout = service_timeout(url)
+    if config.gateway_port:
+        return content_to_object(gateway_request(url, data, request_type, timeout))
+    response = http_request(url, data, request_type, timeout)
     response.raise_for_status()
     return response_to_object(response)
@@ -0,0 +1,141 @@
+"""
+Binary frame format used between the websocket and the downstream stages.
+
+An imageStream message is parsed (json) and its image decoded (base64) exactly once, in AccessiWebsocket.
+After that a frame travels as a ZMQ multipart message:
+    [0] fixed size header (frame id, timestamps, dimensions, slice geometry)
+    [1] raw uint16 pixel buffer
+or, with shared memory transport, the header and pixels go into a SharedFrameRing slot
+and the ZMQ message is only the ring notification.
+"""
+
+import time
+import struct
+import base64
+from collections import deque
+import zmq
+import numpy as np
+from ImageData import FrameMetadata
+from frame_trace import STAGES, STAGE_INDEX, now
+from SharedFrameRing import read_notification
+
+FRAME_MAGIC = b"MRIF"
+FRAME_VERSION = 2
+
+# magic, version, frame_id, trace_id, received_time, acquisition_time,
+# columns, rows, voxel size (column, row, slice), slice position dcs (x, y, z, nan if the frame had none),
+# stage timestamps (frame_trace.STAGES)
+HEADER = struct.Struct(f"<4sHIQd16sHHdddddd{len(STAGES)}d")
+
+
+def pack_frame(response, frame_id, trace_id=0, received=None):
+    """
+    :param response: the 'response' dict of an imageStream websocket message (as returned by handle_websocket_message)
+    :param frame_id: running number given by the websocket.
+    :param trace_id: frame_trace.make_trace_id
+    :param received: frame_trace.now() when the websocket message arrived.
+    :return: [header, pixels] ready for socket.send_multipart
+    """
+    image = response["value"]["image"]
+    dimensions = image["dimensions"]
+    voxel_size = dimensions.get("voxelSize", {})
+    position = image.get("coordinates", {}).get("mrSliceDcs", {}).get("position", {})
+    pixels = base64.b64decode(image["data"])
+    stage_times = [0.0] * len(STAGES)
+    stage_times[STAGE_INDEX["received"]] = received or 0.0
+    stage_times[STAGE_INDEX["decoded"]] = now()
+    header = HEADER.pack(FRAME_MAGIC, FRAME_VERSION, frame_id, trace_id, time.time(),
+                         image["acquisition"]["time"].encode(),
+                         dimensions["columns"], dimensions["rows"],
+                         voxel_size.get("column", 0), voxel_size.get("row", 0), voxel_size.get("slice", 0),
+                         position.get("x", np.nan), position.get("y", np.nan), position.get("z", np.nan),
+                         *stage_times)
+    return [header, pixels]
+
+
+def unpack_header(header) -> FrameMetadata:
+    (magic, version, frame_id, trace_id, received_time, acquisition_time, columns, rows,
+     voxel_column, voxel_row, voxel_slice, x, y, z, *stage_times) = HEADER.unpack(header)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise ValueError(f"Not a binary frame: {magic} v{version}")
+    return FrameMetadata(frame_id=frame_id, trace_id=trace_id, received_time=received_time,
+                         acquisition_time=acquisition_time.rstrip(b"\x00").decode(),
+                         columns=columns, rows=rows,
+                         voxel_size=(voxel_column, voxel_row, voxel_slice),
+                         slice_position=None if np.isnan((x, y, z)).any() else (x, y, z),
+                         stage_times=stage_times)
+
+
+def send_frame(socket, frame, ring_writer=None):
+    """
+    :param frame: [header, pixels] from pack_frame
+    :param ring_writer: SharedFrameRing.RingWriter, None sends the pixels over ZMQ.
+    """
+    if ring_writer is None:
+        socket.send_multipart(frame, copy=False)
+        return
+    header, pixels = frame
+    metadata = unpack_header(header)
+    image = np.frombuffer(pixels, dtype=np.uint16).reshape((metadata.columns, metadata.rows))
+    socket.send(ring_writer.write(header, [image]))
+
+
+def unpack_frame(parts, copy=False):
+    """
+    :param parts: result of recv_multipart, either bytes or zmq.Frame (copy=False).
+    :param copy: copy shared memory frames out of the ring, for callers that keep the frame (SharedFrameRing.read).
+        ZMQ frames are never copied, the buffer belongs to the message.
+    :return: uint16 image and metadata.
+        None, None if the shared memory slot was overwritten before or while it was read.
+    """
+    parts = [part.buffer if isinstance(part, zmq.Frame) else part for part in parts]
+    if len(parts) == 1:
+        frame = read_notification(parts[0], copy)
+        if frame is None:
+            return None, None
+        header, (image,) = frame
+        return image, unpack_header(header)
+    header, pixels = parts
+    metadata = unpack_header(header)
+    image = np.frombuffer(pixels, dtype=np.uint16).reshape((metadata.columns, metadata.rows))
+    return image, metadata
+
+
+def receive_latest_frame(socket, copy=False):
+    """
+    zmq.CONFLATE does not support multipart messages, so the same 'latest wins' behaviour is done here:
+    block for one frame, then drop everything that queued up behind it.
+    Works for both multipart frames and shared memory notifications.
+    :param copy: see unpack_frame
+    """
+    while True:
+        parts = socket.recv_multipart(copy=False)
+        while True:
+            try:
+                parts = socket.recv_multipart(flags=zmq.NOBLOCK, copy=False)
+            except zmq.error.Again:
+                break
+        image, metadata = unpack_frame(parts, copy)
+        if image is not None:
+            return image, metadata
+
+
+def receive_frames(socket, max_frames):
+    """
+    Like receive_latest_frame, but keeps up to max_frames of the frames that queued up (the newest ones),
+    for batched inference. Frames from shared memory are copied out of the ring, the batch outlives the slots.
+    :return: [(image, metadata)] oldest first.
+    """
+    messages = deque(maxlen=max_frames)
+    messages.append(socket.recv_multipart(copy=False))
+    while True:
+        try:
+            messages.append(socket.recv_multipart(flags=zmq.NOBLOCK, copy=False))
+            continue
+        except zmq.error.Again:
+            pass
+        frames = [frame for frame in (unpack_frame(parts, copy=True) for parts in messages) if frame[0] is not None]
+        if frames:
+            return frames
+        messages.clear()
+        messages.append(socket.recv_multipart(copy=False))
@@ -0,0 +1,95 @@
+"""
+Per-frame tracing through the pipeline.
+
+Every frame gets a trace id in the websocket (unique over websocket restarts) and a vector of stage timestamps,
+one slot per entry in STAGES, that travels with the FrameMetadata. Each stage stamps its own slot.
+The timestamps are time.perf_counter(), which is a system wide monotonic clock on Linux (CLOCK_MONOTONIC)
+and Windows (QueryPerformanceCounter), so stamps from different stage processes can be subtracted.
+Unreached stages stay 0.
+"""
+
+import os
+import time
+import numpy as np
+
+STAGES = ("received", "decoded", "inferred", "tracked", "rendered", "can_sent")
+STAGE_INDEX = {stage: index for index, stage in enumerate(STAGES)}
+
+now = time.perf_counter
+
+
+def new_session_id():
+    return int.from_bytes(os.urandom(4), "little")
+
+
+def make_trace_id(session_id, frame_id):
+    return (session_id << 32) | (frame_id & 0xFFFFFFFF)
+
+
+def mark(metadata, stage, timestamp=None):
+    """
+    :param metadata: FrameMetadata of the frame.
+    :param stage: one of STAGES.
+    """
+    metadata.stage_times[STAGE_INDEX[stage]] = now() if timestamp is None else timestamp
+
+
+def stage_durations(stage_times):
+    """
+    :return: seconds from the previous reached stage to each stage (nan if not reached)
+        and total from the first to the last reached stage.
+        Previous is by time, not by STAGES order (3D Suite sends CAN before it renders).
+    """
+    durations = np.full(len(STAGES), np.nan)
+    reached = sorted((stage_times[index], index) for index in range(len(STAGES)) if stage_times[index])
+    for (previous, _), (timestamp, index) in zip(reached, reached[1:]):
+        durations[index] = timestamp - previous
+    total = reached[-1][0] - reached[0][0] if len(reached) > 1 else np.nan
+    return durations, total
+
+
+class StageLatencyWindow:
+    """
+    Sliding window over the last frames, to see which stage is eating the latency budget.
+    Not thread safe, one per consumer (the last stage that sees the frame has the whole vector).
+    """
+
+    def __init__(self, window_size=500):
+        self.durations = np.full((window_size, len(STAGES) + 1), np.nan)
+        self.count = 0
+        self.last_trace_id = None
+
+    def add(self, metadata):
+        """
+        :return: False if the frame was already added (e.g. the same frame rendered again).
+        """
+        if metadata.trace_id is not None and metadata.trace_id == self.last_trace_id:
+            return False
+        self.last_trace_id = metadata.trace_id
+        durations, total = stage_durations(metadata.stage_times)
+        row = self.durations[self.count % len(self.durations)]
+        row[:-1] = durations
+        row[-1] = total
+        self.count += 1
+        return True
+
+    def percentiles(self, percentiles=(50, 95, 99)):
+        """
+        :return: {stage: {percentile: seconds}} for every stage seen in the window, plus "total".
+        """
+        window = self.durations[:min(self.count, len(self.durations))]
+        result = {}
+        for index, stage in enumerate(STAGES + ("total",)):
+            column = window[:, index]
+            column = column[~np.isnan(column)]
+            if column.size:
+                result[stage] = dict(zip(percentiles, np.percentile(column, percentiles).tolist()))
+        return result
+
+    def summary(self, percentile=95):
+        """
+        :return: one line of per-stage latency at the given percentile in ms, for status bars and prints.
+        """
+        stages = self.percentiles((percentile,))
+        return f"p{percentile} " + " | ".join(f"{stage} {values[percentile] * 1000:.1f}ms"
+                                              for stage, values in stages.items())
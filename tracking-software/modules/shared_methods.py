@@ -3,45 +3,38 @@
 """
 
 import json
-import base64
-import numpy as np
-from datetime import datetime
+import time
 from types import SimpleNamespace
+from LatencyLogger import get_latency_logger
 
 
 def json_to_object(json_string):
     return json.loads(json_string, object_hook=lambda d: SimpleNamespace(**d))
 
 
-def convert_websocket_data_to_image(websocket_data):
-    image_data = json.loads(websocket_data.decode('utf-8'), object_hook=lambda d: SimpleNamespace(**d))
-    image = None
-    metadata = None
-    if "imageStream" in image_data:
-        image, metadata = convert_metadata_to_image(image_data[2])
-    return image, metadata
+def acquisition_seconds(acquisition_time):
+    """
+    :param acquisition_time: scanner acquisition time 'HHMMSS.ffffff'
+    :return: seconds since midnight
+    """
+    return int(acquisition_time[0:2]) * 3600 + int(acquisition_time[2:4]) * 60 + float(acquisition_time[4:])
 
 
-def convert_metadata_to_image(metadata):
-    image = metadata.value.image.data
-    image = np.frombuffer(base64.b64decode(image), dtype=np.uint16)
-    image = np.reshape(image, (metadata.value.image.dimensions.columns, metadata.value.image.dimensions.rows))
-    image = (image / image.max() * 255).astype(np.uint8)
-    return image, metadata
+def seconds_since_midnight():
+    now = time.time()
+    return (now + time.localtime(now).tm_gmtoff) % 86400
 
 
 def calculate_latency(metadata, write_to_file=False, filename="default_latency_log"):
     """
 
-    :param write_to_file:
-    :param filename:
-    :param metadata: the 'image[2]' list from websocket imageStream.
-    :return: latency compared to datetime.now() in seconds
+    :param write_to_file: queue the record for the background LatencyLogger of this file.
+    :param filename: log file name, without extension.
+    :param metadata: FrameMetadata of the image.
+    :return: latency compared to the current time in seconds
     """
-    image_timestamp = datetime.strptime(metadata.value.image.acquisition.time, '%H%M%S.%f')
-    latency = (datetime.strptime(datetime.now().strftime('%H%M%S.%f'), '%H%M%S.%f') - image_timestamp).total_seconds()
+    acquisition = acquisition_seconds(metadata.acquisition_time)
+    latency = seconds_since_midnight() - acquisition
     if write_to_file:
-        with open(filename, 'a+') as file:
-            image_id = f"{image_timestamp.strftime('%H%M%S.%f')[:-3]}"
-            file.write(f"{image_id} | {datetime.now().strftime('%H%M%S.%f')} | {datetime.now()} | {latency}\n")
+        get_latency_logger(filename).log(metadata, acquisition, latency)
     return latency
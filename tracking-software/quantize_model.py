@@ -0,0 +1,163 @@
+"""
+Makes reduced precision variants of the segmentation model and gates them on detection accuracy.
+
+Usage: python quantize_model.py MODEL_512_V3 --images <folder with the detection_data.csv images>
+       [--variants int8 bf16] [--calibration ../susceptibility-simulation/generated_dataset/images]
+
+    int8  post-training static quantization of the ONNX export (onnxruntime, QDQ, per channel weights),
+          calibrated on images of the synthetic susceptibility dataset (SusceptibilitySimulation.ipynb).
+    bf16  TorchScript with bfloat16 weights and activations (input and logits stay float32).
+
+Accuracy: for every image of detection_data.csv found in --images, the centroids detected in the variant's
+segmentation (GuidewireTracking.find_artifact_centroids) are matched to the float32 ones within --distance pixels.
+F1 over all images is written with the variant to exported/variants.json, CNNModel only loads a variant
+whose F1 reaches its configured threshold.
+detection_data.csv: image, markers, detected, missed, false positives (of the float32 model, counted by hand).
+"""
+
+import os
+import sys
+import csv
+import json
+import argparse
+import numpy as np
+
+sys.path.append("./modules")
+from modules.CNNModel import CNNModel
+from modules.GuidewireTracking import GuidewireTracking
+from modules.InferenceEngine import (TorchScriptInference, OnnxInference, exported_model_paths, variant_report_path,
+                                     VARIANT_BACKENDS)
+from export_model import load_images, wrap_network, export_torchscript, export_onnx
+
+MAX_CALIBRATION_IMAGES = 200
+
+
+def read_detection_data(path):
+    """
+    :return: {image name: (markers, detected, missed, false positives)}
+    """
+    with open(path, newline="") as file:
+        return {row[0]: tuple(int(value) for value in row[1:5]) for row in csv.reader(file) if row}
+
+
+def quantize_int8(torch, cnn, calibration_images):
+    """
+    Static INT8 quantization of each fold's ONNX export (made first if it is not there).
+    """
+    from onnxruntime.quantization import (quantize_static, CalibrationDataReader, QuantFormat, QuantType,
+                                          CalibrationMethod)
+
+    class ImageCalibrationReader(CalibrationDataReader):
+        def __init__(self):
+            self.images = iter(calibration_images)
+
+        def get_next(self):
+            image = next(self.images, None)
+            if image is None:
+                return None
+            cnn.engine.fill_batch([image])
+            return {"image": cnn.engine.batch[:1].copy()}
+
+    float_paths = exported_model_paths(cnn.path_to_model_directory, cnn.folds, "onnx")
+    int8_paths = exported_model_paths(cnn.path_to_model_directory, cnn.folds, "onnx", "int8")
+    example = torch.zeros((1, 1) + cnn.plans.patch_size)
+    for network, float_path, int8_path in zip(cnn.engine.networks, float_paths, int8_paths):
+        if not os.path.exists(float_path):
+            export_onnx(torch, wrap_network(torch, network), example, float_path)
+        quantize_static(float_path, int8_path, ImageCalibrationReader(), quant_format=QuantFormat.QDQ,
+                        per_channel=True, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                        calibrate_method=CalibrationMethod.MinMax)
+        print(f"Quantized {int8_path}")
+    return int8_paths
+
+
+def convert_bf16(torch, cnn):
+    paths = exported_model_paths(cnn.path_to_model_directory, cnn.folds, "torchscript", "bf16")
+    example = torch.zeros((1, 1) + cnn.plans.patch_size)
+    for network, path in zip(cnn.engine.networks, paths):
+        export_torchscript(torch, wrap_network(torch, network, torch.bfloat16), example, path)
+    return paths
+
+
+def match_centroids(reference, centroids, distance):
+    """
+    Greedy nearest matching. :return: number of reference centroids with a centroid within distance.
+    """
+    remaining = list(centroids)
+    matched = 0
+    for x, y in reference:
+        if not remaining:
+            break
+        distances = [np.hypot(x - other_x, y - other_y) for other_x, other_y in remaining]
+        nearest = int(np.argmin(distances))
+        if distances[nearest] <= distance:
+            matched += 1
+            remaining.pop(nearest)
+    return matched
+
+
+def detection_accuracy(cnn, engine, images, detection_data, distance):
+    """
+    :return: F1 of the variant's centroids against float32, and per image counts for the report.
+    """
+    matched = reference_count = variant_count = 0
+    rows = []
+    for name, image in images.items():
+        reference = GuidewireTracking.find_artifact_centroids(cnn.engine.predict([image])[0] * 255)[0]
+        centroids = GuidewireTracking.find_artifact_centroids(engine.predict([image])[0] * 255)[0]
+        image_matched = match_centroids(reference, centroids, distance)
+        matched += image_matched
+        reference_count += len(reference)
+        variant_count += len(centroids)
+        rows.append((name, detection_data[name], len(reference), len(centroids), image_matched))
+    f1 = 2 * matched / (reference_count + variant_count) if reference_count + variant_count else 1.0
+    return f1, rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="INT8 / bfloat16 variants of the CNN with a detection accuracy gate.")
+    parser.add_argument("model", nargs="?", default="MODEL_512_V3", help="folder in ../MODELS")
+    parser.add_argument("--variants", nargs="+", default=["int8", "bf16"], choices=list(VARIANT_BACKENDS))
+    parser.add_argument("--calibration", default="../susceptibility-simulation/generated_dataset/images",
+                        help="synthetic images for the INT8 calibration")
+    parser.add_argument("--images", required=True, help="folder with the images listed in detection_data.csv")
+    parser.add_argument("--detection-data", default="../susceptibility-simulation/detection_data.csv")
+    parser.add_argument("--distance", type=float, default=5, help="pixels between matching centroids")
+    parser.add_argument("--threads", type=int, default=None)
+    arguments = parser.parse_args()
+
+    import torch
+    cnn = CNNModel(control=None, cnn_model=arguments.model, inference="direct", threads=arguments.threads)
+    cnn.prepare_engine("cpu")
+    detection_data = read_detection_data(arguments.detection_data)
+    test_images = {name: image for name, image in load_images(arguments.images).items() if name in detection_data}
+    if not test_images:
+        sys.exit(f"None of the images in {arguments.detection_data} are in {arguments.images}")
+
+    report_path = variant_report_path(cnn.path_to_model_directory)
+    report = {}
+    if os.path.exists(report_path):
+        with open(report_path) as file:
+            report = json.load(file)
+    for variant in arguments.variants:
+        if variant == "int8":
+            if not os.path.isdir(arguments.calibration):
+                sys.exit(f"No calibration images in {arguments.calibration}, generate the synthetic dataset first "
+                         f"(susceptibility-simulation/SusceptibilitySimulation.ipynb)")
+            calibration = list(load_images(arguments.calibration).values())[:MAX_CALIBRATION_IMAGES]
+            paths = quantize_int8(torch, cnn, calibration)
+            engine = OnnxInference(paths, cnn.plans, threads=arguments.threads)
+        else:
+            paths = convert_bf16(torch, cnn)
+            engine = TorchScriptInference(torch, paths, cnn.plans, threads=arguments.threads)
+        f1, rows = detection_accuracy(cnn, engine, test_images, detection_data, arguments.distance)
+        print(f"{variant}: detection F1 against float32 {f1:.4f} on {len(rows)} images")
+        print("  image                  csv markers/detected/missed/fp   float32  variant  matched")
+        for name, (markers, detected, missed, false_positives), reference, found, matched in rows:
+            print(f"  {name:<22} {markers:>3} {detected:>3} {missed:>3} {false_positives:>3}"
+                  f"{reference:>20} {found:>8} {matched:>8}")
+        report[variant] = {"backend": VARIANT_BACKENDS[variant], "files": [os.path.basename(path) for path in paths],
+                           "f1": f1, "images": len(rows), "distance": arguments.distance}
+    with open(report_path, "w") as file:
+        json.dump(report, file, indent=4)
+    print(f"Wrote {report_path}")
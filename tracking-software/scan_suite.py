@@ -1,6 +1,6 @@
 import copy
-import pickle
 import time
+import asyncio
 from datetime import datetime
 from threading import Thread
 from threading import Lock
@@ -32,7 +32,10 @@ from vtkmodules.vtkFiltersModeling import vtkCollisionDetectionFilter
 sys.path.append("./modules")
 import modules.accessi_local as Access
 import modules.ImageData as ImageData
-from modules.shared_methods import convert_metadata_to_image, calculate_latency
+from modules.shared_methods import calculate_latency
+from modules.FrameNormalizer import FrameNormalizer
+from modules.ImagePublisher import subscribe_image_data, receive_image_data
+from modules.frame_trace import mark, StageLatencyWindow
 
 from PySide6.QtWidgets import QApplication, QMainWindow, QFileDialog
 import zmq
@@ -59,7 +62,7 @@ lineColor = vtkNamedColors().GetColor3d('peacock')
 
 class ScanSuiteWindow:
     def __init__(self, SUBSCRIBE_PORT=None, accessi_ip_address=None, accessi_version=None, collision_detection=False,
-                 cathbot_canbus_feedback=False):
+                 cathbot_canbus_feedback=False, accessi_gateway_port=None):
         # this is awful but no comment, it works.
         self.SUBSCRIBE_PORT = SUBSCRIBE_PORT
         self.collision_detection = collision_detection
@@ -70,6 +73,8 @@ class ScanSuiteWindow:
         self.registered = False
         self.Access.config.ip_address = accessi_ip_address
         self.Access.config.version = accessi_version
+        # Shares the main window's Access-i session through the gateway (None: own session).
+        self.Access.config.gateway_port = accessi_gateway_port
         self.renderer = None
         self.window_interactor = None
         self.mri_slice_fov = None
@@ -86,14 +91,18 @@ class ScanSuiteWindow:
         self.drawn_artifacts = []
         self.tracking_data = None
         self.mri_image_metadata = None
+        # (position, thickness, field of view, orientation) replies, refreshed by poll_slice_geometry.
+        self.slice_geometry = None
+        self.normalizer = FrameNormalizer()
+        self.latency_window = StageLatencyWindow()
         print(f"3D Suite started: collision_detection: {collision_detection}, "
               f"cathbot_canbus_feedback: {cathbot_canbus_feedback}")
 
     @staticmethod
     def start(SUBSCRIBE_PORT=None, accessi_ip_address=None, accessi_version=None,
-              collision_detection=False, cathbot_canbus_feedback=False):
+              collision_detection=False, cathbot_canbus_feedback=False, accessi_gateway_port=None):
         scan_suite = ScanSuiteWindow(SUBSCRIBE_PORT, accessi_ip_address, accessi_version,
-                                     collision_detection, cathbot_canbus_feedback)
+                                     collision_detection, cathbot_canbus_feedback, accessi_gateway_port)
         scan_suite.register()
         scan_suite.initialize_vtk()
         scan_suite.add_mri_slice_actor()
@@ -231,11 +240,10 @@ class ScanSuiteWindow:
 
     @calldata_type(VTK_INT)
     def set_mri_slice_transform_callback(self, caller, timer_event, some_argument):
-        if self.registered:
-            position = self.Access.ParameterStandard.get_slice_position_dcs().value
-            thickness = self.Access.ParameterStandard.get_slice_thickness().value
-            field_of_view = self.Access.ParameterStandard.get_field_of_view_read().value
-            orientation = self.Access.ParameterStandard.get_slice_orientation_degrees_dcs()
+        if self.registered and self.slice_geometry is not None:
+            # No requests on the render thread, the geometry is fetched by poll_slice_geometry.
+            position, thickness, field_of_view, orientation = self.slice_geometry
+            position, thickness, field_of_view = position.value, thickness.value, field_of_view.value
             if not hasattr(orientation, "phase"):
                 return
             self.mri_slice_fov = field_of_view
@@ -255,6 +263,7 @@ class ScanSuiteWindow:
             self.mri_image_plane_source.SetPoint2((field_of_view // 2), (field_of_view // 2), 0)
             self.mri_image_plane_actor.SetUserTransform(transform)
 
+            tracking_data = self.tracking_data
             self.draw_artifact_spheres()
             collision = False
             if self.collision_detection:
@@ -283,8 +292,23 @@ class ScanSuiteWindow:
             # Send to CathBot here.
             if self.cathbot_canbus_feedback:
                 self.send_canbus_message(collision)
+                if tracking_data is not None:
+                    mark(tracking_data.metadata, "can_sent")
 
             self.render_window.Render()
+            if tracking_data is not None:
+                self.record_latency(tracking_data.metadata)
+
+    def record_latency(self, metadata):
+        """
+        The timer renders the same frame until a new one arrives, only the first render of a frame counts.
+        """
+        if metadata.trace_id == self.latency_window.last_trace_id:
+            return
+        mark(metadata, "rendered")
+        self.latency_window.add(metadata)
+        if self.latency_window.count % 100 == 0:
+            print(self.latency_window.summary())
 
     def start_vtk(self):
         if self.SUBSCRIBE_PORT is not None and self.SUBSCRIBE_PORT != "None":
@@ -292,7 +316,7 @@ class ScanSuiteWindow:
             self.subscriber_socket = context.socket(zmq.SUB)
             self.subscriber_socket.setsockopt(zmq.CONFLATE, 1)
             self.subscriber_socket.connect("tcp://127.0.0.1:" + str(self.SUBSCRIBE_PORT))
-            self.subscriber_socket.subscribe("")
+            subscribe_image_data(self.subscriber_socket, pixels=True)
 
         self.window_interactor.Render()
 
@@ -308,13 +332,17 @@ class ScanSuiteWindow:
 
         data_thread = Thread(target=self.get_coordinate_data_thread, daemon=True)
         data_thread.start()
+        if self.registered:
+            Thread(target=asyncio.run, args=(self.poll_slice_geometry(),), daemon=True).start()
 
         self.window_interactor.Start()
 
     def close_event(self, obj, event):
         # Cleanup operations when window is closed
         if self.registered:
-            self.Access.HostControl.release_host_control()
+            # Behind the gateway the session is shared, host control stays with the main window.
+            if not self.Access.config.gateway_port:
+                self.Access.HostControl.release_host_control()
             self.Access.Authorization.deregister()
         if self.canbus_connection is not None:
             self.canbus_connection.shutdown()
@@ -360,15 +388,34 @@ class ScanSuiteWindow:
             # It does need this sleep to keep the 3D UI properly responsive.
             try:
                 if self.SUBSCRIBE_PORT is not None and self.subscriber_socket is not None:
-                    data = self.subscriber_socket.recv()
-                    tracking_data: ImageData = pickle.loads(data)
-                    tracking_data.image, metadata = convert_metadata_to_image(tracking_data.metadata)
+                    tracking_data: ImageData = receive_image_data(self.subscriber_socket)
+                    if tracking_data is None:
+                        continue
+                    if tracking_data.pixels is not None:
+                        # Copy, the render timer reads the texture while the next frame is normalized.
+                        tracking_data.image = self.normalizer.normalize(tracking_data.pixels).copy()
                     self.tracking_data = tracking_data
-                    self.mri_image_metadata = metadata
+                    self.mri_image_metadata = tracking_data.metadata
+                    # Keeps the slice geometry reads of poll_slice_geometry off the network while frames come in.
+                    self.Access.geometry_cache.update_from_metadata(tracking_data.metadata)
 
             except Exception as error:
                 print(f"Error in get_coordinate thread: {error}")
 
+    async def poll_slice_geometry(self, interval=0.2):
+        """
+        The four parameter reads go out together, a tick costs one round trip instead of four.
+        """
+        parameters = self.Access.AsyncParameterStandard
+        while True:
+            try:
+                self.slice_geometry = tuple(await self.Access.gather_requests(
+                    parameters.get_slice_position_dcs(), parameters.get_slice_thickness(),
+                    parameters.get_field_of_view_read(), parameters.get_slice_orientation_degrees_dcs()))
+            except Exception as error:
+                print(f"Error in slice geometry thread: {error}")
+            await asyncio.sleep(interval)
+
 
 class SplineCallback:
     def __init__(self, spline_widget):
@@ -0,0 +1,32 @@
+"""
+Run from tracking-software: python -m pytest test_analyze_latency.py
+"""
+
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "modules"))
+from analyze_latency import parse_text_chunk
+
+LINE = b"100420.645 | 100424.075113 | 2024-04-15 10:04:24.075113 | 3.430113\n"
+
+
+def test_log_lines():
+    image_id, logged, latency = parse_text_chunk(LINE * 3)
+    assert image_id.tolist() == [36260645] * 3
+    assert np.allclose(logged, 36264.075113)
+    assert np.allclose(latency, 3.430113)
+
+
+def test_bad_lines_are_skipped():
+    chunk = b"image id | logged | time | latency\n" + LINE + b"not a log line\n" + LINE + b"1 | 2 | 3\n" + LINE
+    image_id, logged, latency = parse_text_chunk(chunk)
+    assert image_id.tolist() == [36260645] * 3
+    assert np.allclose(logged, 36264.075113)
+    assert np.allclose(latency, 3.430113)
+
+
+def test_no_log_lines():
+    image_id, logged, latency = parse_text_chunk(b"not a log line\n")
+    assert image_id.size == logged.size == latency.size == 0